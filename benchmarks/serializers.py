@@ -0,0 +1,75 @@
+"""Compare the serialization of Pyramid responses with the previous format.
+
+The previous format pickled the HTTP message (``str(response)``) and parsed
+it back with ``Response.from_file`` on each cache hit.
+
+Usage: python benchmarks/serializers.py [body size in bytes]
+"""
+import cPickle as pickle
+from cStringIO import StringIO
+import sys
+import timeit
+
+from pyramid import testing
+from pyramid.response import Response
+
+from pyramid_caching.serializers import (
+    PICKLE_PROTOCOL,
+    ResponseAdapter,
+    SerializerUtility,
+    )
+
+NUMBER = 10000
+
+
+def legacy_dumps(response):
+    meta = {
+        'type': ResponseAdapter.name,
+        'version': 1,
+        'payload': str(response),
+        }
+    return pickle.dumps(meta, protocol=PICKLE_PROTOCOL)
+
+
+def legacy_loads(data):
+    data = pickle.loads(data)
+    res = Response.from_file(StringIO(data['payload']))
+    res._headerlist = [(str(k), str(v)) for k, v in res._headerlist]
+    return res
+
+
+def make_response(size):
+    response = Response('x' * size, content_type='application/json')
+    response.headers['ETag'] = 'a62f2225bf70bfaccbc7f1ef2a397836717377de'
+    response.headers['X-View-Cache'] = 'MISS'
+    response.cache_control.max_age = 60
+    return response
+
+
+def report(name, func, arg):
+    elapsed = min(timeit.repeat(lambda: func(arg), number=NUMBER, repeat=3))
+    print '%-8s %8.2f us' % (name, elapsed / NUMBER * 1e6)
+
+
+def main(size):
+    config = testing.setUp()
+    serializer = SerializerUtility(config.registry)
+    serializer.register_serialization_adapter(Response, ResponseAdapter)
+
+    response = make_response(size)
+    legacy_data = legacy_dumps(response)
+    data = serializer.dumps(response)
+    print 'body: %d bytes, legacy: %d bytes, binary: %d bytes' % (
+        size, len(legacy_data), len(data))
+
+    print 'dumps'
+    report('legacy', legacy_dumps, response)
+    report('binary', serializer.dumps, response)
+    print 'loads'
+    report('legacy', legacy_loads, legacy_data)
+    report('binary', serializer.loads, data)
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2048)
@@ -0,0 +1,140 @@
+"""Stop calling cache backends that keep failing."""
+
+import logging
+import threading
+import time
+
+from pyramid_caching.events import CircuitBreakerStateChanged
+from pyramid_caching.exc import Base as BaseCacheError
+from pyramid_caching.exc import (
+    CacheBudgetExceeded,
+    CacheDisabled,
+    CacheKeyAlreadyExists,
+    CircuitOpen,
+    )
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+
+    """Bypass a backend for ``cooldown`` seconds after ``failures``
+    consecutive failed calls.
+
+    A call fails when it raises a pyramid_caching error other than
+    CacheDisabled and CacheKeyAlreadyExists, when it exceeds its latency
+    budget (CacheBudgetExceeded) or when it takes more than ``slow_call``
+    seconds. While the circuit is open, calls raise CircuitOpen
+    immediately. After the cooldown, the circuit is half-open: up to
+    ``trials`` calls go through, and the circuit closes when all of them
+    succeeded or opens again on the first failure.
+
+    State changes are passed to ``notify`` as CircuitBreakerStateChanged
+    events.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failures=5, cooldown=30, slow_call=None,
+                 trials=1, notify=None):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.slow_call = slow_call
+        self.trials = trials
+        self.notify = notify
+        self.state = self.CLOSED
+        self._failed = 0
+        self._opened_at = None
+        self._trials_started = 0
+        self._trials_succeeded = 0
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """Return ``func(*args, **kwargs)`` unless the circuit is open."""
+        trial = self._allow()
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except CacheBudgetExceeded:
+            self._record(trial, False)
+            raise
+        except CacheDisabled:
+            self._record(trial, None)
+            raise
+        except CacheKeyAlreadyExists:
+            self._record(trial, True)
+            raise
+        except BaseCacheError:
+            self._record(trial, False)
+            raise
+        except Exception:
+            self._record(trial, None)
+            raise
+        duration = time.time() - start
+        self._record(trial,
+                     self.slow_call is None or duration <= self.slow_call)
+        return result
+
+    def _allow(self):
+        """Return whether the call is a trial, raise CircuitOpen if it is not
+        allowed."""
+        changes = []
+        try:
+            with self._lock:
+                if self.state == self.CLOSED:
+                    return False
+                if self.state == self.OPEN:
+                    if time.time() - self._opened_at < self.cooldown:
+                        raise CircuitOpen(self.name)
+                    changes.append(self._set_state(self.HALF_OPEN))
+                    self._trials_started = 0
+                    self._trials_succeeded = 0
+                if self._trials_started >= self.trials:
+                    raise CircuitOpen(self.name)
+                self._trials_started += 1
+                return True
+        finally:
+            self._notify(changes)
+
+    def _record(self, trial, succeeded):
+        """Record the outcome of a call: True, False or None when it tells
+        nothing about the backend."""
+        changes = []
+        with self._lock:
+            if trial and self.state == self.HALF_OPEN:
+                if succeeded is None:
+                    self._trials_started -= 1
+                elif not succeeded:
+                    changes.append(self._open())
+                else:
+                    self._trials_succeeded += 1
+                    if self._trials_succeeded >= self.trials:
+                        self._failed = 0
+                        changes.append(self._set_state(self.CLOSED))
+            elif not trial and self.state == self.CLOSED:
+                if succeeded:
+                    self._failed = 0
+                elif succeeded is not None:
+                    self._failed += 1
+                    if self._failed >= self.failures:
+                        changes.append(self._open())
+        self._notify(changes)
+
+    def _open(self):
+        self._opened_at = time.time()
+        log.warning('Circuit breaker %s open for %ss', self.name,
+                    self.cooldown)
+        return self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        previous_state, self.state = self.state, state
+        return CircuitBreakerStateChanged(self, state, previous_state)
+
+    def _notify(self, changes):
+        if self.notify is None:
+            return
+        for event in changes:
+            self.notify(event)
@@ -1,17 +1,41 @@
 from collections import namedtuple
 import hashlib
 import logging
+import math
+import random
+import threading
+import time
 
+from pyramid.exceptions import ConfigurationError
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.location import lineage
+from pyramid.settings import asbool
+from pyramid.threadlocal import manager as threadlocal_manager
+from webob.acceptparse import AcceptEncodingValidHeader
 from zope.interface import implementer, classImplements
 
-from pyramid_caching.events import ViewCacheHit, ViewCacheMiss
+from pyramid_caching.breaker import CircuitBreaker
+from pyramid_caching.events import (
+    ViewCacheBudgetExceeded,
+    ViewCacheHit,
+    ViewCacheMiss,
+    ViewCacheStale,
+    )
 from pyramid_caching.interfaces import (
     ICacheClient,
+    ICacheLeaseClient,
     ICacheManager,
+    IVersionedCacheClient,
     )
 from pyramid_caching.exc import Base as BaseCacheError
-from pyramid_caching.exc import CacheDisabled
+from pyramid_caching.exc import (
+    CacheBudgetExceeded,
+    CacheDisabled,
+    CacheError,
+    CacheKeyAlreadyExists,
+    CacheLeaseTimeout,
+    )
+from pyramid_caching.local import copy_result, LocalCacheClient, LRUCache
 
 log = logging.getLogger(__name__)
 
@@ -26,19 +50,110 @@ def includeme(config):
 
     config.add_directive('add_cache_client', add_cache_client)
 
+    config.add_directive('add_versioned_cache_client',
+                         add_versioned_cache_client)
+
     config.add_request_method(get_cache_manager, 'cache_manager', reify=True)
 
+    settings = config.registry.settings
+    coalesce_misses = asbool(settings.get('caching.coalesce_misses', True))
+    coalesce_timeout = float(settings.get('caching.coalesce_timeout', 10))
+    leases = parse_lease_settings(settings)
+    breaker = parse_breaker_settings(settings, config.registry.notify)
+    local_max_size = int(settings.get('caching.local.max_size', 0))
+    local_store = settings.get('caching.local.store', 'bytes')
+    key_max_length = int(settings.get('caching.key.max_length', 0)) or None
+    budget = settings.get('caching.budget')
+    budget = float(budget) if budget is not None else None
+    if local_store not in ('bytes', 'results'):
+        raise ConfigurationError(
+            'caching.local.store must be bytes or results, got %r' %
+            local_store)
+
     def register():
         cache_client = config.get_cache_client()
         versioner = config.get_versioner()
         serializer = config.get_serializer()
-        manager = Manager(config.registry, versioner, cache_client, serializer)
+        versioned_cache_client = config.registry.queryUtility(
+            IVersionedCacheClient)
+        local_results = None
+        if key_max_length is not None:
+            # The single round trip script does not compact keys.
+            versioned_cache_client = None
+        if local_max_size:
+            # The local layer needs the versioned key before fetching data.
+            versioned_cache_client = None
+            if local_store == 'results':
+                local_results = LRUCache(local_max_size)
+            else:
+                cache_client = LocalCacheClient(
+                    cache_client, local_max_size,
+                    mutable_prefixes=[Manager.STALE_POINTER_PREFIX])
+        if leases is not None and not ICacheLeaseClient.providedBy(
+                cache_client):
+            raise ConfigurationError(
+                'caching.lease.enabled requires a cache client providing '
+                'ICacheLeaseClient, got %r' % cache_client)
+        manager = Manager(config.registry, versioner, cache_client, serializer,
+                          versioned_cache_client=versioned_cache_client,
+                          coalesce_misses=coalesce_misses,
+                          coalesce_timeout=coalesce_timeout,
+                          leases=leases,
+                          local_results=local_results,
+                          key_max_length=key_max_length,
+                          breaker=breaker,
+                          budget=budget)
         config.registry.registerUtility(manager)
         log.debug('registering cache manager %r', manager)
 
     config.action((__name__, 'cache_manager'), register, order=2)
 
 
+def parse_lease_settings(settings):
+    """Return the CacheLeases configured by ``caching.lease.*`` settings.
+
+    - caching.lease.enabled: take a lease on cache misses (default: false)
+    - caching.lease.ttl: lease duration in seconds (default: 5)
+    - caching.lease.wait: time waiting for the lease holder (default: 0.5)
+    - caching.lease.interval: cache polling interval (default: 0.05)
+    - caching.lease.fallback: ``render`` or ``fail`` (default: render)
+    """
+    if not asbool(settings.get('caching.lease.enabled', False)):
+        return None
+    return CacheLeases(
+        ttl=float(settings.get('caching.lease.ttl', 5)),
+        wait=float(settings.get('caching.lease.wait', 0.5)),
+        interval=float(settings.get('caching.lease.interval', 0.05)),
+        fallback=settings.get('caching.lease.fallback', CacheLeases.RENDER),
+        )
+
+
+def parse_breaker_settings(settings, notify=None):
+    """Return the CircuitBreaker configured by ``caching.breaker.*``
+    settings.
+
+    - caching.breaker.failures: consecutive failures opening the circuit
+      (default: 0, no circuit breaker)
+    - caching.breaker.cooldown: seconds before trial calls (default: 30)
+    - caching.breaker.slow_call: calls taking more seconds count as failures
+      (default: none)
+    - caching.breaker.trials: successful trial calls closing the circuit
+      (default: 1)
+    """
+    failures = int(settings.get('caching.breaker.failures', 0))
+    if not failures:
+        return None
+    slow_call = settings.get('caching.breaker.slow_call')
+    return CircuitBreaker(
+        'cache',
+        failures=failures,
+        cooldown=float(settings.get('caching.breaker.cooldown', 30)),
+        slow_call=float(slow_call) if slow_call is not None else None,
+        trials=int(settings.get('caching.breaker.trials', 1)),
+        notify=notify,
+        )
+
+
 def get_cache_client(config_or_request):
     return config_or_request.registry.getUtility(ICacheClient)
 
@@ -59,31 +174,495 @@ def add_cache_client(config, client):
     config.action((__name__, 'cache_client'), register, order=0)
 
 
+def add_versioned_cache_client(config, client):
+    """Register a client resolving versions and cache content at once."""
+    def register():
+        log.debug('registering versioned cache client %r', client)
+        config.registry.registerUtility(client, IVersionedCacheClient)
+
+    config.action((__name__, 'versioned_cache_client'), register, order=0)
+
+
 @implementer(ICacheManager)
 class Manager(object):
 
-    def __init__(self, registry, versioner, cache_client, serializer):
+    """Get results from the cache or from the application.
+
+    When ``coalesce_misses`` is true (setting ``caching.coalesce_misses``,
+    enabled by default), concurrent misses on the same key within a process
+    are coalesced: a single thread calls the application while the others
+    wait for it and deserialize its result. They wait at most
+    ``coalesce_timeout`` seconds (setting ``caching.coalesce_timeout``,
+    default: 10), then call the application themselves.
+
+    With ``leases`` (see :class:`CacheLeases`), misses are also coordinated
+    across processes through the cache client.
+
+    When ``get_or_cache`` is called with ``max_stale``, a pointer to the last
+    good entry is kept for each key root and unversioned identities of the
+    dependencies: outdated versions of a resource are served for this
+    resource only. On a miss, this entry is served while the new version is
+    rendered in a background thread, for at most ``max_stale`` seconds after
+    its first stale delivery.
+
+    With ``local_results`` (a :class:`pyramid_caching.local.LRUCache`),
+    deserialized results of cache hits are kept in process memory and copied
+    on each hit. Enabled with the settings ``caching.local.max_size`` (in
+    bytes of serialized data) and ``caching.local.store = results``. With
+    ``caching.local.store = bytes``, the cache client is wrapped in a
+    :class:`pyramid_caching.local.LocalCacheClient` instead.
+
+    A :class:`CachePolicy` passed to ``get_or_cache`` sets the expiration of
+    the cache entries and the maximum size of the cached data.
+
+    ``if_none_match`` is a container of entity tags, such as
+    ``request.if_none_match``. When the hash of the versioned key, or one of
+    its encoded variants (see :func:`matching_etag`), is one of them, a
+    not-modified result is returned without fetching the cache entry nor
+    calling the application.
+
+    With ``key_max_length`` (setting ``caching.key.max_length``), longer
+    cache keys are compacted, see :class:`CacheKey`.
+
+    With a ``breaker`` (see :func:`parse_breaker_settings`), the lookup of
+    versions and cache entries is bypassed after repeated failures: it raises
+    CircuitOpen, a CacheDisabled error. Storing rendered results goes through
+    the same breaker; when it fails, the result is returned without being
+    cached. Version increments are never bypassed, since a missed increment
+    would leave outdated entries.
+
+    ``budget`` (setting ``caching.budget``, or ``budget`` argument of
+    ``get_or_cache``) is the time in seconds allowed to look up the versions
+    and the cache entry. It is checked before fetching the cache entry: once
+    exceeded, the lookup is abandoned with CacheBudgetExceeded, a
+    CacheDisabled error that the breaker counts as a failure. A backend call
+    in progress is not interrupted (see the client timeouts), and an entry
+    already fetched is used. The single round trip of a
+    ``versioned_cache_client`` is not checked.
+
+    The steps that do not perform I/O are public, for frontends driving
+    their own (for example non-blocking) clients::
+
+        keys = manager.versioner.identify_all(dependencies)
+        versiontuples = <get the versions of keys>
+        key = manager.make_key(prefixes,
+                               manager.versioner.format_keys(versiontuples))
+        content = <get str(key)>
+        result = manager.load(key, content) if content is not None else None
+        if result is None:
+            data = manager.serializer.dumps(<render>)
+            if policy.accepts(data):
+                <add str(key), data, **policy.add_kwargs()>
+    """
+
+    STALE_POINTER_PREFIX = 'stale:'
+    STALE_SINCE_PREFIX = 'stale:since:'
+
+    def __init__(self, registry, versioner, cache_client, serializer,
+                 versioned_cache_client=None, coalesce_misses=False,
+                 coalesce_timeout=None,
+                 leases=None, local_results=None, key_max_length=None,
+                 breaker=None, budget=None):
         self.versioner = versioner
         self.cache_client = cache_client
         self.serializer = serializer
         self.registry = registry
+        self.versioned_cache_client = versioned_cache_client
+        self.misses = SingleFlight(coalesce_timeout) if coalesce_misses \
+            else None
+        self.leases = leases
+        self.local_results = local_results
+        self.key_max_length = key_max_length
+        self.breaker = breaker
+        self.budget = budget
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def get_or_cache(self, get_result, prefixes, dependencies,
+                     max_stale=None, if_none_match=None, policy=None,
+                     budget=None):
+        if budget is None:
+            budget = self.budget
+        key, cache_content, result = self._call(
+            self._lookup, prefixes, dependencies, if_none_match, budget)
+        if result is not None:
+            return result
 
-    def get_or_cache(self, get_result, prefixes, dependencies):
-        versioned_keys = self.versioner.get_multi_keys(dependencies)
-        key = CacheKey(prefixes, versioned_keys)
-
+        if cache_content is not None:
+            result = self._hit(key, cache_content)
+            if result is not None:
+                return result
+
+        stale_pointer = None
+        if max_stale is not None:
+            stale_pointer = self._stale_pointer(
+                key, self.versioner.identify_all(dependencies))
+            result = self._stale(get_result, key, stale_pointer, max_stale,
+                                 policy)
+            if result is not None:
+                return result
+
+        if self.misses is not None:
+            leader, filled = self.misses.run(
+                str(key),
+                lambda: self._fill(get_result, key, stale_pointer, policy))
+            if leader:
+                return filled[0]
+            if filled is not None:
+                log.debug('Coalesced miss on %s', key)
+                return self._hit(key, filled[1])
+
+        return self._fill(get_result, key, stale_pointer, policy)[0]
+
+    def _call(self, func, *args, **kwargs):
+        """Call the cache backend through the circuit breaker, if any."""
+        if self.breaker is None:
+            return func(*args, **kwargs)
+        return self.breaker.call(func, *args, **kwargs)
+
+    def _lookup(self, prefixes, dependencies, if_none_match=None,
+                budget=None):
+        """Return a tuple (key, cache content, CacheResult), the result being
+        set when no further lookup is needed."""
+        if self.versioned_cache_client is not None and not if_none_match:
+            key, cache_content = self._lookup_versioned(prefixes,
+                                                        dependencies)
+            return key, cache_content, None
+
+        started = time.time() if budget is not None else None
+        key = self.make_key(prefixes,
+                            self.versioner.get_multi_keys(dependencies))
+        if if_none_match and matching_etag(key.hash(), if_none_match):
+            log.debug('Not modified: %s', key)
+            return key, None, CacheResult.not_modified(key)
+        if self.local_results is not None:
+            result = self.local_results.get(str(key))
+            if result is not None:
+                log.debug('Local cache HIT on %s', key)
+                return key, None, CacheResult.hit(key, copy_result(result))
+        self._check_budget(key, started, budget)
         cache_content = self.cache_client.get(str(key))
+        return key, cache_content, None
+
+    def _check_budget(self, key, started, budget):
+        if budget is None:
+            return
+        elapsed = time.time() - started
+        if elapsed > budget:
+            log.info('Cache lookup budget exceeded on %s: %.3fs', key,
+                     elapsed)
+            raise CacheBudgetExceeded(key, elapsed, budget)
+
+    def make_key(self, prefixes, versioned_keys, root=None):
+        """Return the CacheKey of a view from its prefixes and the versioned
+        keys of its dependencies (see Versioner.format_keys)."""
+        return CacheKey(prefixes, versioned_keys, root=root,
+                        max_length=self.key_max_length)
+
+    def load(self, key, cache_content):
+        """Return the CacheResult of a cache entry, or None if the entry was
+        serialized in a format that is not supported anymore."""
+        result = self.serializer.loads(cache_content)
+        if result is None:
+            log.debug('Unsupported serialization format on %s', key)
+            return None
+        log.debug('Cache HIT on %s', key)
+        return CacheResult.hit(key, result)
+
+    def _hit(self, key, cache_content):
+        result = self.load(key, cache_content)
+        if result is not None and self.local_results is not None:
+            self.local_results.put(str(key), copy_result(result.data),
+                                   len(cache_content))
+        return result
+
+    def _fill(self, get_result, key, stale_pointer=None, policy=None):
+        """Return a tuple (CacheResult, data) for a missing cache entry."""
+        if self.leases is None:
+            return self._render(get_result, key, stale_pointer, policy)
+
+        token = self.cache_client.acquire_lease(str(key), self.leases.ttl)
+        if token is None:
+            cache_content, released = self.leases.wait(self.cache_client,
+                                                       str(key))
+            result = None
+            if cache_content is not None:
+                result = self._hit(key, cache_content)
+            if result is not None:
+                return result, cache_content
+            if released:
+                log.debug('Lease on %s released without entry', key)
+                return self._render(get_result, key, stale_pointer, policy)
+            if self.leases.fallback == CacheLeases.FAIL:
+                raise CacheLeaseTimeout(str(key))
+            log.debug('Lease wait timeout on %s', key)
+            return self._render(get_result, key, stale_pointer, policy)
+
+        return self._render_leased(token, get_result, key, stale_pointer,
+                                   policy)
+
+    def _render_leased(self, token, get_result, key, stale_pointer=None,
+                       policy=None):
+        try:
+            return self._render(get_result, key, stale_pointer, policy)
+        finally:
+            try:
+                self.cache_client.release_lease(str(key), token)
+            except CacheError:
+                log.warning('Failed to release lease on %s', key,
+                            exc_info=True)
+
+    def _render(self, get_result, key, stale_pointer=None, policy=None):
+        """Call the application and store its result in the cache, and
+        point ``stale_pointer`` to it if set."""
+        result = get_result()
+        data = self.serializer.dumps(result)
+        if policy is None:
+            policy = DEFAULT_POLICY
+        if not policy.accepts(data):
+            log.debug('Cache entry %s is too large (%d bytes)', key, len(data))
+            return CacheResult.miss(key, result), data
+        try:
+            self._store(key, data, stale_pointer, policy)
+        except CacheDisabled as e:
+            log.debug('Cache entry %s not stored: %r', key, e)
+        except CacheError:
+            log.warning('Failed to store cache entry %s', key, exc_info=True)
+        log.debug('Cache MISS on %s', key)
+        return CacheResult.miss(key, result), data
+
+    def _store(self, key, data, stale_pointer, policy):
+        try:
+            self._call(self.cache_client.add, str(key), data,
+                       **policy.add_kwargs())
+        except CacheKeyAlreadyExists:
+            log.debug('Cache entry %s was added concurrently', key)
+        if stale_pointer is not None:
+            self._call(self.cache_client.set, stale_pointer, str(key))
+
+    def _stale_pointer(self, key, identities):
+        """The pointer to the last good entry of the root of ``key`` for
+        the unversioned ``identities`` of its dependencies, compacted like
+        the key."""
+        return self.STALE_POINTER_PREFIX + self.make_key(
+            key.bases, identities, root=key.root()).key()
+
+    def _stale(self, get_result, key, stale_pointer, max_stale, policy=None):
+        """Return the last good result pointed by ``stale_pointer`` and
+        refresh it in the background, or None if there is none within the
+        budget."""
+        stale_key = self.cache_client.get(stale_pointer)
+        if stale_key is None or stale_key == str(key):
+            return None
+        if not self._within_stale_budget(key, max_stale):
+            log.debug('Stale budget exceeded on %s', key)
+            return None
+        cache_content = self.cache_client.get(stale_key)
+        if cache_content is None:
+            return None
+
+        result = self.serializer.loads(cache_content)
+        if result is None:
+            return None
+        self._refresh(get_result, key, stale_pointer, policy)
+        log.debug('Cache STALE on %s', key)
+        return CacheResult.stale(key, result, stale_key)
+
+    def _within_stale_budget(self, key, max_stale):
+        """Record the first stale delivery for ``key`` and check how long
+        ago it happened. The record expires with the budget."""
+        marker = self.STALE_SINCE_PREFIX + str(key)
+        now = time.time()
+        try:
+            self.cache_client.add(marker, repr(now),
+                                  expiration=max(int(math.ceil(max_stale)), 1))
+            return True
+        except CacheKeyAlreadyExists:
+            since = self.cache_client.get(marker)
+        return since is not None and now - float(since) <= max_stale
+
+    def _refresh(self, get_result, key, stale_pointer, policy=None):
+        """Render ``key`` in a background thread, once per process."""
+        with self._refreshing_lock:
+            if str(key) in self._refreshing:
+                return
+            self._refreshing.add(str(key))
+        thread = threading.Thread(target=self._run_refresh,
+                                  args=(get_result, key, stale_pointer,
+                                        policy),
+                                  name='pyramid_caching-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _run_refresh(self, get_result, key, stale_pointer, policy=None):
+        try:
+            if self.leases is None:
+                self._render(get_result, key, stale_pointer, policy)
+                return
+            token = self.cache_client.acquire_lease(str(key), self.leases.ttl)
+            if token is None:
+                log.debug('Refresh of %s in progress elsewhere', key)
+                return
+            self._render_leased(token, get_result, key, stale_pointer,
+                                policy)
+        except Exception:
+            log.exception('Background refresh failed on %s', key)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(str(key))
+
+    def _lookup_versioned(self, prefixes, dependencies):
+        """Return the versioned cache key and the cached content, if any."""
+        keys = self.versioner.identify_all(dependencies)
+        root = CacheKey(prefixes, []).root()
+        versiontuples, cache_content = \
+            self.versioned_cache_client.get_versioned(root, keys)
+        key = self.make_key(prefixes,
+                            self.versioner.format_keys(versiontuples),
+                            root=root)
+        return key, cache_content
+
+
+class CacheLeases(object):
+
+    """Protect the application against cache stampedes across processes.
+
+    On a cache miss, the first process takes a lease on the key for ``ttl``
+    seconds and renders the result. Others poll the cache every ``interval``
+    seconds, up to ``wait`` seconds. When the lease is released without a
+    cache entry (the result was not cached or the holder failed), they
+    render the result themselves right away. Otherwise, they apply the
+    ``fallback`` policy once the wait expires:
+
+    - ``render``: call the application anyway.
+    - ``fail``: raise CacheLeaseTimeout, which is not caught by the view
+      decorator. Register an exception view to shed the load.
+    """
 
-        if cache_content is not None:
-            result = self.serializer.loads(cache_content)
-            log.debug('Cache HIT on %s', key)
-            return CacheResult.hit(key, result)
-        else:
-            result = get_result()
-            data = self.serializer.dumps(result)
-            self.cache_client.add(str(key), data)
-            log.debug('Cache MISS on %s', key)
-            return CacheResult.miss(key, result)
+    RENDER = 'render'
+    FAIL = 'fail'
+
+    def __init__(self, ttl=5, wait=0.5, interval=0.05, fallback=RENDER):
+        if fallback not in (self.RENDER, self.FAIL):
+            raise ConfigurationError(
+                'Invalid lease fallback policy %r' % fallback)
+        self.ttl = ttl
+        self.wait_timeout = wait
+        self.interval = interval
+        self.fallback = fallback
+
+    def wait(self, cache_client, key):
+        """Poll the cache for ``key`` until the wait timeout expires.
+
+        Return a tuple ``(cache content, released)``: the content is None
+        when the wait expired or when the lease was ``released`` without
+        adding the entry.
+        """
+        deadline = time.time() + self.wait_timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, False
+            time.sleep(min(self.interval, remaining))
+            cache_content = cache_client.get(key)
+            if cache_content is not None:
+                return cache_content, False
+            token = cache_client.acquire_lease(key, self.ttl)
+            if token is not None:
+                cache_client.release_lease(key, token)
+                return None, True
+
+
+class CachePolicy(object):
+
+    """Storage policy of the cache entries of a view.
+
+    - ``ttl``: expiration of the entries in seconds (default: cache client
+      default expiration).
+    - ``max_size``: results larger than ``max_size`` bytes once serialized
+      are not stored.
+    - ``jitter``: fraction of ``ttl`` by which the expiration is randomly
+      shortened, so that entries cached at the same time do not expire
+      together.
+    """
+
+    def __init__(self, ttl=None, max_size=None, jitter=0):
+        if not 0 <= jitter < 1:
+            raise ConfigurationError('Invalid cache jitter %r' % jitter)
+        if jitter and ttl is None:
+            raise ConfigurationError('Cache jitter requires a ttl')
+        self.ttl = ttl
+        self.max_size = max_size
+        self.jitter = jitter
+
+    def accepts(self, data):
+        return self.max_size is None or len(data) <= self.max_size
+
+    def expiration(self):
+        """Return the expiration of a new entry in seconds, or None."""
+        if self.ttl is None:
+            return None
+        ttl = self.ttl * (1 - random.uniform(0, self.jitter))
+        return max(int(ttl), 1)
+
+    def add_kwargs(self):
+        """Keyword arguments of ICacheClient.add for a new entry."""
+        expiration = self.expiration()
+        if expiration is None:
+            return {}
+        return {'expiration': expiration}
+
+
+DEFAULT_POLICY = CachePolicy()
+
+
+class SingleFlight(object):
+
+    """Coalesce concurrent calls sharing the same key within a process.
+
+    Concurrent callers wait for the first one at most ``timeout`` seconds
+    (no limit by default).
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def run(self, key, func):
+        """Call ``func`` unless a call for ``key`` is already in progress.
+
+        Return a tuple ``(leader, value)``. The thread calling ``func`` gets
+        its return value with ``leader`` set to True. Concurrent callers wait
+        for it and get the same value, or None if ``func`` raised or did not
+        return within the timeout.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                log.warning('Gave up waiting for a concurrent call on %s',
+                            key)
+            return False, flight.value
+
+        try:
+            flight.value = func()
+            return True, flight.value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
 
 
 class CacheKey(object):
@@ -101,43 +680,98 @@ class CacheKey(object):
        key.root() --> 'mypackage.views:hello_view'
        str(key) --> 'mypackage.views:hello_view:user:bob'
 
+    Keys longer than ``max_length`` are compacted: the first base is kept
+    readable and the rest is replaced with a digest of the whole key::
+
+       key = CacheKey(['mypackage.views', 'hello_view'], ['user:bob'],
+                      max_length=20)
+       str(key) --> 'mypackage.views:#<SHA-1 of the whole key>'
+
     """
 
-    def __init__(self, bases, dependencies):
+    __slots__ = ('bases', 'dependencies', 'max_length', '_root', '_key',
+                 '_hash')
+
+    def __init__(self, bases, dependencies, root=None, max_length=None):
         self.bases = bases
         self.dependencies = dependencies
-
-    def _flatten(self, item):
-        if isinstance(item, dict):
-            return ':'.join(["%s=%s" % (k, v)
-                             for k, v in sorted(item.iteritems())])
-        elif isinstance(item, list):
-            return ':'.join([self._flatten(x) for x in item])
-        return item
+        self.max_length = max_length
+        self._root = root
+        self._key = None
+        self._hash = None
 
     def root(self):
         """The static part that refers to a single view or model class."""
-        return self._flatten(self.bases)
+        if self._root is None:
+            parts = []
+            _flatten(self.bases, parts)
+            self._root = ':'.join(parts)
+        return self._root
+
+    def root_key(self):
+        """The root, compacted like the key when it is too long."""
+        return self._compact(self.root())
 
     def key(self):
         """The unique cache key identifying a resource and its context."""
-        return self.root() + ':' + ':'.join(self.dependencies)
+        if self._key is None:
+            self._key = self._compact(
+                self.root() + ':' + ':'.join(self.dependencies))
+        return self._key
+
+    def _compact(self, key):
+        if not self.max_length or len(key) <= self.max_length:
+            return key
+        parts = []
+        _flatten(self.bases[:1], parts)
+        compacted = '%s:#%s' % (parts[0], hash_key(key))
+        return compacted if len(compacted) < len(key) else key
+
+    def hash(self):
+        """Cryptographic hash digest of the key, used as entity tag."""
+        if self._hash is None:
+            self._hash = hash_key(self.key())
+        return self._hash
 
     def __str__(self):
         return self.key()
 
 
-_CacheResultInfo = namedtuple("CacheResultInfo", ["key", "hit"])
+def _flatten(item, parts):
+    """Append the key segments of ``item`` (nested lists and dicts) to
+    ``parts``."""
+    if isinstance(item, dict):
+        if not item:
+            parts.append('')
+        parts.extend(['%s=%s' % k_v for k_v in sorted(item.iteritems())])
+    elif isinstance(item, list):
+        if not item:
+            parts.append('')
+        for x in item:
+            _flatten(x, parts)
+    else:
+        parts.append(item)
+
+
+def hash_key(key):
+    return hashlib.sha1(key).hexdigest()
+
+
+_CacheResultInfo = namedtuple("CacheResultInfo",
+                              ["key", "hit", "stale", "not_modified"])
 
 
 class CacheResult(object):
 
     """A versioned cache response based on a unique key."""
 
-    def __init__(self, cache_key, data, hit):
+    def __init__(self, cache_key, data, hit, stale_key=None,
+                 not_modified=False):
         self._cache_key = cache_key
         self.data = data
         self._hit = hit
+        self._stale_key = stale_key
+        self._not_modified = not_modified
 
     @classmethod
     def hit(cls, cache_key, data):
@@ -149,18 +783,32 @@ class CacheResult(object):
         """Specify that this data was loaded from the application."""
         return cls(cache_key, data, False)
 
+    @classmethod
+    def stale(cls, cache_key, data, stale_key):
+        """Specify that this data is an outdated version fetched from the
+        cache under ``stale_key``."""
+        return cls(cache_key, data, True, stale_key)
+
+    @classmethod
+    def not_modified(cls, cache_key):
+        """Specify that the client already has this version: there is no
+        data."""
+        return cls(cache_key, None, True, not_modified=True)
+
     def key_hash(self):
         """Unique hash to identify this result in the cache.
 
         A string corresponding to a cryptographic hash digest of the cache key
         that uniquely defines the version of this result.
         """
-        m = hashlib.sha1()
-        m.update(str(self._cache_key))
-        return m.hexdigest()
+        if self._stale_key is not None:
+            return hash_key(self._stale_key)
+        return self._cache_key.hash()
 
     def info(self):
-        return _CacheResultInfo(self._cache_key, self._hit)
+        return _CacheResultInfo(self._cache_key, self._hit,
+                                self._stale_key is not None,
+                                self._not_modified)
 
 
 class cache_factory(object):
@@ -181,67 +829,166 @@ class cache_factory(object):
            user = User(request.matchdict['user'])
            return "Hello, {}".format(user.name)
 
+    ``ttl``, ``max_size`` and ``jitter`` define the :class:`CachePolicy` of
+    the view. ``budget`` overrides the ``caching.budget`` setting.
     """
 
-    def __init__(self, varies_on=None, depends_on=None):
+    def __init__(self, varies_on=None, depends_on=None, max_stale=None,
+                 ttl=None, max_size=None, jitter=0, budget=None):
         self.varies_on = varies_on
         self.depends_on = depends_on
+        self.max_stale = max_stale
+        self.budget = budget
+        self.policy = None
+        if ttl is not None or max_size is not None or jitter:
+            self.policy = CachePolicy(ttl=ttl, max_size=max_size,
+                                      jitter=jitter)
 
     def __call__(self, view):
         return ViewCacheDecorator(view,
                                   varies_on=self.varies_on,
                                   depends_on=self.depends_on,
+                                  max_stale=self.max_stale,
+                                  policy=self.policy,
+                                  budget=self.budget,
                                   )
 
 
 class ViewCacheDecorator(object):
 
-    def __init__(self, view, varies_on=None, depends_on=None):
+    """Cache the responses of a view.
+
+    With ``max_stale`` (in seconds), the last good response of an outdated
+    view, for the same dependencies, is served with the header
+    ``X-View-Cache: STALE`` while the new version is rendered in a background
+    thread. The view is then called outside of the request processing: no
+    finished callbacks, and thread-local resources (such as a scoped session)
+    are not cleaned up by the request lifecycle.
+
+    A GET or HEAD request with an ``If-None-Match`` header matching the
+    current version gets a ``304 Not Modified`` response without calling the
+    view (``X-View-Cache: NOT_MODIFIED``). Headers set by the view are not
+    part of this response.
+
+    Cached responses stored compressed (setting
+    ``caching.compress.min_size``) are sent as is when the request accepts
+    their content encoding, and decompressed otherwise.
+
+    When the cache lookup exceeds its ``budget`` (in seconds, see
+    :class:`Manager`), the view is called without cache and the response has
+    the header ``X-View-Cache: BUDGET_EXCEEDED``.
+    """
+
+    def __init__(self, view, varies_on=None, depends_on=None, max_stale=None,
+                 policy=None, budget=None):
         self.view = view
         self.varies_on = varies_on or []
         self.depends_on = depends_on or []
+        self.max_stale = max_stale
+        self.policy = policy
+        self.budget = budget
+        # Static part of the cache keys of this view.
+        self.root = '%s:%s' % (view.__module__, view.__name__)
 
     def __call__(self, context, request):
-        def get_result():
-            return self.view(context, request)
-
-        def nocache_result():
-            response = get_result()
-            response.headers['X-View-Cache'] = 'DISABLED'
-            return response
-
         if not request.registry.settings.get('caching.enabled', False):
-            return nocache_result()
+            return self.nocache_result(context, request)
 
         cache_manager = request.cache_manager
 
-        prefixes = [self.view.__module__, self.view.__name__]
+        prefixes = [self.root]
         if context is not None and context.__name__ is not None:
-            prefixes.extend([context.__module__, context.__name__])
+            prefixes.append(context.__module__)
+            prefixes.append(context.__name__)
         prefixes.append(request.scheme)
         prefixes.extend(self.get_modifiers(request))
 
         dependencies = self.get_dependencies(context, request)
 
+        def get_result():
+            return self.view(context, request)
+
+        result_getter = get_result
+        kwargs = {}
+        if self.max_stale is not None:
+            def refresh_result():
+                threadlocal_manager.push({'request': request,
+                                          'registry': request.registry})
+                try:
+                    return get_result()
+                finally:
+                    threadlocal_manager.pop()
+
+            result_getter = refresh_result
+            kwargs['max_stale'] = self.max_stale
+        if self.policy is not None:
+            kwargs['policy'] = self.policy
+        if self.budget is not None:
+            kwargs['budget'] = self.budget
+        if request.method in ('GET', 'HEAD') and request.if_none_match:
+            kwargs['if_none_match'] = request.if_none_match
+
         try:
-            result = cache_manager.get_or_cache(get_result,
+            result = cache_manager.get_or_cache(result_getter,
                                                 prefixes,
-                                                dependencies)
+                                                dependencies,
+                                                **kwargs)
+        except CacheBudgetExceeded as e:
+            request.registry.notify(ViewCacheBudgetExceeded(e.cache_key,
+                                                            request))
+            response = self.view(context, request)
+            response.headers['X-View-Cache'] = 'BUDGET_EXCEEDED'
+            return response
         except CacheDisabled:
-            return nocache_result()
+            return self.nocache_result(context, request)
+        except CacheLeaseTimeout:
+            raise
         except BaseCacheError:
             log.warning('cache backend failed, calling application view', exc_info=True)
-            return nocache_result()
+            return self.nocache_result(context, request)
 
-        response = result.data
         result_info = result.info()
-        if result_info.hit:
+        if result_info.not_modified:
+            request.registry.notify(ViewCacheHit(result_info.key, request))
+            response = HTTPNotModified()
+            response.headers['X-View-Cache'] = 'NOT_MODIFIED'
+            response.headers['ETag'] = matching_etag(result.key_hash(),
+                                                     request.if_none_match)
+            self._vary_on_encoding(request, response, None)
+            return response
+
+        response = result.data
+        stored_encoding = response.content_encoding
+        if result_info.hit and stored_encoding and \
+                not accepts_encoding(request, stored_encoding):
+            response.decode_content()
+        if result_info.stale:
+            request.registry.notify(ViewCacheStale(result_info.key, request))
+            response.headers['X-View-Cache'] = 'STALE'
+        elif result_info.hit:
             request.registry.notify(ViewCacheHit(result_info.key, request))
             response.headers['X-View-Cache'] = 'HIT'
         else:
             request.registry.notify(ViewCacheMiss(result_info.key, request))
             response.headers['X-View-Cache'] = 'MISS'
-        response.headers['ETag'] = result.key_hash()
+        response.headers['ETag'] = encoded_etag(result.key_hash(),
+                                                response.content_encoding)
+        self._vary_on_encoding(request, response, stored_encoding)
+        return response
+
+    def _vary_on_encoding(self, request, response, stored_encoding):
+        """Add Accept-Encoding to the Vary header of responses that may be
+        sent encoded or not depending on the request."""
+        if not stored_encoding and \
+                not request.registry.settings.get('caching.compress.min_size'):
+            return
+        vary = response.vary or ()
+        if 'accept-encoding' not in [name.lower() for name in vary]:
+            response.vary = tuple(vary) + ('Accept-Encoding',)
+
+    def nocache_result(self, context, request):
+        response = self.view(context, request)
+        response.headers['X-View-Cache'] = 'DISABLED'
         return response
 
     def get_modifiers(self, request):
@@ -251,6 +998,35 @@ class ViewCacheDecorator(object):
         return [dep(context, request) for dep in self.depends_on]
 
 
+def accepts_encoding(request, encoding):
+    """Whether the Accept-Encoding header of ``request`` explicitly accepts
+    ``encoding``. Without a valid header, responses are sent decoded."""
+    accept_encoding = request.accept_encoding
+    if not isinstance(accept_encoding, AcceptEncodingValidHeader):
+        return False
+    return bool(accept_encoding.acceptable_offers([encoding]))
+
+
+def encoded_etag(etag, content_encoding):
+    """The entity tag of a representation sent with ``content_encoding``:
+    encoded and decoded bodies must not share a strong entity tag."""
+    if content_encoding:
+        return '%s-%s' % (etag, content_encoding)
+    return etag
+
+
+def matching_etag(etag, if_none_match):
+    """Return the entity tag of ``if_none_match`` (a container of entity
+    tags) matching ``etag`` or one of its encoded variants, or None."""
+    if etag in if_none_match:
+        return etag
+    prefix = etag + '-'
+    for tag in getattr(if_none_match, 'etags', if_none_match):
+        if tag.startswith(prefix):
+            return tag
+    return None
+
+
 class ModelDependency(object):
 
     """Simple dependency on a model, such as a collection."""
@@ -1,6 +1,12 @@
 from zope.interface import implementer
 
-from pyramid_caching.interfaces import ICacheHit, ICacheMiss
+from pyramid_caching.interfaces import (
+    ICacheBudgetExceeded,
+    ICacheHit,
+    ICacheMiss,
+    ICacheStale,
+    ICircuitBreakerStateChanged,
+    )
 
 
 @implementer(ICacheHit)
@@ -22,3 +28,37 @@ class ViewCacheMiss(object):
     def __init__(self, cache_key, request):
         self.cache_key = cache_key
         self.request = request
+
+
+@implementer(ICacheStale)
+class ViewCacheStale(object):
+    """An instance of this class is emitted as an event when the cache manager
+    served the last good response of an outdated view while a new version is
+    rendered in the background.
+    """
+    def __init__(self, cache_key, request):
+        self.cache_key = cache_key
+        self.request = request
+
+
+@implementer(ICacheBudgetExceeded)
+class ViewCacheBudgetExceeded(object):
+    """An instance of this class is emitted as an event when the cache lookup
+    took longer than its latency budget and the view was called without
+    cache.
+    """
+    def __init__(self, cache_key, request):
+        self.cache_key = cache_key
+        self.request = request
+
+
+@implementer(ICircuitBreakerStateChanged)
+class CircuitBreakerStateChanged(object):
+    """An instance of this class is emitted as an event when a circuit breaker
+    opens after repeated cache backend failures, lets trial calls through
+    (half-open) or closes again.
+    """
+    def __init__(self, breaker, state, previous_state):
+        self.breaker = breaker
+        self.state = state
+        self.previous_state = previous_state
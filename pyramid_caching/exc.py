@@ -7,6 +7,24 @@ class CacheDisabled(Base):
     """Cache is disabled """
 
 
+class CircuitOpen(CacheDisabled):
+    """Cache is bypassed after repeated backend failures"""
+
+
+class CacheBudgetExceeded(CacheDisabled):
+    """Cache lookup took longer than its latency budget.
+
+    ``cache_key`` is the key being looked up, ``elapsed`` and ``budget`` are
+    in seconds.
+    """
+
+    def __init__(self, cache_key, elapsed, budget):
+        super(CacheBudgetExceeded, self).__init__(cache_key, elapsed, budget)
+        self.cache_key = cache_key
+        self.elapsed = elapsed
+        self.budget = budget
+
+
 class CacheError(Base):
     """Base exception for cache client"""
 
@@ -23,6 +41,14 @@ class CacheGetError(CacheError):
     """Error on cache key retrieval"""
 
 
+class CacheLeaseError(CacheError):
+    """Error on cache lease operation"""
+
+
+class CacheLeaseTimeout(CacheError):
+    """Timeout waiting for another process to populate a cache entry"""
+
+
 class VersionError(Base):
     """Base exception for version client"""
 
@@ -35,6 +61,17 @@ class VersionIncrementError(VersionError):
     """Error on model version increment operation"""
 
 
+class VersionMultiIncrementError(VersionIncrementError):
+    """Error on some increments of a batch.
+
+    ``failures`` maps each key that could not be incremented to its error.
+    """
+
+    def __init__(self, failures):
+        super(VersionMultiIncrementError, self).__init__(failures)
+        self.failures = failures
+
+
 class VersionMasterVersionError(VersionError):
     """Error on master version operation"""
 
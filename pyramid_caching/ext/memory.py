@@ -0,0 +1,175 @@
+"""Keep the cache store and the version store in process memory.
+
+Meant for tests, development and single-process tools: entries are neither
+shared between processes nor persistent. Both stores are thread-safe and
+bounded.
+"""
+
+import os
+import threading
+import time
+
+from zope.interface import implementer
+
+from pyramid_caching.exc import CacheDisabled, CacheKeyAlreadyExists
+from pyramid_caching.interfaces import ICacheLeaseClient, IKeyVersioner
+from pyramid_caching.local import LRUCache
+
+
+def includeme(config):
+    """Use process memory as cache store and version store.
+
+    - caching.memory.max_size: size of the cache store, in bytes of keys and
+      values (default: 64MB)
+    - caching.memory.max_versions: number of versions kept (default: 100000)
+    """
+    settings = config.registry.settings
+    if not settings['caching.enabled']:
+        return
+    config.add_cache_client(MemoryCacheClient(
+        int(settings.get('caching.memory.max_size', 64 * 1024 * 1024))))
+    config.add_key_version_client(MemoryVersionStore(
+        int(settings.get('caching.memory.max_versions', 100000))))
+
+
+@implementer(ICacheLeaseClient)
+class MemoryCacheClient(object):
+
+    """Cache entries in a LRU mapping bounded by ``max_size`` bytes.
+
+    Entries expire after ``expiration`` seconds (default: 7 days, as
+    RedisCacheWrapper). Expired entries are dropped when read, or evicted as
+    the least recently used ones.
+    """
+
+    LEASE_KEY_PREFIX = 'lease:'
+
+    def __init__(self, max_size):
+        self.default_expiration = 3600 * 24 * 7  # 7 days
+        self.entries = LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            self.entries.discard(key)
+            return None
+        return entry[0]
+
+    def _put(self, key, value, expiration):
+        self.entries.put(key, (value, time.time() + expiration),
+                         len(key) + len(value))
+
+    def add(self, key, value, expiration=None):
+        """Create a cache entry. Raise CacheKeyAlreadyExists if this entry
+        already exists."""
+        if expiration is None:
+            expiration = self.default_expiration
+        with self._lock:
+            if self._get(key) is not None:
+                raise CacheKeyAlreadyExists(key)
+            self._put(key, value, expiration)
+
+    def get(self, key):
+        return self._get(key)
+
+    def set(self, key, value, expiration=None):
+        """Create or replace a cache entry."""
+        if expiration is None:
+            expiration = self.default_expiration
+        self._put(key, value, expiration)
+
+    def acquire_lease(self, key, ttl):
+        """Take the lease on key for ttl seconds. Return a random token if
+        acquired, None if the lease is held by someone else."""
+        token = os.urandom(16).encode('hex')
+        with self._lock:
+            if self._get(self.LEASE_KEY_PREFIX + key) is not None:
+                return None
+            self._put(self.LEASE_KEY_PREFIX + key, token, ttl)
+        return token
+
+    def release_lease(self, key, token):
+        """Delete the lease on key, unless it expired and was taken again."""
+        with self._lock:
+            if self._get(self.LEASE_KEY_PREFIX + key) == token:
+                self.entries.discard(self.LEASE_KEY_PREFIX + key)
+
+    def flush_all(self):
+        self.entries.clear()
+
+
+@implementer(IKeyVersioner)
+class MemoryVersionStore(object):
+
+    """Keep versions in a dictionary, with the semantics of
+    RedisVersionWrapper: missing versions are '0', an increment of a missing
+    version stores '1', and the master-version 'cache' is returned first.
+
+    The master-version is initialized from the current time, and always
+    changes when the store is flushed. When more than ``max_versions``
+    versions are stored, all of them are dropped with a new master-version:
+    dropping only some would bring their versions back to '0' and cached
+    entries built with them would be served again.
+
+    :meth:`disable` inhibits caching while maintaining the versions, as the
+    master-version 'off' does.
+    """
+
+    MASTER_VERSION_KEY = 'cache'
+    MASTER_VERSION_DISABLE_VALUE = 'off'
+
+    def __init__(self, max_versions=100000):
+        self.max_versions = max_versions
+        self.master_version = None
+        self._last_master_version = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _generate_master_version(self):
+        version = max(int(time.time()), self._last_master_version + 1)
+        self._last_master_version = version
+        return str(version)
+
+    def get_multi(self, keys):
+        """Return an ordered list of tuple (key, value). The value default to
+        '0'."""
+        with self._lock:
+            if self.master_version is None:
+                self.master_version = self._generate_master_version()
+            master_version = self.master_version
+            versions = [str(self._versions.get(key, 0)) for key in keys]
+        if master_version == self.MASTER_VERSION_DISABLE_VALUE:
+            raise CacheDisabled('Disabled by master_version')
+        return zip([self.MASTER_VERSION_KEY] + keys,
+                   [master_version] + versions)
+
+    def incr(self, key):
+        """Increment a version. If the key was missing, the new value is 1"""
+        self.incr_multi([key])
+
+    def incr_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+            if len(self._versions) > self.max_versions:
+                self._versions.clear()
+                if self.master_version != self.MASTER_VERSION_DISABLE_VALUE:
+                    self.master_version = None
+
+    def disable(self):
+        """Inhibit caching until :meth:`enable` is called."""
+        with self._lock:
+            self.master_version = self.MASTER_VERSION_DISABLE_VALUE
+
+    def enable(self):
+        """Enable caching with a new master-version."""
+        with self._lock:
+            self.master_version = self._generate_master_version()
+
+    def flush_all(self):
+        with self._lock:
+            self._versions.clear()
+            self.master_version = None
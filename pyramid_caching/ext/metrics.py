@@ -5,7 +5,12 @@ via pyramid_metrics.
 
 from pyramid.events import subscriber
 
-from pyramid_caching.events import ViewCacheHit, ViewCacheMiss
+from pyramid_caching.events import (
+    ViewCacheBudgetExceeded,
+    ViewCacheHit,
+    ViewCacheMiss,
+    ViewCacheStale,
+    )
 
 
 def includeme(config):
@@ -34,6 +39,16 @@ def cache_miss(event):
     count_view_cache_event(event, 'miss')
 
 
+@subscriber(ViewCacheStale)
+def cache_stale(event):
+    count_view_cache_event(event, 'stale')
+
+
+@subscriber(ViewCacheBudgetExceeded)
+def cache_budget_exceeded(event):
+    count_view_cache_event(event, 'budget_exceeded')
+
+
 def count_view_cache_event(event, access):
     metrics = event.request.metrics
     key = event.cache_key.root().replace(':', '_').replace('.', '_')
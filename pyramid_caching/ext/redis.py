@@ -1,45 +1,278 @@
 from __future__ import absolute_import
 
+import itertools
+import logging
 import os
+import threading
 import time
 
-from redis import StrictRedis, RedisError
-
+from pyramid.events import ApplicationCreated
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+from redis import (
+    BlockingConnectionPool,
+    ConnectionPool,
+    StrictRedis,
+    RedisError,
+    )
+from zope.interface import implementer
+
+from pyramid_caching.cache import CacheKey
 from pyramid_caching.exc import (
     CacheAddError,
     CacheGetError,
     CacheKeyAlreadyExists,
+    CacheLeaseError,
     VersionGetError,
     VersionIncrementError,
+    VersionMultiIncrementError,
     VersionMasterVersionError,
     CacheDisabled,
 )
+from pyramid_caching.interfaces import (
+    ICacheClient,
+    ICacheLeaseClient,
+    IKeyVersioner,
+    IVersionedCacheClient,
+    )
+from pyramid_caching.local import LRUCache
+from pyramid_caching.sharding import ShardedCacheClient
+
+log = logging.getLogger(__name__)
 
 
 def includeme(config):
-    if not config.registry.settings['caching.enabled']:
+    """Use Redis as cache store and version store.
+
+    With the setting ``caching.redis.single_round_trip = true``, cache hits
+    are resolved with a single server-side script. Both stores must then use
+    the same Redis database.
+
+    Version increments are published on the pub/sub channel named by the
+    ``caching.redis.version_channel`` setting. With
+    ``caching.redis.version_cache_max_age`` (seconds), versions are kept in
+    process memory, invalidated by messages of that channel and refetched
+    after at most max_age seconds in any case. They take at most
+    ``caching.redis.version_cache_max_size`` bytes (default: 1MB).
+
+    ``CACHE_STORE_REDIS_URI`` may list several URIs, separated by commas or
+    whitespace: cache entries are then sharded across those servers, see
+    :class:`pyramid_caching.sharding.ShardedCacheClient`. A failed server is
+    skipped for ``caching.redis.shard_retry_interval`` seconds (default: 30).
+
+    Versions are read from the replicas listed in
+    ``VERSION_STORE_REDIS_REPLICA_URIS``, if any, while they lag by at most
+    ``caching.redis.replica_max_lag`` seconds (default: 10), checked every
+    ``caching.redis.replica_check_interval`` seconds (default: 1). See
+    RedisVersionWrapper.
+
+    Connections are configured by the settings listed in redis_client. With
+    ``caching.redis.prewarm``, that many connections of each pool are opened
+    when the application is created, see prewarm.
+    """
+    settings = config.registry.settings
+    if not settings['caching.enabled']:
         return
-    include_cache_store(config)
-    include_version_store(config)
+    cache_store = include_cache_store(config)
+    version_store = include_version_store(config)
+    if asbool(settings.get('caching.redis.single_round_trip', False)):
+        include_versioned_cache_client(config, cache_store, version_store)
+    prewarm_count = int(settings.get('caching.redis.prewarm', 0))
+    if prewarm_count:
+        config.add_subscriber(
+            lambda event: prewarm(event.app.registry, prewarm_count),
+            ApplicationCreated)
+
+
+CONNECTION_SETTINGS = (
+    ('max_connections', int),
+    ('socket_timeout', float),
+    ('socket_connect_timeout', float),
+    ('socket_keepalive', asbool),
+    ('retry_on_timeout', asbool),
+    ('health_check_interval', int),
+    )
+
+# Options of TCP connections only.
+TCP_CONNECTION_SETTINGS = ('socket_connect_timeout', 'socket_keepalive')
+
+
+def redis_client(uri, settings, pubsub=False):
+    """Return a client for ``uri`` (``redis://``, ``rediss://`` or
+    ``unix://``) configured by the settings:
+
+    - caching.redis.max_connections: size of each connection pool
+    - caching.redis.pool_timeout: wait at most that many seconds for a free
+      connection when the pool is full, instead of failing immediately
+    - caching.redis.socket_timeout, caching.redis.socket_connect_timeout:
+      in seconds, no timeout by default
+    - caching.redis.socket_keepalive: enable TCP keepalive
+    - caching.redis.retry_on_timeout: retry a command once on timeout
+    - caching.redis.health_check_interval: check idle connections with a PING
+      after that many seconds
+
+    Clients used for ``pubsub`` have no socket timeout: they wait for
+    messages indefinitely.
+
+    Connection pools are reset in forked processes on first use: connections
+    are never shared between a parent process and its children.
+    """
+    kwargs = {}
+    for name, convert in CONNECTION_SETTINGS:
+        value = settings.get('caching.redis.' + name)
+        if value is not None:
+            kwargs[name] = convert(value)
+    if uri.startswith('unix://'):
+        for name in TCP_CONNECTION_SETTINGS:
+            kwargs.pop(name, None)
+    if pubsub:
+        kwargs.pop('socket_timeout', None)
+    pool_class = ConnectionPool
+    pool_timeout = settings.get('caching.redis.pool_timeout')
+    if pool_timeout is not None:
+        pool_class = BlockingConnectionPool
+        kwargs['timeout'] = float(pool_timeout)
+    return StrictRedis(connection_pool=pool_class.from_url(uri, **kwargs))
+
+
+def prewarm(registry, count):
+    """Open up to ``count`` connections in each Redis connection pool of the
+    cache store and the version store.
+
+    Called when the application is created if ``caching.redis.prewarm`` is
+    set. When the application is loaded before forking worker processes,
+    call it from each worker instead (for example in a gunicorn
+    ``post_fork`` hook): pools are reset in forked processes.
+    """
+    clients = []
+    for store in (registry.queryUtility(ICacheClient),
+                  registry.queryUtility(IKeyVersioner)):
+        clients.extend(_redis_clients(store))
+    for client in clients:
+        _prewarm_pool(client.connection_pool, count)
+
+
+def _redis_clients(store):
+    if isinstance(store, ShardedCacheClient):
+        return [client for shard in store.shards.itervalues()
+                for client in _redis_clients(shard)]
+    clients = []
+    if isinstance(getattr(store, 'client', None), StrictRedis):
+        clients.append(store.client)
+    if getattr(store, 'replicas', None) is not None:
+        clients.extend(store.replicas.clients)
+    return clients
+
+
+def _prewarm_pool(pool, count):
+    connections = []
+    try:
+        for _ in range(min(count, pool.max_connections)):
+            connection = pool.get_connection('PING')
+            connections.append(connection)
+            connection.connect()
+    except RedisError:
+        log.warning('Failed to prewarm Redis connections', exc_info=True)
+    finally:
+        for connection in connections:
+            pool.release(connection)
 
 
 def include_cache_store(config):
-    uri = os.environ['CACHE_STORE_REDIS_URI']
-    client = StrictRedis.from_url(uri)
-    config.add_cache_client(RedisCacheWrapper(client))
+    settings = config.registry.settings
+    uris = os.environ['CACHE_STORE_REDIS_URI'].replace(',', ' ').split()
+    if len(uris) == 1:
+        cache_store = RedisCacheWrapper(redis_client(uris[0], settings))
+    else:
+        shards = {}
+        for uri in uris:
+            client = redis_client(uri, settings)
+            shards[_database_address(client)] = RedisCacheWrapper(client)
+        if len(shards) != len(uris):
+            raise ConfigurationError(
+                'CACHE_STORE_REDIS_URI lists the same database twice')
+        retry_interval = float(
+            settings.get('caching.redis.shard_retry_interval', 30))
+        cache_store = ShardedCacheClient(shards,
+                                         retry_interval=retry_interval)
+    config.add_cache_client(cache_store)
+    return cache_store
 
 
 def include_version_store(config):
+    settings = config.registry.settings
     uri = os.environ['VERSION_STORE_REDIS_URI']
-    client = StrictRedis.from_url(uri)
-    config.add_key_version_client(RedisVersionWrapper(client))
+    client = redis_client(uri, settings)
+    channel = settings.get('caching.redis.version_channel')
+    max_age = float(settings.get('caching.redis.version_cache_max_age', 0))
+    near_cache = None
+    if max_age:
+        near_cache = VersionNearCache(
+            redis_client(uri, settings, pubsub=True), max_age,
+            channel=channel,
+            max_size=int(settings.get('caching.redis.version_cache_max_size',
+                                      1024 * 1024)))
+    replicas = None
+    replica_uris = os.environ.get('VERSION_STORE_REDIS_REPLICA_URIS', '')
+    if replica_uris.strip():
+        replicas = VersionReplicas(
+            [redis_client(replica_uri, settings)
+             for replica_uri in replica_uris.replace(',', ' ').split()],
+            max_lag=float(settings.get('caching.redis.replica_max_lag', 10)),
+            check_interval=float(
+                settings.get('caching.redis.replica_check_interval', 1)))
+    version_store = RedisVersionWrapper(client, channel=channel,
+                                        near_cache=near_cache,
+                                        replicas=replicas)
+    config.add_key_version_client(version_store)
+    return version_store
+
+
+def include_versioned_cache_client(config, cache_store, version_store):
+    if isinstance(cache_store, ShardedCacheClient):
+        raise ConfigurationError(
+            'caching.redis.single_round_trip does not support a sharded '
+            'cache store')
+    cache_db = _database_address(cache_store.client)
+    version_db = _database_address(version_store.client)
+    if cache_db != version_db:
+        raise ConfigurationError(
+            'caching.redis.single_round_trip requires the cache store and the '
+            'version store to share the same Redis database (%s != %s)' %
+            (cache_db, version_db))
+    config.add_versioned_cache_client(
+        RedisVersionedCacheWrapper(version_store, cache_store))
+
+
+def _database_address(client):
+    db = client.connection_pool.connection_kwargs.get('db', 0)
+    return '%s/%s' % (_server_address(client), db)
+
+
+def _server_address(client):
+    kwargs = client.connection_pool.connection_kwargs
+    if 'path' in kwargs:
+        return kwargs['path']
+    return '%s:%s' % (kwargs.get('host', 'localhost'),
+                      kwargs.get('port', 6379))
+
+
+@implementer(ICacheLeaseClient)
+class RedisCacheWrapper(object):
 
+    LEASE_KEY_PREFIX = 'lease:'
 
-class RedisCacheWrapper(object):
+    RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
     def __init__(self, client):
         self.default_expiration = 3600 * 24 * 7  # 7 days
         self.client = client
+        self._release_lease_script = None
 
     def add(self, key, value, expiration=None):
         """Create a cache entry. Raise CacheKeyAlreadyExists is this entry
@@ -64,6 +297,38 @@ class RedisCacheWrapper(object):
         except RedisError as error:
             raise CacheGetError(error)
 
+    def set(self, key, value, expiration=None):
+        """Create or replace a cache entry. (Default expiration: 7 days)"""
+        if expiration is None:
+            expiration = self.default_expiration
+
+        try:
+            self.client.set(key, value, ex=expiration)
+        except RedisError as error:
+            raise CacheAddError(error)
+
+    def acquire_lease(self, key, ttl):
+        """Take the lease on key for ttl seconds. Return a random token if
+        acquired, None if the lease is held by someone else."""
+        token = os.urandom(16).encode('hex')
+        try:
+            acquired = self.client.set(self.LEASE_KEY_PREFIX + key, token,
+                                       px=int(ttl * 1000), nx=True)
+        except RedisError as error:
+            raise CacheLeaseError(error)
+        return token if acquired else None
+
+    def release_lease(self, key, token):
+        """Delete the lease on key, unless it expired and was taken again."""
+        if self._release_lease_script is None:
+            self._release_lease_script = self.client.register_script(
+                self.RELEASE_LEASE_SCRIPT)
+        try:
+            self._release_lease_script(keys=[self.LEASE_KEY_PREFIX + key],
+                                       args=[token])
+        except RedisError as error:
+            raise CacheLeaseError(error)
+
     def flush_all(self):
         self.client.flushall()
 
@@ -102,13 +367,35 @@ class RedisVersionWrapper(object):
 
     Note: the special master-version 'off' will inhibit caching while still
     maintaining the model versions.
+
+    Notes about the near cache:
+
+    When ``channel`` is given, each increment publishes the key on this
+    pub/sub channel. A ``near_cache`` (see VersionNearCache) keeps versions in
+    process memory and drops them when notified on the channel. Increments
+    also drop their keys from the near cache of the current process, which
+    then reads its own writes without waiting for the notification.
+
+    Notes about replicas:
+
+    With ``replicas`` (see VersionReplicas), versions are read from a replica
+    lagging by at most ``replicas.max_lag`` seconds. Increments and the
+    master-version initialization stay on ``client``, the primary. Reads
+    from the primary are pinned to the current thread for ``max_lag`` seconds
+    after an increment, so a request reads its own writes. They are also
+    preferred for ``max_lag`` seconds after the near cache was invalidated,
+    which a lagging replica would otherwise fill with outdated versions.
     """
 
     MASTER_VERSION_KEY = 'cache'
     MASTER_VERSION_DISABLE_VALUE = 'off'
 
-    def __init__(self, client):
+    def __init__(self, client, channel=None, near_cache=None, replicas=None):
         self.client = client
+        self.channel = channel
+        self.near_cache = near_cache
+        self.replicas = replicas
+        self._local = threading.local()
 
     def _get_master_version(self):
         """Return the master-version or None if the key is missing"""
@@ -145,10 +432,16 @@ class RedisVersionWrapper(object):
         """
         keys_with_master = [self.MASTER_VERSION_KEY] + keys
 
-        try:
-            versions = self.client.mget(keys_with_master)
-        except RedisError as error:
-            raise VersionGetError(error)
+        if self.near_cache is None:
+            versions = self._mget(keys_with_master)
+        else:
+            versions = self.near_cache.get_multi(keys_with_master)
+            if versions is None:
+                generation = self.near_cache.generation
+                versions = self._mget(keys_with_master)
+                if versions[0] is not None:
+                    self.near_cache.update(keys_with_master, versions,
+                                           generation)
 
         self._handle_master_version(versions)
 
@@ -156,12 +449,341 @@ class RedisVersionWrapper(object):
 
         return zip(keys_with_master, versions)
 
+    def _mget(self, keys):
+        replica = self._read_replica()
+        if replica is not None:
+            try:
+                versions = replica.mget(keys)
+            except RedisError:
+                log.warning('Version replica failed, reading from primary',
+                            exc_info=True)
+                self.replicas.mark_failed(replica)
+            else:
+                # The primary initializes a missing master-version.
+                if versions[0] is not None:
+                    return versions
+        try:
+            return self.client.mget(keys)
+        except RedisError as error:
+            raise VersionGetError(error)
+
+    def _read_replica(self):
+        """The replica to read versions from, or None to use the primary."""
+        if self.replicas is None:
+            return None
+        now = time.time()
+        if getattr(self._local, 'pinned_until', 0) > now:
+            return None
+        if self.near_cache is not None and \
+                now - self.near_cache.invalidated_at < self.replicas.max_lag:
+            return None
+        return self.replicas.choose()
+
+    def _pin_primary(self):
+        if self.replicas is not None:
+            self._local.pinned_until = time.time() + self.replicas.max_lag
+
+    def incr_multi(self, keys):
+        """Increment versions in a single pipeline.
+
+        Raise VersionMultiIncrementError with the keys that failed, if any.
+        """
+        self._pin_primary()
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.incr(key)
+        if self.channel is not None:
+            for key in keys:
+                pipeline.publish(self.channel, key)
+        try:
+            results = pipeline.execute(raise_on_error=False)
+        except RedisError as error:
+            raise VersionIncrementError(error)
+        finally:
+            self._invalidate_near_cache(keys)
+        failures = dict((key, result)
+                        for key, result in zip(keys, results)
+                        if isinstance(result, Exception))
+        if failures:
+            raise VersionMultiIncrementError(failures)
+
     def incr(self, key):
         """Increment a version. If the key was missing, the new value is 1"""
+        self._pin_primary()
         try:
-            self.client.incr(key)
+            if self.channel is None:
+                self.client.incr(key)
+            else:
+                pipeline = self.client.pipeline(transaction=False)
+                pipeline.incr(key)
+                pipeline.publish(self.channel, key)
+                pipeline.execute()
         except RedisError as error:
             raise VersionIncrementError(error)
+        finally:
+            self._invalidate_near_cache([key])
+
+    def _invalidate_near_cache(self, keys):
+        if self.near_cache is not None:
+            for key in keys:
+                self.near_cache.invalidate(key)
 
     def flush_all(self):
         self.client.flushall()
+        if self.near_cache is not None:
+            self.near_cache.clear()
+
+
+class VersionReplicas(object):
+    """Choose a replica of the version store to read from.
+
+    A replica is healthy when its link with the primary is up and its last
+    interaction with it happened at most ``max_lag`` seconds ago (Redis
+    reports it with a one second resolution). The health of each replica is
+    checked at most every ``check_interval`` seconds; replicas are used in
+    turn.
+    """
+
+    def __init__(self, clients, max_lag=10, check_interval=1):
+        self.clients = list(clients)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._checks = {}
+        self._turn = itertools.count()
+
+    def choose(self):
+        """Return a healthy replica, or None."""
+        count = len(self.clients)
+        start = next(self._turn)
+        for i in range(count):
+            client = self.clients[(start + i) % count]
+            if self.is_healthy(client):
+                return client
+        return None
+
+    def is_healthy(self, client):
+        now = time.time()
+        check = self._checks.get(client)
+        if check is not None and now - check[0] < self.check_interval:
+            return check[1]
+        healthy = self._check(client)
+        self._checks[client] = (now, healthy)
+        return healthy
+
+    def _check(self, client):
+        try:
+            info = client.info('replication')
+        except RedisError:
+            log.warning('Version replica health check failed', exc_info=True)
+            return False
+        last_io = info.get('master_last_io_seconds_ago')
+        return (info.get('role') == 'slave' and
+                info.get('master_link_status') == 'up' and
+                last_io is not None and 0 <= last_io <= self.max_lag)
+
+    def mark_failed(self, client):
+        """Stop using ``client`` until its next health check."""
+        self._checks[client] = (time.time(), False)
+
+
+class VersionNearCache(object):
+    """Keep versions in process memory.
+
+    Versions are dropped when their key is published on ``channel`` by
+    RedisVersionWrapper.incr(). A daemon thread, started on first use in each
+    process, listens to the channel. All versions are dropped whenever this
+    subscription is (re)established, since messages may have been missed.
+
+    Whatever the state of the subscription, versions are refetched after
+    ``max_age`` seconds: this bounds the staleness when messages are lost and
+    covers changes that are not published, such as a manual update of the
+    master-version. Without channel, this is the only invalidation.
+
+    Versions are kept in a LRU bounded by ``max_size`` bytes of keys and
+    versions.
+    """
+
+    RETRY_INTERVAL = 1
+
+    def __init__(self, client, max_age, channel=None, max_size=1024 * 1024):
+        self.client = client
+        self.max_age = max_age
+        self.channel = channel
+        self.generation = 0
+        self.invalidated_at = 0
+        self.connected = False
+        self._versions = LRUCache(max_size)
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def get_multi(self, keys):
+        """Return the list of versions of keys, or None if any of them is
+        missing or expired."""
+        self._ensure_listener()
+        now = time.time()
+        versions = []
+        for key in keys:
+            entry = self._versions.get(key)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                self._versions.discard(key)
+                return None
+            versions.append(entry[0])
+        return versions
+
+    def update(self, keys, versions, generation):
+        """Store versions fetched when the cache was at ``generation``.
+
+        They are discarded if an invalidation happened in the meantime.
+        """
+        expires = time.time() + self.max_age
+        with self._lock:
+            if generation != self.generation:
+                return
+            for key, version in zip(keys, versions):
+                self._versions.put(key, (version, expires),
+                                   len(key) + len(version or ''))
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self.invalidated_at = time.time()
+            self._versions.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidated_at = time.time()
+            self._versions.clear()
+
+    def _ensure_listener(self):
+        if self.channel is None or self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            self._versions.clear()
+        thread = threading.Thread(target=self._listen,
+                                  name='pyramid_caching-versions')
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self):
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._handle_message(message)
+            except RedisError:
+                log.warning('Version invalidation channel lost',
+                            exc_info=True)
+            finally:
+                self.connected = False
+                self.clear()
+                pubsub.close()
+            time.sleep(self.RETRY_INTERVAL)
+
+    def _handle_message(self, message):
+        if message['type'] == 'subscribe':
+            self.clear()
+            self.connected = True
+        elif message['type'] == 'message':
+            self.invalidate(message['data'])
+
+
+@implementer(IVersionedCacheClient)
+class RedisVersionedCacheWrapper(object):
+    """Redis implementation of the IVersionedCacheClient interface.
+
+    Both stores must use the same Redis database. A Lua script reads the
+    master-version and the dependency versions, and reads the cache entry
+    when the versions are the ones last seen for the same root and keys: the
+    candidate cache key is built client-side from these versions and passed
+    with the other keys, as Redis requires for replication and Cluster
+    (where all the keys must still belong to the same slot). A cache hit
+    then costs a single round trip instead of a MGET followed by a GET.
+    When versions changed, the script returns them and the entry is read
+    with a GET.
+
+    The last seen versions are kept in a LRU bounded by ``max_size`` bytes.
+
+    When the master-version is missing or disabled, the version store is
+    queried the usual way: it initializes the master-version or raises
+    CacheDisabled.
+    """
+
+    SCRIPT = """
+local count = tonumber(ARGV[2])
+local versions = redis.call('MGET', unpack(KEYS, 1, count))
+if not versions[1] or versions[1] == ARGV[1] then
+    return false
+end
+local matched = #KEYS > count
+for i = 1, count do
+    versions[i] = versions[i] or '0'
+    if versions[i] ~= ARGV[i + 2] then
+        matched = false
+    end
+end
+if matched then
+    return {1, versions, redis.call('GET', KEYS[count + 1])}
+end
+return {0, versions}
+"""
+
+    def __init__(self, version_store, cache_store, max_size=1024 * 1024):
+        self.version_store = version_store
+        self.cache_store = cache_store
+        self.last_versions = LRUCache(max_size)
+        self._script = version_store.client.register_script(self.SCRIPT)
+
+    def _run_script(self, keys_with_master, expected, cache_key):
+        keys = list(keys_with_master)
+        args = [self.version_store.MASTER_VERSION_DISABLE_VALUE,
+                len(keys_with_master)]
+        if expected is not None:
+            keys.append(cache_key)
+            args.extend(expected)
+        try:
+            return self._script(keys=keys, args=args)
+        except RedisError as error:
+            raise VersionGetError(error)
+
+    def get_versioned(self, root, keys):
+        """Return a tuple (versions, data) where versions is an ordered list
+        of tuple (key, value), as returned by RedisVersionWrapper.get_multi.
+        """
+        keys_with_master = [self.version_store.MASTER_VERSION_KEY] + keys
+        lookup_key = '\0'.join([root] + keys_with_master)
+        expected = self.last_versions.get(lookup_key)
+        cache_key = None
+        if expected is not None:
+            cache_key = _versioned_key(root, keys_with_master, expected)
+
+        reply = self._run_script(keys_with_master, expected, cache_key)
+        if reply is None:
+            self.version_store.get_multi(keys)
+            reply = self._run_script(keys_with_master, expected, cache_key)
+            if reply is None:
+                raise VersionMasterVersionError(
+                    "Still no master version after reset attempt")
+
+        matched, versions = reply[0], reply[1]
+        if matched:
+            data = reply[2]
+        else:
+            self.last_versions.put(lookup_key, versions,
+                                   len(lookup_key) + sum(map(len, versions)))
+            data = self.cache_store.get(
+                _versioned_key(root, keys_with_master, versions))
+        return zip(keys_with_master, versions), data
+
+
+def _versioned_key(root, keys, versions):
+    """The cache key of root for these versions, as built by the cache
+    manager with Versioner.format_keys."""
+    return str(CacheKey([root], ['%s:v=%s' % (key, version)
+                                 for key, version in zip(keys, versions)]))
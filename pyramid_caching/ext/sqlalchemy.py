@@ -4,14 +4,21 @@ from __future__ import absolute_import
 
 import functools
 import logging
+from operator import attrgetter
 import weakref
 
 from zope.interface import implementer
 
-from pyramid_caching.exc import VersionIncrementError
+from pyramid_caching.exc import (
+    VersionIncrementError,
+    VersionMultiIncrementError,
+    )
 from pyramid_caching.interfaces import IIdentityInspector
+from pyramid_caching.versioner import ScopedIdentity
 
-from sqlalchemy import event
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE
+from sqlalchemy.sql.expression import UpdateBase
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +29,22 @@ def register_sqlalchemy_caching(config, session_factory, base_cls,
 
     If the `caching.enabled` configuration setting is set to `true`, no hooks
     will be registered.
+
+    Besides the ORM unit of work, INSERT, UPDATE and DELETE statements
+    executed through the sessions (``Query.update()``, ``Query.delete()``,
+    Core statements passed to ``Session.execute()``...) invalidate the whole
+    table: its class key and its generation key, on which the keys of all
+    its rows and collections depend. The table is identified through the
+    classes derived from `base_cls` that are mapped to it, statements on
+    other tables and textual SQL statements are not inspected.
+
+    Modified instances are only invalidated when an attribute that cached
+    views depend on has changed, see DefaultIdentityInspector.is_modified.
+
+    A custom `identity_inspector` only needs `identify_instance`,
+    `identify_collection` and `identify_class`: without `identify_modified`,
+    `identify_table` or `is_modified`, flushed instances and modified tables
+    are identified with them.
     """
     if not config.registry.settings['caching.enabled']:
         return
@@ -46,7 +69,8 @@ def register_sqlalchemy_caching(config, session_factory, base_cls,
 
     config.action((__name__, 'session_caching_hook'),
                   _register_sqla_session_caching_hook,
-                  args=(config, session_factory),
+                  args=(config, session_factory, base_cls,
+                        identity_inspector),
                   order=3)
 
 
@@ -65,51 +89,206 @@ class Collection(object):
         self.instance = weakref.ref(instance)
 
 
-def _register_sqla_session_caching_hook(config, session_factory):
-    def identify(entity):
-        registry = config.registry
-        y = registry.queryAdapter(entity, IIdentityInspector)
-        if y is None:
-            raise TypeError("Could not adapt %r" % entity)
-        return y
-
-    def on_before_commit(session):
-        versioner = config.get_versioner()
-        cache_keys = _get_modified_entity_keys(session, identify)
-        after_commit = functools.partial(
-            _increment_versions_after_commit, versioner, cache_keys)
-        event.listen(session, 'after_commit', after_commit)
+SESSION_INFO_KEY = 'pyramid_caching.identities'
 
-    event.listen(session_factory, 'before_commit', on_before_commit)
 
+def _register_sqla_session_caching_hook(config, session_factory, base_cls,
+                                        identity_inspector):
+    """Increment the versions of the entities modified by a transaction.
 
-def _get_modified_entity_keys(session, identify_func):
-        identities = set()
-        for entity in session.new:
-            identities.add(identify_func(Collection(entity)))
-        for entity in session.dirty:
-            identities.add(identify_func(Collection(entity)))
-            identities.add(identify_func(entity))
-        for entity in session.deleted:
-            identities.add(identify_func(Collection(entity)))
-            identities.add(identify_func(entity))
-        return identities
+    Identities are collected after each flush and attached to the innermost
+    transaction that can be rolled back on its own: the root transaction or a
+    savepoint. When a savepoint is released, its identities are merged into
+    the enclosing transaction; they are dropped on rollback. Versions are
+    incremented in one batch after the root transaction commits.
 
+    Statements executed outside of flushes add the keys of the modified table
+    to the same pending set.
 
-def _increment_versions_after_commit(versioner, cache_keys, *args):
-    for key in cache_keys:
-        if not key:
+    Modified instances are identified in bulk by the identity inspector,
+    without going through the adapter registry.
+    """
+    sessions = weakref.WeakKeyDictionary()
+
+    identify_modified = getattr(identity_inspector, 'identify_modified', None)
+    if identify_modified is None:
+        identify_modified = functools.partial(_identify_modified,
+                                              identity_inspector)
+    identify_table = getattr(identity_inspector, 'identify_table', None)
+    if identify_table is None:
+        identify_table = functools.partial(_identify_table,
+                                           identity_inspector)
+
+    def on_after_flush(session, flush_context):
+        identities = identify_modified(
+            session.new, session.dirty, session.deleted)
+        if identities:
+            _pending_identities(session, session.transaction).update(
+                identities)
+
+    def on_after_commit(session):
+        transaction = session.transaction
+        identities = session.info.get(SESSION_INFO_KEY, {}).pop(transaction,
+                                                                None)
+        if not identities:
+            return
+        if transaction.nested:
+            _pending_identities(session, transaction.parent).update(
+                identities)
+        else:
+            _increment_versions_after_commit(config.get_versioner(),
+                                             identities)
+
+    def on_after_transaction_end(session, transaction):
+        # Identities of a committed transaction were popped on commit.
+        session.info.get(SESSION_INFO_KEY, {}).pop(transaction, None)
+
+    def on_after_begin(session, transaction, connection):
+        sessions[connection] = session
+        if not event.contains(connection, 'after_execute', on_after_execute):
+            event.listen(connection, 'after_execute', on_after_execute)
+
+    def on_after_execute(connection, clauseelement, multiparams, params,
+                         result):
+        session = sessions.get(connection)
+        # Statements of a flush are identified by on_after_flush.
+        if session is None or session._flushing:
+            return
+        if not isinstance(clauseelement, UpdateBase):
+            return
+        entities = _mapped_classes(base_cls, clauseelement.table)
+        if not entities:
+            return
+        pending = _pending_identities(session, session.transaction)
+        for entity in entities:
+            pending.update(identify_table(entity))
+
+    event.listen(session_factory, 'after_flush', on_after_flush)
+    event.listen(session_factory, 'after_commit', on_after_commit)
+    event.listen(session_factory, 'after_transaction_end',
+                 on_after_transaction_end)
+    event.listen(session_factory, 'after_begin', on_after_begin)
+
+
+def _pending_identities(session, transaction):
+    """The set of identities pending on the root transaction or savepoint
+    enclosing ``transaction``."""
+    while not transaction.nested and transaction.parent is not None:
+        transaction = transaction.parent
+    pending = session.info.setdefault(SESSION_INFO_KEY, {})
+    return pending.setdefault(transaction, set())
+
+
+def _identify_modified(identity_inspector, new=(), dirty=(), deleted=()):
+    """identify_modified for inspectors that do not provide it.
+
+    Dirty instances are all invalidated unless the inspector has an
+    is_modified method.
+    """
+    is_modified = getattr(identity_inspector, 'is_modified', None)
+    identify_collection = identity_inspector.identify_collection
+    identify_instance = identity_inspector.identify_instance
+    identities = set()
+    for instance in new:
+        identities.add(identify_collection(Collection(instance)))
+    for instance in dirty:
+        if is_modified is not None and not is_modified(instance):
             continue
-        try:
-            versioner.incr(key)
-        except VersionIncrementError:
-            log.exception("Entity version increment failed key=%s", key)
+        identities.add(identify_collection(Collection(instance)))
+        identities.add(identify_instance(instance))
+    for instance in deleted:
+        identities.add(identify_collection(Collection(instance)))
+        identities.add(identify_instance(instance))
+    identities.discard('')
+    return identities
+
+
+def _identify_table(identity_inspector, entity):
+    """identify_table for inspectors that do not provide it: the class
+    identity and its scopes."""
+    identity = identity_inspector.identify_class(entity)
+    return [identity] + list(getattr(identity, 'scopes', ()))
+
+
+def _mapped_classes(base_cls, table):
+    """The classes derived from base_cls that are mapped to table."""
+    classes = []
+    pending = [base_cls]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        if getattr(cls, '__table__', None) is table:
+            classes.append(cls)
+    return classes
+
+
+def _increment_versions_after_commit(versioner, cache_keys):
+    keys = [key for key in cache_keys if key]
+    try:
+        versioner.incr_multi(keys)
+    except VersionMultiIncrementError as error:
+        for key, failure in error.failures.iteritems():
+            log.error("Entity version increment failed key=%s: %s",
+                      key, failure)
+    except VersionIncrementError:
+        log.exception("Entity version increment failed keys=%s", keys)
+
+
+def _escape_format(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+class _IdentityTemplate(object):
+
+    """Format the identities of the instances of a mapped class.
+
+    Built once per class and kind of identity: the sorted column names and
+    the key template are reused for every instance.
+    """
+
+    def __init__(self, table_name, column_names, scopes):
+        self.table_name = table_name
+        self.column_names = tuple(sorted(column_names))
+        self.scopes = tuple(scopes)
+        self.template = ':'.join(
+            [_escape_format(table_name)] +
+            [_escape_format(name) + '={}' for name in self.column_names])
+        if len(self.column_names) == 1:
+            getter = attrgetter(self.column_names[0])
+            self.values = lambda instance: (getter(instance),)
+        elif self.column_names:
+            self.values = attrgetter(*self.column_names)
+        else:
+            self.values = lambda instance: ()
+
+    def identify(self, instance):
+        values = self.values(instance)
+        if any(value is None for value in values):
+            return self._identify_partial(values)
+        return ScopedIdentity(self.template.format(*values), self.scopes)
+
+    def _identify_partial(self, values):
+        ids = [self.table_name]
+        for col_name, value in zip(self.column_names, values):
+            if value is not None:
+                ids.append('{}={}'.format(col_name, value))
+            else:
+                log.warning('Caching key %s:%s is None',
+                            self.table_name, col_name)
+        return ScopedIdentity(':'.join(ids), self.scopes)
 
 
 @implementer(IIdentityInspector)
 class DefaultIdentityInspector(object):
 
-    """Generate a cache key from SQLAlchemy ORM classes."""
+    """Generate a cache key from SQLAlchemy ORM classes.
+
+    The table name and key columns of a class are looked up once, the first
+    time one of its instances is identified.
+    """
+
+    def __init__(self):
+        self._templates = {}
 
     def table_name(self, entity):
         """The name of the base table of an ORM entity."""
@@ -125,20 +304,95 @@ class DefaultIdentityInspector(object):
         table = instance.__table__
         return [fk.parent.name for fk in table.foreign_keys]
 
-    def _entity_cache_key(self, instance, column_names):
-        ids = []
-        for col_name in sorted(column_names):
-            value = getattr(instance, col_name)
-            if value is not None:
-                ids.append('{}={}'.format(col_name, value))
-            else:
-                log.warning('Caching key %s:%s is None',
-                            self.table_name(instance), col_name)
-        return ':'.join([self.table_name(instance)] + ids)
+    def generation_key(self, table_name):
+        """The key invalidating all the rows and collections of a table."""
+        return table_name + ':*'
+
+    def _template(self, instance, collection):
+        key = (type(instance), collection)
+        try:
+            return self._templates[key]
+        except KeyError:
+            pass
+        if collection:
+            column_names = self.foreign_key_column_names(instance)
+        else:
+            column_names = self.primary_key_column_names(instance)
+        if column_names is None:
+            template = None
+        else:
+            table_name = self.table_name(instance)
+            template = _IdentityTemplate(table_name, column_names,
+                                         [self.generation_key(table_name)])
+        return self._templates.setdefault(key, template)
+
+    def _entity_cache_key(self, instance, collection=False):
+        template = self._template(instance, collection)
+        if template is None:
+            return ''
+        return template.identify(instance)
+
+    def is_modified(self, instance):
+        """Whether an attribute rendered by cached views has changed.
+
+        By default, any column or relationship attribute is relevant. A model
+        may list the relevant attributes in ``__cache_columns__``, or the
+        irrelevant ones in ``__cache_ignore__``::
+
+            class User(Base):
+                __cache_ignore__ = ('last_seen',)
+        """
+        columns = getattr(instance, '__cache_columns__', None)
+        ignored = getattr(instance, '__cache_ignore__', ())
+        state = inspect(instance)
+        # Only attributes set since the instance was loaded can have changes.
+        for key in list(state.committed_state):
+            if columns is not None and key not in columns:
+                continue
+            if key in ignored:
+                continue
+            if state.get_history(key, PASSIVE_NO_INITIALIZE).has_changes():
+                return True
+        return False
+
+    def identify_modified(self, new=(), dirty=(), deleted=()):
+        """Get the cache keys to increment for the instances of a flush.
+
+        New instances invalidate their collection, dirty ones their
+        collection and themselves if they were modified (see is_modified),
+        deleted ones their collection and themselves.
+        """
+        identities = set()
+        for instance in new:
+            identities.add(self._entity_cache_key(instance,
+                                                   collection=True))
+        for instance in dirty:
+            if not self.is_modified(instance):
+                continue
+            identities.add(self._entity_cache_key(instance,
+                                                   collection=True))
+            identities.add(self._entity_cache_key(instance))
+        for instance in deleted:
+            identities.add(self._entity_cache_key(instance,
+                                                   collection=True))
+            identities.add(self._entity_cache_key(instance))
+        identities.discard('')
+        return identities
 
     def identify_class(self, cls):
-        """Get the cache key for the model class."""
-        return self.table_name(cls)
+        """Get the cache key for the model class.
+
+        Views depending on the class also depend on the generation key of
+        its table.
+        """
+        table_name = self.table_name(cls)
+        return ScopedIdentity(table_name, [self.generation_key(table_name)])
+
+    def identify_table(self, entity):
+        """Get the keys to increment when unknown rows of the table of an
+        ORM entity were modified."""
+        table_name = self.table_name(entity)
+        return [table_name, self.generation_key(table_name)]
 
     def identify_collection(self, collection):
         """Get the cache key for the collection containing a model instance.
@@ -151,10 +405,7 @@ class DefaultIdentityInspector(object):
         if instance is None:
             # Referent has been garbage collected.
             return ''
-        column_names = self.foreign_key_column_names(instance)
-        if column_names is None:
-            return ''
-        return self._entity_cache_key(instance, column_names)
+        return self._entity_cache_key(instance, collection=True)
 
     def identify_instance(self, instance):
         """Get the cache key for a model instance.
@@ -163,7 +414,4 @@ class DefaultIdentityInspector(object):
         `id`, an object `<UserMessage user_id=123, id=456>` will have the cache
         key: `'user_message:id=456:user_id=123'`.
         """
-        column_names = self.primary_key_column_names(instance)
-        if column_names is None:
-            return ''
-        return self._entity_cache_key(instance, column_names)
+        return self._entity_cache_key(instance)
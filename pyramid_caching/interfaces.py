@@ -26,6 +26,12 @@ class IKeyVersioner(Interface):
         specific.
         """
 
+    def incr_multi(keys):
+        """Increment the versions of a list of keys at once.
+
+        Raise VersionMultiIncrementError if only some of them failed.
+        """
+
 
 class IVersioner(Interface):
 
@@ -46,6 +52,9 @@ class IVersioner(Interface):
     def incr(obj_or_cls, start=0):
         "Increment version of object and class or of class only"
 
+    def incr_multi(objects_or_classes):
+        "Increment the versions of several objects or classes at once"
+
 
 class IIdentityInspector(Interface):
 
@@ -57,12 +66,49 @@ class IIdentityInspector(Interface):
 
 class ICacheClient(Interface):
 
-    def add(key, obj):
-        pass
+    def add(key, obj, expiration=None):
+        """Store ``obj`` under ``key`` for ``expiration`` seconds (default is
+        implementation specific). Raise CacheKeyAlreadyExists if the entry
+        exists.
+        """
 
     def get(key):
         pass
 
+    def set(key, obj, expiration=None):
+        """Store ``obj`` under ``key``, replacing any existing entry."""
+
+
+class ICacheLeaseClient(ICacheClient):
+    """A cache client able to lease the right to populate a cache entry."""
+
+    def acquire_lease(key, ttl):
+        """Take the lease on ``key`` for ``ttl`` seconds.
+
+        Return an opaque token if the lease was acquired, None if it is
+        already held.
+        """
+
+    def release_lease(key, token):
+        """Release the lease on ``key`` if it is still held with ``token``.
+        """
+
+
+class IVersionedCacheClient(Interface):
+    """Resolve key versions and fetch the matching cache entry at once.
+
+    Optional: when registered, the cache manager uses it instead of querying
+    the key versioner and the cache client one after the other.
+    """
+
+    def get_versioned(root, keys):
+        """Return a tuple ``(versions, data)``.
+
+        ``versions`` is the list of ``(key, version)`` tuples, as returned by
+        :meth:`IKeyVersioner.get_multi`, and ``data`` is the content stored
+        under the cache key built from ``root`` and those versions, or None.
+        """
+
 
 class ICacheManager(Interface):
     pass
@@ -95,3 +141,19 @@ class ICacheHit(Interface):
 class ICacheMiss(Interface):
     cache_key = Attribute("The cache key object")
     request = Attribute("The request object")
+
+
+class ICacheStale(Interface):
+    cache_key = Attribute("The cache key object")
+    request = Attribute("The request object")
+
+
+class ICacheBudgetExceeded(Interface):
+    cache_key = Attribute("The cache key object")
+    request = Attribute("The request object")
+
+
+class ICircuitBreakerStateChanged(Interface):
+    breaker = Attribute("The circuit breaker object")
+    state = Attribute("The new state: closed, open or half-open")
+    previous_state = Attribute("The state before the change")
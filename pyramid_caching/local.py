@@ -0,0 +1,123 @@
+"""Process-local cache layer.
+
+Versioned cache keys embed the version of every dependency, so the content
+stored under a given key never changes. A local copy of a cache entry can not
+become stale: it is either used again or evicted.
+"""
+
+from collections import OrderedDict
+import copy
+import threading
+
+from pyramid.response import Response
+from zope.interface import alsoProvides, implementer, providedBy
+
+from pyramid_caching.interfaces import ICacheClient
+
+
+class LRUCache(object):
+
+    """Thread-safe LRU mapping bounded by the total size of its entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored under key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Store value under key, evicting the least recently used entries.
+
+        Values larger than the whole cache are not stored.
+        """
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+@implementer(ICacheClient)
+class LocalCacheClient(object):
+
+    """Keep the most recently used cache entries in process memory.
+
+    Wraps any ICacheClient and provides the same interfaces. Entries are
+    bounded by ``max_size`` bytes (keys and values). Keys starting with one
+    of ``mutable_prefixes`` are never kept locally: they refer to entries
+    replaced with ``set``, such as stale-while-revalidate pointers.
+
+    Other operations (leases, flush_all...) are delegated to the wrapped
+    client.
+    """
+
+    def __init__(self, client, max_size, mutable_prefixes=()):
+        self.client = client
+        self.local = LRUCache(max_size)
+        self.mutable_prefixes = tuple(mutable_prefixes)
+        alsoProvides(self, *providedBy(client))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _is_mutable(self, key):
+        return key.startswith(self.mutable_prefixes)
+
+    def get(self, key):
+        if self._is_mutable(key):
+            return self.client.get(key)
+        value = self.local.get(key)
+        if value is None:
+            value = self.client.get(key)
+            if value is not None:
+                self.local.put(key, value, len(key) + len(value))
+        return value
+
+    def add(self, key, value, expiration=None):
+        self.client.add(key, value, expiration=expiration)
+        if not self._is_mutable(key):
+            self.local.put(key, value, len(key) + len(value))
+
+    def set(self, key, value, expiration=None):
+        self.local.discard(key)
+        self.client.set(key, value, expiration=expiration)
+
+    def flush_all(self):
+        self.local.clear()
+        self.client.flush_all()
+
+
+def copy_result(result):
+    """Return a copy of a cached result that the caller may modify."""
+    if isinstance(result, Response):
+        return result.copy()
+    return copy.deepcopy(result)
@@ -1,5 +1,7 @@
 import cPickle as pickle
 from cStringIO import StringIO
+import struct
+import zlib
 
 from pyramid.response import Response
 from zope.interface import implementer, providedBy
@@ -7,7 +9,10 @@ from zope.interface import implementer, providedBy
 from pyramid_caching.exc import SerializationError, DeserializationError
 from pyramid_caching.interfaces import ISerializer, ISerializationAdapter
 
-SERIALIZER_META_VERSION = 1
+# Version 2 payloads may use the binary format of ResponseAdapter. The
+# envelope stays a pickled dict so that version 1 readers, which only check
+# the version, treat version 2 entries as misses during rolling deployments.
+SERIALIZER_META_VERSION = 2
 PICKLE_PROTOCOL = 2
 
 
@@ -17,7 +22,16 @@ def includeme(config):
     utility = SerializerUtility(registry)
     registry.registerUtility(utility)
 
-    utility.register_serialization_adapter(Response, ResponseAdapter)
+    compressor = None
+    settings = registry.settings
+    min_size = int(settings.get('caching.compress.min_size', 0))
+    if min_size:
+        level = int(settings.get('caching.compress.level', 6))
+        compressor = GzipCompressor(min_size, level)
+
+    utility.register_serialization_adapter(
+        Response, lambda: ResponseAdapter(compressor),
+        name=ResponseAdapter.name)
 
     config.add_directive('get_serializer', get_serializer, action_wrap=False)
 
@@ -31,7 +45,14 @@ class SerializerUtility(object):
     def __init__(self, registry):
         self.registry = registry
 
-    def register_serialization_adapter(self, object_class, adapter_factory):
+    def register_serialization_adapter(self, object_class, adapter_factory,
+                                       name=None):
+        """Register a factory of ISerializationAdapter for ``object_class``.
+
+        ``name`` defaults to the ``name`` attribute of ``adapter_factory``.
+        """
+        if name is None:
+            name = adapter_factory.name
         # Register serializer by object class.
         self.registry.registerAdapter(lambda x: adapter_factory(),
                                       required=[object_class],
@@ -41,7 +62,7 @@ class SerializerUtility(object):
         self.registry.registerAdapter(lambda x: adapter_factory(),
                                       required=[None],
                                       provided=ISerializationAdapter,
-                                      name=adapter_factory.name,
+                                      name=name,
                                       )
 
     def dumps(self, obj, adapter=None):
@@ -61,7 +82,7 @@ class SerializerUtility(object):
 
     def loads(self, data):
         data = pickle.loads(data)
-        if 'version' not in data or data['version'] != SERIALIZER_META_VERSION:
+        if data.get('version') not in (1, SERIALIZER_META_VERSION):
             return None
         adapter = self.registry.queryAdapter(None,
                                              ISerializationAdapter,
@@ -74,14 +95,97 @@ class SerializerUtility(object):
 
 @implementer(ISerializationAdapter)
 class ResponseAdapter(object):
-    """Deserializer for Pyramid Response objects."""
+    """Serializer for Pyramid Response objects.
+
+    The status, the header list and the body are length-prefixed so that
+    decoding does not involve any HTTP parsing::
+
+        marker | status length | header count | status
+        (name length | value length | name | value) * header count
+        body length | body
+
+    Responses serialized as HTTP messages by earlier versions are still
+    decoded.
+
+    With a ``compressor`` (see GzipCompressor), the body is stored compressed
+    along with the matching ``Content-Encoding`` header. It is sent as is to
+    clients accepting this encoding, see ViewCacheDecorator.
+    """
 
     name = 'pyramid.response.Response'
 
-    def serialize(self, response):
-        return str(response)
+    MARKER = '\x00'
+    HEAD = struct.Struct('>cHH')
+    HEADER = struct.Struct('>HI')
+    BODY = struct.Struct('>I')
 
-    def deserialize(self, raw_response):
+    def __init__(self, compressor=None):
+        self.compressor = compressor
+
+    def serialize(self, response):
+        headerlist = response.headerlist
+        body = response.body
+        if self.compressor is not None and response.content_encoding is None:
+            compressed = self.compressor.compress(body)
+            if compressed is not None:
+                body = compressed
+                headerlist = self._compressed_headerlist(
+                    headerlist, self.compressor.encoding)
+        parts = [self.HEAD.pack(self.MARKER, len(response.status),
+                                len(headerlist)),
+                 response.status]
+        for name, value in headerlist:
+            name, value = str(name), str(value)
+            parts.extend([self.HEADER.pack(len(name), len(value)),
+                          name, value])
+        parts.extend([self.BODY.pack(len(body)), body])
+        return ''.join(parts)
+
+    def _compressed_headerlist(self, headerlist, encoding):
+        compressed = [('Content-Encoding', encoding)]
+        vary = 'Accept-Encoding'
+        for name, value in headerlist:
+            if name.lower() == 'content-length':
+                continue
+            if name.lower() == 'vary':
+                if 'accept-encoding' not in value.lower():
+                    vary = '%s, %s' % (value, vary)
+                continue
+            compressed.append((name, value))
+        compressed.append(('Vary', vary))
+        return compressed
+
+    def deserialize(self, payload):
+        if not payload.startswith(self.MARKER):
+            return self._deserialize_http(payload)
+        try:
+            _, status_length, header_count = self.HEAD.unpack_from(payload)
+            offset = self.HEAD.size
+            status = payload[offset:offset + status_length]
+            offset += status_length
+            headerlist = []
+            for _ in xrange(header_count):
+                name_length, value_length = self.HEADER.unpack_from(payload,
+                                                                    offset)
+                offset += self.HEADER.size
+                name = payload[offset:offset + name_length]
+                offset += name_length
+                value = payload[offset:offset + value_length]
+                offset += value_length
+                headerlist.append((name, value))
+            body_length, = self.BODY.unpack_from(payload, offset)
+        except struct.error as error:
+            raise DeserializationError(error)
+        offset += self.BODY.size
+        if offset + body_length != len(payload):
+            raise DeserializationError('Truncated response payload')
+        # The body is the only copy of the payload: a buffer would avoid it,
+        # but WSGI bodies must be str and webob joins app_iter into a str as
+        # soon as the body is read.
+        return Response(status=status, headerlist=headerlist,
+                        body=payload[offset:])
+
+    def _deserialize_http(self, raw_response):
         res = Response.from_file(StringIO(raw_response))
 
         # Workaround for issue #99 in webob. All header names must be str
@@ -89,3 +193,28 @@ class ResponseAdapter(object):
         res._headerlist = [(str(k), str(v)) for k, v in res._headerlist]
 
         return res
+
+
+class GzipCompressor(object):
+    """Compress payloads of at least ``min_size`` bytes with gzip.
+
+    Enabled with the setting ``caching.compress.min_size`` (in bytes), the
+    compression level is set by ``caching.compress.level`` (default: 6).
+    """
+
+    encoding = 'gzip'
+
+    def __init__(self, min_size, level=6):
+        self.min_size = min_size
+        self.level = level
+
+    def compress(self, data):
+        """Return the compressed data, or None if it is not worth it."""
+        if len(data) < self.min_size:
+            return None
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return None
+        return compressed
@@ -0,0 +1,144 @@
+"""Spread cache entries across several cache clients.
+
+Keys are assigned to shards with consistent hashing: adding or removing a
+shard only moves the keys of the ring segments it owns. A shard failing is
+skipped for a while, its keys being served by the next shard on the ring.
+Since versioned cache entries never change, an entry read from another
+shard can not be outdated; it is only a miss.
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+from zope.interface import alsoProvides, implementer
+
+from pyramid_caching.exc import (
+    CacheAddError,
+    CacheError,
+    CacheGetError,
+    CacheKeyAlreadyExists,
+    CacheLeaseError,
+    )
+from pyramid_caching.interfaces import ICacheClient, ICacheLeaseClient
+
+log = logging.getLogger(__name__)
+
+
+def _hash(value):
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class ConsistentHashRing(object):
+
+    """Map keys to node names.
+
+    Each node is placed ``replicas`` times on the ring, so that keys spread
+    evenly and a new node takes a share of the keys of every other node.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = sorted(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((_hash('%s#%d' % (node, i)), node))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """The node owning ``key``."""
+        return next(self.iter_nodes(key))
+
+    def iter_nodes(self, key):
+        """The distinct nodes following ``key`` on the ring, starting with
+        its owner."""
+        count = len(self._points)
+        start = bisect.bisect(self._points, _hash(key))
+        seen = set()
+        for i in xrange(count):
+            node = self._nodes[(start + i) % count]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+
+@implementer(ICacheClient)
+class ShardedCacheClient(object):
+
+    """Dispatch the operations on a key to the cache client owning it.
+
+    ``shards`` maps names to cache clients; names place the shards on the
+    ring and must not depend on the order of the configuration. A shard
+    raising a CacheError is considered dead for ``retry_interval`` seconds:
+    its keys are handled by the next live shard meanwhile. When no shard is
+    alive, the error of the operation is raised.
+
+    Provides ICacheLeaseClient when all the shards do.
+    """
+
+    def __init__(self, shards, replicas=100, retry_interval=30):
+        if not shards:
+            raise ValueError('ShardedCacheClient requires at least one shard')
+        self.shards = dict(shards)
+        self.ring = ConsistentHashRing(self.shards, replicas)
+        self.retry_interval = retry_interval
+        self._dead_until = {}
+        self._lock = threading.Lock()
+        if all(ICacheLeaseClient.providedBy(shard)
+               for shard in self.shards.itervalues()):
+            alsoProvides(self, ICacheLeaseClient)
+
+    def _is_alive(self, name):
+        dead_until = self._dead_until.get(name)
+        if dead_until is None:
+            return True
+        if time.time() < dead_until:
+            return False
+        with self._lock:
+            self._dead_until.pop(name, None)
+        log.info('Retrying cache shard %s', name)
+        return True
+
+    def _mark_dead(self, name):
+        with self._lock:
+            self._dead_until[name] = time.time() + self.retry_interval
+        log.warning('Cache shard %s failed, skipped for %ss', name,
+                    self.retry_interval, exc_info=True)
+
+    def _call(self, error_class, method, key, *args, **kwargs):
+        for name in self.ring.iter_nodes(key):
+            if not self._is_alive(name):
+                continue
+            try:
+                return getattr(self.shards[name], method)(key, *args,
+                                                          **kwargs)
+            except CacheKeyAlreadyExists:
+                raise
+            except CacheError:
+                self._mark_dead(name)
+        raise error_class('No cache shard available for %s' % key)
+
+    def get(self, key):
+        return self._call(CacheGetError, 'get', key)
+
+    def add(self, key, value, expiration=None):
+        self._call(CacheAddError, 'add', key, value, expiration=expiration)
+
+    def set(self, key, value, expiration=None):
+        self._call(CacheAddError, 'set', key, value, expiration=expiration)
+
+    def acquire_lease(self, key, ttl):
+        return self._call(CacheLeaseError, 'acquire_lease', key, ttl)
+
+    def release_lease(self, key, token):
+        self._call(CacheLeaseError, 'release_lease', key, token)
+
+    def flush_all(self):
+        for shard in self.shards.itervalues():
+            shard.flush_all()
@@ -35,6 +35,20 @@ class Test(Base):
         self._modify_user()
         self.assertNotEqual(result1, self.app.get('/users/1').json)
 
+    def test_bulk_update_invalidates_views(self):
+        from example.model import User, Session
+        result1 = self.app.get('/users/1').json
+        index1 = self.app.get('/users').json
+
+        session = Session()
+        session.query(User).update({'name': 'Bob Marley'},
+                                   synchronize_session=False)
+        session.commit()
+        session.close()
+
+        self.assertNotEqual(result1, self.app.get('/users/1').json)
+        self.assertNotEqual(index1, self.app.get('/users').json)
+
     def test_inhibited_cache_view(self):
         self.key_versioner_client.client.set('cache', 'off')
 
@@ -51,3 +65,15 @@ class Test(Base):
         self.assertNotEqual(result1, result2)
         result3 = self.app.get('/users?name=Ziggy').json
         self.assertNotEqual(result2, result3)
+
+    def test_not_modified(self):
+        etag = self.app.get('/users/1').headers['ETag']
+
+        response = self.app.get('/users/1', headers={'If-None-Match': etag},
+                                status=304)
+        self.assertEqual(response.headers['X-View-Cache'], 'NOT_MODIFIED')
+        self.assertEqual(response.body, '')
+
+        self._modify_user()
+        response = self.app.get('/users/1', headers={'If-None-Match': etag})
+        self.assertNotEqual(response.headers['ETag'], etag)
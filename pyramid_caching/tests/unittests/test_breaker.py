@@ -0,0 +1,154 @@
+import unittest
+
+import mock
+
+from pyramid_caching.breaker import CircuitBreaker
+from pyramid_caching.exc import (
+    CacheBudgetExceeded,
+    CacheDisabled,
+    CacheGetError,
+    CacheKeyAlreadyExists,
+    CircuitOpen,
+    )
+
+
+def fail():
+    raise CacheGetError('down')
+
+
+def succeed():
+    return 'ok'
+
+
+@mock.patch('pyramid_caching.breaker.time')
+class CircuitBreakerTests(unittest.TestCase):
+
+    def _make_one(self, **kwargs):
+        self.events = []
+        kwargs.setdefault('failures', 2)
+        kwargs.setdefault('cooldown', 30)
+        return CircuitBreaker('cache', notify=self.events.append, **kwargs)
+
+    def _fail(self, breaker, times):
+        for _ in range(times):
+            with self.assertRaises(CacheGetError):
+                breaker.call(fail)
+
+    def test_closed(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self._fail(breaker, 1)
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self._fail(breaker, 1)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(self.events, [])
+
+    def test_open_after_failures(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 2)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        calls = []
+        with self.assertRaises(CircuitOpen):
+            breaker.call(calls.append, 1)
+        self.assertEqual(calls, [])
+        self.assertEqual([(e.previous_state, e.state) for e in self.events],
+                         [('closed', 'open')])
+        self.assertIs(self.events[0].breaker, breaker)
+
+    def test_circuit_open_disables_cache(self, m_time):
+        self.assertTrue(issubclass(CircuitOpen, CacheDisabled))
+
+    def test_half_open_after_cooldown(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 2)
+        m_time.time.return_value = 1030
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual([(e.previous_state, e.state) for e in self.events],
+                         [('closed', 'open'),
+                          ('open', 'half-open'),
+                          ('half-open', 'closed')])
+
+    def test_failed_trial_opens_again(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 2)
+        m_time.time.return_value = 1030
+        self._fail(breaker, 1)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        m_time.time.return_value = 1059
+        with self.assertRaises(CircuitOpen):
+            breaker.call(succeed)
+
+    def test_trials_limit_concurrent_calls(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one(trials=2)
+        self._fail(breaker, 2)
+        m_time.time.return_value = 1030
+
+        def nested():
+            self.assertEqual(breaker.call(succeed), 'ok')
+            with self.assertRaises(CircuitOpen):
+                breaker.call(succeed)
+            return 'nested'
+
+        self.assertEqual(breaker.call(nested), 'nested')
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_slow_calls_fail(self, m_time):
+        m_time.time.side_effect = [1000, 1000.5, 1000, 1000.05,
+                                   1000, 1000.5, 1000, 1000.5, 1000.5]
+        breaker = self._make_one(slow_call=0.1)
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    @staticmethod
+    def _raise(error):
+        raise error
+
+    def test_neutral_errors(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 1)
+        with self.assertRaises(CacheDisabled):
+            breaker.call(self._raise, CacheDisabled())
+        with self.assertRaises(ValueError):
+            breaker.call(self._raise, ValueError())
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self._fail(breaker, 1)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_neutral_trial_is_retried(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 2)
+        m_time.time.return_value = 1030
+        with self.assertRaises(CacheDisabled):
+            breaker.call(self._raise, CacheDisabled())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertEqual(breaker.call(succeed), 'ok')
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_existing_key_succeeds(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 1)
+        with self.assertRaises(CacheKeyAlreadyExists):
+            breaker.call(self._raise, CacheKeyAlreadyExists('a'))
+        self._fail(breaker, 1)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_budget_exceeded_fails(self, m_time):
+        m_time.time.return_value = 1000
+        breaker = self._make_one()
+        self._fail(breaker, 1)
+        with self.assertRaises(CacheBudgetExceeded):
+            breaker.call(self._raise, CacheBudgetExceeded('a', 0.2, 0.1))
+        self.assertEqual(breaker.state, breaker.OPEN)
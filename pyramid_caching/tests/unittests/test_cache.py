@@ -1,11 +1,29 @@
+import threading
+import time
 import unittest
 
+import mock
+from nose_parameterized import parameterized
 from pyramid import testing
 from pyramid.response import Response
+from webob.acceptparse import create_accept_encoding_header
 from webob.multidict import MultiDict
+from webob.request import Request
 
-from pyramid_caching.cache import CacheResult
-from pyramid_caching.exc import CacheGetError, VersionGetError
+from pyramid_caching.cache import (
+    CacheKey,
+    CacheResult,
+    hash_key,
+    matching_etag,
+    )
+from pyramid_caching.exc import (
+    CacheAddError,
+    CacheBudgetExceeded,
+    CacheGetError,
+    CacheKeyAlreadyExists,
+    CacheLeaseTimeout,
+    VersionGetError,
+    )
 
 
 class CacheManagerTests(unittest.TestCase):
@@ -33,6 +51,29 @@ class CacheManagerTests(unittest.TestCase):
         result = manager.get_or_cache(None, ['a', 'b'], ['c', 'd'])
         self.assertEqual(result._cache_key.key(), 'a:b:c:d')
 
+    def test_make_key(self):
+        from pyramid_caching.cache import Manager
+        manager = Manager(self.registry, DummyVersioner(), None,
+                          DummySerializer(), key_max_length=16)
+        key = manager.make_key(['a', 'x' * 60], ['c:v=1'])
+        self.assertEqual(key.root(), 'a:' + 'x' * 60)
+        self.assertEqual(str(key), 'a:#' + hash_key(
+            'a:' + 'x' * 60 + ':c:v=1'))
+
+    def test_load(self):
+        manager = self._make_one(None)
+        key = CacheKey(['a'], ['b'])
+        result = manager.load(key, 'data')
+        self.assertEqual(result.data, 'data')
+        self.assertTrue(result.info().hit)
+        self.assertIs(result.info().key, key)
+
+    def test_load_unsupported_format(self):
+        from pyramid_caching.cache import Manager
+        manager = Manager(self.registry, DummyVersioner(), None,
+                          DummyUnsupportedSerializer())
+        self.assertIsNone(manager.load(CacheKey(['a'], ['b']), 'data'))
+
     def test_cache_miss_when_client_returns_none(self):
         def get_result():
             pass
@@ -57,6 +98,775 @@ class CacheManagerTests(unittest.TestCase):
         result = manager.get_or_cache(get_result, [], [])
         self.assertEqual(result.data, "loaded")
 
+    def test_cache_miss_ignores_concurrent_add(self):
+        manager = self._make_one(None)
+        manager.cache_client.add_error = CacheKeyAlreadyExists
+        result = manager.get_or_cache(lambda: "loaded", [], [])
+        self.assertEqual(result.data, "loaded")
+
+    def test_cache_miss_returns_result_when_add_fails(self):
+        manager = self._make_one(None)
+        manager.cache_client.add_error = CacheAddError
+        calls = []
+
+        def get_result():
+            calls.append(1)
+            return "loaded"
+
+        result = manager.get_or_cache(get_result, [], [])
+        self.assertEqual(result.data, "loaded")
+        self.assertFalse(result.info().hit)
+        self.assertEqual(calls, [1])
+
+    @mock.patch('pyramid_caching.cache._Flight')
+    def test_coalesce_concurrent_misses(self, m_flight):
+        from pyramid_caching.cache import Manager
+        all_waiting = threading.Event()
+        m_flight.side_effect = lambda: DummyFlight(3, all_waiting)
+        client = DummyClient(None)
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          client,
+                          DummySerializer(),
+                          coalesce_misses=True)
+        calls = []
+        rendering = threading.Event()
+        release = threading.Event()
+
+        def get_result():
+            calls.append(1)
+            rendering.set()
+            release.wait()
+            return "loaded"
+
+        results = []
+
+        def request():
+            results.append(manager.get_or_cache(get_result, ['a'], ['b']))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        rendering.wait()
+        followers = [threading.Thread(target=request) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        all_waiting.wait()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r.data for r in results], ["loaded"] * 4)
+        self.assertEqual(sorted(r.info().hit for r in results),
+                         [False, True, True, True])
+
+    def test_manager_renders_after_coalesce_timeout(self):
+        from pyramid_caching.cache import Manager
+        manager = Manager(self.registry, DummyVersioner(), DummyClient(None),
+                          DummySerializer(), coalesce_misses=True,
+                          coalesce_timeout=0.01)
+        manager.misses.run = mock.Mock(return_value=(False, None))
+        result = manager.get_or_cache(lambda: 'rendered', ['a'], ['b'])
+        self.assertEqual(result.data, 'rendered')
+        self.assertFalse(result.info().hit)
+
+    def test_local_results(self):
+        from pyramid_caching.cache import Manager
+        from pyramid_caching.local import LRUCache
+        client = DummyClient('cached')
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          client,
+                          DummyResponseSerializer(),
+                          local_results=LRUCache(1000))
+        first = manager.get_or_cache(None, ['a'], ['b'])
+        first.data.headers['X-View-Cache'] = 'HIT'
+        second = manager.get_or_cache(None, ['a'], ['b'])
+        self.assertEqual(client.gets, 1)
+        self.assertTrue(second.info().hit)
+        self.assertEqual(second.data.body, 'cached')
+        self.assertNotIn('X-View-Cache', second.data.headers)
+        self.assertIsNot(second.data, first.data)
+
+    def test_unsupported_format_is_a_miss(self):
+        from pyramid_caching.cache import Manager
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          DummyClient('cached'),
+                          DummyUnsupportedSerializer())
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertFalse(result.info().hit)
+        self.assertEqual(result.data, 'loaded')
+
+    def test_policy_expiration(self):
+        from pyramid_caching.cache import CachePolicy, Manager
+        client = DictClient()
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          client,
+                          DummySerializer())
+        manager.get_or_cache(lambda: 'loaded', ['a'], ['b'],
+                             policy=CachePolicy(ttl=60))
+        self.assertEqual(client.expirations, {'a:b': 60})
+
+    def test_policy_max_size(self):
+        from pyramid_caching.cache import CachePolicy, Manager
+        client = DictClient()
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          client,
+                          DummySerializer())
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'],
+                                      policy=CachePolicy(max_size=5))
+        self.assertEqual(result.data, 'loaded')
+        self.assertEqual(client.data, {})
+
+    def test_versioned_cache_client_hit(self):
+        from pyramid_caching.cache import Manager
+        versioned_client = DummyVersionedCacheClient('cached')
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          DummyClient(None),
+                          DummySerializer(),
+                          versioned_cache_client=versioned_client)
+        result = manager.get_or_cache(None, ['a', 'b'], ['c', 'd'])
+        self.assertTrue(result.info().hit)
+        self.assertEqual(result.data, 'cached')
+        self.assertEqual(versioned_client.calls, [('a:b', ['c', 'd'])])
+        self.assertEqual(result._cache_key.key(), 'a:b:c:v=0:d:v=0')
+
+    def test_not_modified_skips_cache_get(self):
+        from pyramid_caching.cache import Manager
+        client = DummyClient('cached')
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          client,
+                          DummySerializer())
+        etag = CacheKey(['a'], ['b']).hash()
+        result = manager.get_or_cache(None, ['a'], ['b'],
+                                      if_none_match=['other', etag])
+        self.assertTrue(result.info().not_modified)
+        self.assertIsNone(result.data)
+        self.assertEqual(result.key_hash(), etag)
+        self.assertEqual(client.gets, 0)
+
+    def test_not_modified_encoded_etag(self):
+        manager = self._make_one('cached')
+        etag = CacheKey(['a'], ['b']).hash()
+        result = manager.get_or_cache(None, ['a'], ['b'],
+                                      if_none_match=[etag + '-gzip'])
+        self.assertTrue(result.info().not_modified)
+
+    def test_if_none_match_mismatch(self):
+        manager = self._make_one('cached')
+        result = manager.get_or_cache(None, ['a'], ['b'],
+                                      if_none_match=['other'])
+        self.assertFalse(result.info().not_modified)
+        self.assertEqual(result.data, 'cached')
+
+    def test_not_modified_skips_versioned_cache_client(self):
+        from pyramid_caching.cache import Manager
+        versioned_client = DummyVersionedCacheClient('cached')
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          DummyClient(None),
+                          DummySerializer(),
+                          versioned_cache_client=versioned_client)
+        etag = CacheKey(['a'], ['b']).hash()
+        result = manager.get_or_cache(None, ['a'], ['b'],
+                                      if_none_match=[etag])
+        self.assertTrue(result.info().not_modified)
+        self.assertEqual(versioned_client.calls, [])
+
+    def test_versioned_cache_client_miss(self):
+        from pyramid_caching.cache import Manager
+        manager = Manager(self.registry,
+                          DummyVersioner(),
+                          DummyClient(None),
+                          DummySerializer(),
+                          versioned_cache_client=DummyVersionedCacheClient())
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['c'])
+        self.assertFalse(result.info().hit)
+        self.assertEqual(result.data, 'loaded')
+
+    def _make_slow(self, m_time, versions=0, get=0, cached_value=None):
+        from pyramid_caching.cache import Manager
+        m_time.time.return_value = 1000
+        versioner = DummyVersioner()
+        client = DummyClient(cached_value)
+
+        def get_multi_keys(dependencies):
+            m_time.time.return_value += versions
+            return dependencies
+
+        def slow_get(key):
+            m_time.time.return_value += get
+            return cached_value
+
+        versioner.get_multi_keys = get_multi_keys
+        client.get = mock.Mock(side_effect=slow_get)
+        return Manager(self.registry, versioner, client, DummySerializer(),
+                       budget=0.1), client
+
+    @mock.patch('pyramid_caching.cache.time')
+    def test_budget_exceeded_by_versions(self, m_time):
+        manager, client = self._make_slow(m_time, versions=0.2)
+        with self.assertRaises(CacheBudgetExceeded) as cm:
+            manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertEqual(cm.exception.cache_key.key(), 'a:b')
+        self.assertAlmostEqual(cm.exception.elapsed, 0.2)
+        self.assertEqual(cm.exception.budget, 0.1)
+        self.assertFalse(client.get.called)
+
+    @mock.patch('pyramid_caching.cache.time')
+    def test_hit_fetched_over_budget_is_used(self, m_time):
+        manager, client = self._make_slow(m_time, versions=0.05, get=0.1,
+                                          cached_value='data')
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertTrue(result.info().hit)
+        self.assertEqual(result.data, 'data')
+
+    @mock.patch('pyramid_caching.cache.time')
+    def test_within_budget(self, m_time):
+        manager, client = self._make_slow(m_time, versions=0.05, get=0.04,
+                                          cached_value='data')
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertTrue(result.info().hit)
+
+    @mock.patch('pyramid_caching.cache.time')
+    def test_budget_argument(self, m_time):
+        manager, client = self._make_slow(m_time, versions=0.2,
+                                          cached_value='data')
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'],
+                                      budget=0.5)
+        self.assertTrue(result.info().hit)
+
+    @mock.patch('pyramid_caching.cache.time')
+    def test_versioned_lookup_is_not_checked(self, m_time):
+        from pyramid_caching.cache import Manager
+        m_time.time.return_value = 1000
+        versioned_client = DummyVersionedCacheClient('data')
+        get_versioned = versioned_client.get_versioned
+
+        def slow_get_versioned(root, keys):
+            m_time.time.return_value += 0.2
+            return get_versioned(root, keys)
+
+        versioned_client.get_versioned = slow_get_versioned
+        manager = Manager(self.registry, DummyVersioner(), None,
+                          DummySerializer(),
+                          versioned_cache_client=versioned_client,
+                          budget=0.1)
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertTrue(result.info().hit)
+
+
+class CacheKeyTests(unittest.TestCase):
+
+    def test_flatten(self):
+        key = CacheKey(['a', ['b', {'y': 2, 'x': 1}], {}, []], ['d:v=1'])
+        self.assertEqual(key.root(), 'a:b:x=1:y=2::')
+        self.assertEqual(str(key), 'a:b:x=1:y=2:::d:v=1')
+
+    def test_key_is_memoized(self):
+        key = CacheKey(['a'], ['b'])
+        self.assertIs(str(key), str(key))
+        self.assertIs(key.hash(), key.hash())
+        self.assertEqual(key.hash(), hash_key('a:b'))
+
+    def test_root_given(self):
+        key = CacheKey(['a', 'b'], ['c'], root='a:b')
+        self.assertEqual(str(key), 'a:b:c')
+
+    def test_compact_long_key(self):
+        key = CacheKey(['view', {'q': 'x' * 100}], ['user:v=1'],
+                       max_length=64)
+        full = 'view:q=%s:user:v=1' % ('x' * 100)
+        self.assertEqual(str(key), 'view:#' + hash_key(full))
+        self.assertEqual(key.root(), 'view:q=' + 'x' * 100)
+
+    def test_compaction_does_not_lengthen_key(self):
+        key = CacheKey(['view', 'x' * 10], ['user:v=1'], max_length=8)
+        self.assertEqual(str(key), 'view:xxxxxxxxxx:user:v=1')
+
+    def test_short_key_is_readable(self):
+        key = CacheKey(['view', {'q': 'x'}], ['user:v=1'], max_length=64)
+        self.assertEqual(str(key), 'view:q=x:user:v=1')
+
+    def test_compact_root_key(self):
+        key = CacheKey(['view', {'q': 'x' * 100}], [], max_length=64)
+        self.assertEqual(key.root_key(),
+                         'view:#' + hash_key('view:q=' + 'x' * 100))
+
+    def test_key_hash_reuses_key(self):
+        key = CacheKey(['a'], ['b'])
+        self.assertIs(CacheResult.hit(key, 'data').key_hash(), key.hash())
+
+
+class CacheLeaseTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.registry = self.config.registry
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _make_one(self, client, fallback='render'):
+        from pyramid_caching.cache import CacheLeases, Manager
+        leases = CacheLeases(ttl=1, wait=0.01, interval=0.001,
+                             fallback=fallback)
+        return Manager(self.registry,
+                       DummyVersioner(),
+                       client,
+                       DummySerializer(),
+                       leases=leases)
+
+    def test_lease_holder_renders(self):
+        client = DummyLeaseClient(acquired=True)
+        manager = self._make_one(client)
+        result = manager.get_or_cache(lambda: "loaded", ['a'], ['b'])
+        self.assertFalse(result.info().hit)
+        self.assertEqual(result.data, "loaded")
+        self.assertEqual(client.acquired, [('a:b', 1)])
+        self.assertEqual(client.released, [('a:b', 'token')])
+
+    def test_lease_released_when_render_fails(self):
+        client = DummyLeaseClient(acquired=True)
+        manager = self._make_one(client)
+
+        def get_result():
+            raise ValueError()
+
+        self.assertRaises(ValueError, manager.get_or_cache,
+                          get_result, ['a'], ['b'])
+        self.assertEqual(client.released, [('a:b', 'token')])
+
+    def test_wait_for_lease_holder(self):
+        client = DummyLeaseClient(acquired=False, filled_after=2)
+        manager = self._make_one(client)
+        result = manager.get_or_cache(None, ['a'], ['b'])
+        self.assertTrue(result.info().hit)
+        self.assertEqual(result.data, "filled")
+
+    def test_wait_timeout_renders(self):
+        client = DummyLeaseClient(acquired=False)
+        manager = self._make_one(client)
+        result = manager.get_or_cache(lambda: "loaded", ['a'], ['b'])
+        self.assertFalse(result.info().hit)
+        self.assertEqual(result.data, "loaded")
+        self.assertEqual(client.released, [])
+
+    def test_render_when_lease_released_without_entry(self):
+        client = DummyLeaseClient(acquired=False, free_after=2)
+        manager = self._make_one(client, fallback='fail')
+        manager.leases.wait_timeout = 60
+        result = manager.get_or_cache(lambda: "loaded", ['a'], ['b'])
+        self.assertFalse(result.info().hit)
+        self.assertEqual(result.data, "loaded")
+        self.assertEqual(client.released, [('a:b', 'token')])
+
+    def test_oversized_result_releases_waiters(self):
+        from pyramid_caching.cache import CachePolicy
+        client = DictLeaseClient()
+        manager = self._make_one(client)
+        manager.leases.wait_timeout = 60
+        policy = CachePolicy(max_size=1)
+        rendering = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def render():
+            rendering.set()
+            release.wait()
+            return 'oversized'
+
+        def request(get_result):
+            results.append(manager.get_or_cache(get_result, ['a'], ['b'],
+                                                policy=policy))
+
+        leader = threading.Thread(target=request, args=(render,))
+        leader.start()
+        rendering.wait()
+        follower = threading.Thread(target=request,
+                                    args=(lambda: 'follower',))
+        follower.start()
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(sorted(r.data for r in results),
+                         ['follower', 'oversized'])
+        self.assertNotIn('a:b', client.data)
+
+    def test_wait_timeout_fails(self):
+        client = DummyLeaseClient(acquired=False)
+        manager = self._make_one(client, fallback='fail')
+        self.assertRaises(CacheLeaseTimeout, manager.get_or_cache,
+                          lambda: "loaded", ['a'], ['b'])
+
+    def test_invalid_fallback(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_caching.cache import CacheLeases
+        self.assertRaises(ConfigurationError, CacheLeases, fallback='maybe')
+
+    def test_parse_settings_disabled(self):
+        from pyramid_caching.cache import parse_lease_settings
+        self.assertIsNone(parse_lease_settings({}))
+
+    def test_parse_settings(self):
+        from pyramid_caching.cache import parse_lease_settings
+        leases = parse_lease_settings({
+            'caching.lease.enabled': 'true',
+            'caching.lease.ttl': '2',
+            'caching.lease.wait': '0.2',
+            'caching.lease.fallback': 'fail',
+            })
+        self.assertEqual(leases.ttl, 2.0)
+        self.assertEqual(leases.wait_timeout, 0.2)
+        self.assertEqual(leases.interval, 0.05)
+        self.assertEqual(leases.fallback, 'fail')
+
+    def test_circuit_open(self):
+        from pyramid_caching.breaker import CircuitBreaker
+        from pyramid_caching.cache import Manager
+        from pyramid_caching.exc import CircuitOpen
+        client = DummyClient(None)
+        client.get = mock.Mock(side_effect=CacheGetError('down'))
+        manager = Manager(self.registry, DummyVersioner(), client,
+                          DummySerializer(),
+                          breaker=CircuitBreaker('cache', failures=1))
+        self.assertRaises(CacheGetError, manager.get_or_cache,
+                          lambda: 'loaded', ['a'], ['b'])
+        self.assertRaises(CircuitOpen, manager.get_or_cache,
+                          lambda: 'loaded', ['a'], ['b'])
+        self.assertEqual(client.get.call_count, 1)
+
+    def test_add_failures_open_the_circuit(self):
+        from pyramid_caching.breaker import CircuitBreaker
+        from pyramid_caching.cache import Manager
+        client = DummyClient(None)
+        client.add_error = CacheAddError
+        breaker = CircuitBreaker('cache', failures=1)
+        manager = Manager(self.registry, DummyVersioner(), client,
+                          DummySerializer(), breaker=breaker)
+        result = manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertEqual(result.data, 'loaded')
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_concurrent_add_does_not_fail_the_circuit(self):
+        from pyramid_caching.breaker import CircuitBreaker
+        from pyramid_caching.cache import Manager
+        client = DummyClient(None)
+        client.add_error = CacheKeyAlreadyExists
+        breaker = CircuitBreaker('cache', failures=1)
+        manager = Manager(self.registry, DummyVersioner(), client,
+                          DummySerializer(), breaker=breaker)
+        manager.get_or_cache(lambda: 'loaded', ['a'], ['b'])
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_parse_breaker_settings_disabled(self):
+        from pyramid_caching.cache import parse_breaker_settings
+        self.assertIsNone(parse_breaker_settings({}))
+
+    def test_parse_breaker_settings(self):
+        from pyramid_caching.cache import parse_breaker_settings
+        notify = mock.Mock()
+        breaker = parse_breaker_settings({
+            'caching.breaker.failures': '3',
+            'caching.breaker.cooldown': '10',
+            'caching.breaker.slow_call': '0.5',
+            'caching.breaker.trials': '2',
+            }, notify)
+        self.assertEqual(breaker.name, 'cache')
+        self.assertEqual(breaker.failures, 3)
+        self.assertEqual(breaker.cooldown, 10.0)
+        self.assertEqual(breaker.slow_call, 0.5)
+        self.assertEqual(breaker.trials, 2)
+        self.assertIs(breaker.notify, notify)
+
+
+class StaleWhileRevalidateTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.registry = self.config.registry
+        self.client = DictClient()
+        self.versioner = DictVersioner()
+        from pyramid_caching.cache import Manager
+        self.manager = Manager(self.registry,
+                               self.versioner,
+                               self.client,
+                               DummySerializer())
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _join_refresh(self):
+        for thread in threading.enumerate():
+            if thread.name == 'pyramid_caching-refresh':
+                thread.join()
+
+    def test_miss_stores_pointer(self):
+        self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'], max_stale=60)
+        self.assertEqual(self.client.data['stale:a:b'], 'a:b:v=0')
+
+    def test_compacted_pointer(self):
+        self.manager.key_max_length = 16
+        self.manager.get_or_cache(lambda: 'v1', ['a', 'x' * 60], ['b'],
+                                  max_stale=60)
+        key = 'a:#' + hash_key('a:' + 'x' * 60 + ':b:v=0')
+        self.assertEqual(self.client.data[key], 'v1')
+        pointer = 'stale:a:#' + hash_key('a:' + 'x' * 60 + ':b')
+        self.assertEqual(self.client.data[pointer], key)
+
+        self.versioner.versions['b'] = 1
+        result = self.manager.get_or_cache(lambda: 'v2', ['a', 'x' * 60],
+                                           ['b'], max_stale=60)
+        self._join_refresh()
+        self.assertTrue(result.info().stale)
+        self.assertEqual(result.data, 'v1')
+
+    def test_no_pointer_without_max_stale(self):
+        self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'])
+        self.assertNotIn('stale:a:b', self.client.data)
+
+    def test_serve_stale_and_refresh(self):
+        self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'], max_stale=60)
+
+        self.versioner.versions['b'] = 1
+        result = self.manager.get_or_cache(lambda: 'v2', ['a'], ['b'],
+                                           max_stale=60)
+        self.assertEqual(result.data, 'v1')
+        self.assertTrue(result.info().stale)
+        self.assertEqual(str(result.info().key), 'a:b:v=1')
+
+        self._join_refresh()
+        self.assertEqual(self.client.data['a:b:v=1'], 'v2')
+        self.assertEqual(self.client.data['stale:a:b'], 'a:b:v=1')
+
+        result = self.manager.get_or_cache(None, ['a'], ['b'],
+                                           max_stale=60)
+        self.assertEqual(result.data, 'v2')
+        self.assertFalse(result.info().stale)
+
+    def test_other_resources_are_not_served_stale(self):
+        self.manager.get_or_cache(lambda: 'user 1', ['a'], ['user:1'],
+                                  max_stale=60)
+
+        result = self.manager.get_or_cache(lambda: 'user 2', ['a'],
+                                           ['user:2'], max_stale=60)
+        self.assertEqual(result.data, 'user 2')
+        self.assertFalse(result.info().hit)
+
+        self.versioner.versions['user:1'] = 1
+        self.versioner.versions['user:2'] = 1
+        for user_id in ('1', '2'):
+            result = self.manager.get_or_cache(lambda: 'new', ['a'],
+                                               ['user:' + user_id],
+                                               max_stale=60)
+            self.assertTrue(result.info().stale)
+            self.assertEqual(result.data, 'user ' + user_id)
+        self._join_refresh()
+
+    def test_stale_marker_expires_with_budget(self):
+        for max_stale, expiration in ((60, 60), (2.5, 3), (0.1, 1)):
+            self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'],
+                                      max_stale=max_stale)
+            self.versioner.versions['b'] = 1
+            self.manager.get_or_cache(lambda: 'v2', ['a'], ['b'],
+                                      max_stale=max_stale)
+            self._join_refresh()
+            self.assertEqual(self.client.expirations['stale:since:a:b:v=1'],
+                             expiration)
+            self.client.data.clear()
+            self.versioner.versions.clear()
+
+    def test_stale_etag_identifies_stale_entry(self):
+        from pyramid_caching.cache import CacheKey
+        self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'], max_stale=60)
+        fresh = CacheResult.hit(CacheKey(['a'], ['b:v=0']), 'v1')
+
+        self.versioner.versions['b'] = 1
+        stale = self.manager.get_or_cache(lambda: 'v2', ['a'], ['b'],
+                                          max_stale=60)
+        self._join_refresh()
+        self.assertEqual(stale.key_hash(), fresh.key_hash())
+
+    def test_stale_budget_exceeded(self):
+        self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'], max_stale=60)
+        self.client.data['stale:since:a:b:v=1'] = repr(time.time() - 61)
+
+        self.versioner.versions['b'] = 1
+        result = self.manager.get_or_cache(lambda: 'v2', ['a'], ['b'],
+                                           max_stale=60)
+        self.assertEqual(result.data, 'v2')
+        self.assertFalse(result.info().hit)
+
+    def test_failed_refresh_is_logged(self):
+        self.manager.get_or_cache(lambda: 'v1', ['a'], ['b'], max_stale=60)
+
+        def get_result():
+            raise ValueError()
+
+        self.versioner.versions['b'] = 1
+        result = self.manager.get_or_cache(get_result, ['a'], ['b'],
+                                           max_stale=60)
+        self._join_refresh()
+        self.assertEqual(result.data, 'v1')
+        self.assertEqual(self.client.data['stale:a:b'], 'a:b:v=0')
+
+
+class CachePolicyTests(unittest.TestCase):
+
+    def _make_one(self, **kwargs):
+        from pyramid_caching.cache import CachePolicy
+        return CachePolicy(**kwargs)
+
+    def test_default(self):
+        policy = self._make_one()
+        self.assertIsNone(policy.expiration())
+        self.assertEqual(policy.add_kwargs(), {})
+        self.assertTrue(policy.accepts('x' * 10000))
+
+    def test_max_size(self):
+        policy = self._make_one(max_size=3)
+        self.assertTrue(policy.accepts('abc'))
+        self.assertFalse(policy.accepts('abcd'))
+
+    def test_expiration(self):
+        policy = self._make_one(ttl=60)
+        self.assertEqual(policy.add_kwargs(), {'expiration': 60})
+
+    @mock.patch('pyramid_caching.cache.random')
+    def test_jitter(self, m_random):
+        m_random.uniform.return_value = 0.1
+        policy = self._make_one(ttl=100, jitter=0.2)
+        self.assertEqual(policy.expiration(), 90)
+        m_random.uniform.assert_called_once_with(0, 0.2)
+
+    def test_jitter_bounds(self):
+        policy = self._make_one(ttl=100, jitter=0.5)
+        for _ in range(100):
+            self.assertTrue(50 <= policy.expiration() <= 100)
+
+    def test_invalid_jitter(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._make_one, ttl=1, jitter=1)
+
+    def test_jitter_requires_ttl(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._make_one, max_size=10,
+                          jitter=0.1)
+
+    def test_cache_factory_jitter_requires_ttl(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_caching.cache import cache_factory
+        self.assertRaises(ConfigurationError, cache_factory, jitter=0.1)
+
+
+class AcceptsEncodingTests(unittest.TestCase):
+
+    @parameterized.expand([
+        ('gzip', True),
+        ('gzip, deflate', True),
+        ('deflate, GZIP;q=0.5', True),
+        ('gzip;q=0', False),
+        ('*', True),
+        ('*, gzip;q=0', False),
+        ('identity', False),
+        ('gzip;q=invalid', False),
+        ('', False),
+        ])
+    def test_accepts_gzip(self, header, expected):
+        from pyramid_caching.cache import accepts_encoding
+        headers = {'Accept-Encoding': header} if header else {}
+        request = Request.blank('/', headers=headers)
+        self.assertEqual(accepts_encoding(request, 'gzip'), expected)
+
+
+class EntityTagTests(unittest.TestCase):
+
+    def test_encoded_etag(self):
+        from pyramid_caching.cache import encoded_etag
+        self.assertEqual(encoded_etag('abc', None), 'abc')
+        self.assertEqual(encoded_etag('abc', 'gzip'), 'abc-gzip')
+
+    @parameterized.expand([
+        ('plain', '"abc"', 'abc'),
+        ('encoded', '"xyz", "abc-gzip"', 'abc-gzip'),
+        ('any', '*', 'abc'),
+        ('other', '"abcd", "xyz-gzip"', None),
+        ])
+    def test_matching_etag(self, name, header, expected):
+        from pyramid_caching.cache import matching_etag
+        request = Request.blank('/', headers={'If-None-Match': header})
+        self.assertEqual(matching_etag('abc', request.if_none_match),
+                         expected)
+
+
+class SingleFlightTests(unittest.TestCase):
+    def _make_one(self):
+        from pyramid_caching.cache import SingleFlight
+        return SingleFlight()
+
+    def test_leader_gets_value(self):
+        flight = self._make_one()
+        self.assertEqual(flight.run('key', lambda: 42), (True, 42))
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flight = self._make_one()
+        flight.run('key', lambda: 1)
+        self.assertEqual(flight.run('key', lambda: 2), (True, 2))
+
+    def test_follower_gets_none_when_leader_fails(self):
+        flight = self._make_one()
+        started = threading.Event()
+        release = threading.Event()
+        outcomes = []
+
+        def fail():
+            started.set()
+            release.wait()
+            raise ValueError()
+
+        def lead():
+            self.assertRaises(ValueError, flight.run, 'key', fail)
+
+        def follow():
+            outcomes.append(flight.run('key', lambda: 'unused'))
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=follow)
+        follower.start()
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertIn(outcomes, [[(False, None)], [(True, 'unused')]])
+
+    @mock.patch('pyramid_caching.cache._Flight')
+    def test_follower_gives_up_after_timeout(self, m_flight):
+        from pyramid_caching.cache import SingleFlight
+        all_waiting = threading.Event()
+        m_flight.side_effect = lambda: DummyFlight(1, all_waiting)
+        flight = SingleFlight(timeout=0.01)
+        started = threading.Event()
+        release = threading.Event()
+        outcomes = []
+
+        def hang():
+            started.set()
+            all_waiting.wait()
+            release.wait()
+            return 'late'
+
+        leader = threading.Thread(target=flight.run, args=('key', hang))
+        leader.start()
+        started.wait()
+        outcomes.append(flight.run('key', lambda: 'unused'))
+        release.set()
+        leader.join()
+        self.assertEqual(outcomes, [(False, None)])
+
 
 class ViewCacheDecoratorTests(unittest.TestCase):
     def setUp(self):
@@ -81,21 +891,28 @@ class ViewCacheDecoratorTests(unittest.TestCase):
         response = view(None, request)
         self.assertEqual(response.body, "ok")
 
-    def _make_one(self, varies_on=None, depends_on=None, hit=True, fail_with=None):
+    def _make_one(self, varies_on=None, depends_on=None, hit=True, fail_with=None,
+                  stale=False, max_stale=None, response=None):
         from pyramid_caching.cache import ViewCacheDecorator
         request = testing.DummyRequest()
         request.registry.settings['caching.enabled'] = True
         request.scheme = 'https'
-        request.cache_manager = DummyCacheManager(hit=hit, fail_with=fail_with)
+        request.if_none_match = None
+        request.accept_encoding = create_accept_encoding_header(None)
+        request.cache_manager = DummyCacheManager(hit=hit, fail_with=fail_with,
+                                                  stale=stale,
+                                                  response=response)
         return request, ViewCacheDecorator(self._view,
                                            varies_on=varies_on,
-                                           depends_on=depends_on)
+                                           depends_on=depends_on,
+                                           max_stale=max_stale)
 
     def test_key_base_from_view_name(self):
         request, deco = self._make_one()
         deco(None, request)
-        self.assertEqual(request.cache_manager.prefixes,
-                         [__name__, '_view', 'https'])
+        prefixes = request.cache_manager.prefixes
+        self.assertEqual(CacheKey(prefixes, []).root(),
+                         __name__ + ':_view:https')
 
     def test_key_dependencies_from_route(self):
         from pyramid_caching.cache import RouteDependency
@@ -180,6 +997,29 @@ class ViewCacheDecoratorTests(unittest.TestCase):
         response = deco(None, request)
         self.assertEqual(response.headers['X-View-Cache'], 'HIT')
 
+    def test_stale_result_header(self):
+        request, deco = self._make_one(stale=True, max_stale=60)
+        response = deco(None, request)
+        self.assertEqual(response.headers['X-View-Cache'], 'STALE')
+        self.assertEqual(request.cache_manager.max_stale, 60)
+
+    def test_stale_refresh_pushes_threadlocals(self):
+        from pyramid.threadlocal import get_current_request
+        requests = []
+
+        def view(context, request):
+            requests.append(get_current_request())
+            return Response('ok')
+
+        from pyramid_caching.cache import ViewCacheDecorator
+        request, _ = self._make_one(max_stale=60)
+        deco = ViewCacheDecorator(view, max_stale=60)
+        deco(None, request)
+        thread = threading.Thread(target=request.cache_manager.get_result)
+        thread.start()
+        thread.join()
+        self.assertEqual(requests, [request])
+
     def test_cache_disabled_result_header(self):
         from pyramid_caching.cache import ViewCacheDecorator
         request = testing.DummyRequest()
@@ -205,6 +1045,14 @@ class ViewCacheDecoratorTests(unittest.TestCase):
 
         self.assertEqual(len(hit_events), 1)
 
+    def test_cache_stale_event(self):
+        from pyramid_caching.interfaces import ICacheStale
+
+        stale_events = self._register_event_listener(ICacheStale)
+        request, deco = self._make_one(stale=True, max_stale=60)
+        deco(None, request)
+        self.assertEqual(len(stale_events), 1)
+
     def test_cache_miss_event(self):
         from pyramid_caching.interfaces import ICacheMiss
 
@@ -218,26 +1066,237 @@ class ViewCacheDecoratorTests(unittest.TestCase):
         response = deco(None, request)
         self.assertEqual(response.headers['X-View-Cache'], 'DISABLED')
 
+    def test_bypass_cache_on_budget_exceeded(self):
+        from pyramid_caching.interfaces import ICacheBudgetExceeded
+
+        events = self._register_event_listener(ICacheBudgetExceeded)
+        key = DummyKey('key')
+        request, deco = self._make_one(
+            fail_with=CacheBudgetExceeded(key, 0.2, 0.1))
+        response = deco(None, request)
+        self.assertEqual(response.body, 'ok')
+        self.assertEqual(response.headers['X-View-Cache'], 'BUDGET_EXCEEDED')
+        self.assertEqual(len(events), 1)
+        self.assertIs(events[0].cache_key, key)
+
+    def test_view_budget(self):
+        from pyramid_caching.cache import cache_factory
+        request, _ = self._make_one()
+        deco = cache_factory(budget=0.05)(self._view)
+        deco(None, request)
+        self.assertEqual(request.cache_manager.budget, 0.05)
+
     def test_bypass_cache_on_storage_error(self):
         request, deco = self._make_one(fail_with=CacheGetError)
         response = deco(None, request)
         self.assertEqual(response.headers['X-View-Cache'], 'DISABLED')
 
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        from pyramid_caching.interfaces import ICacheHit
+
+        hit_events = self._register_event_listener(ICacheHit)
+        request, deco = self._make_one()
+        request.if_none_match = [hash_key('key')]
+        response = deco(None, request)
+        self.assertIsInstance(response, HTTPNotModified)
+        self.assertEqual(response.headers['X-View-Cache'], 'NOT_MODIFIED')
+        self.assertEqual(response.headers['ETag'], hash_key('key'))
+        self.assertEqual(len(hit_events), 1)
+
+    def test_if_none_match_ignored_on_post(self):
+        request, deco = self._make_one()
+        request.method = 'POST'
+        request.if_none_match = [hash_key('key')]
+        response = deco(None, request)
+        self.assertEqual(response.headers['X-View-Cache'], 'HIT')
+        self.assertIsNone(request.cache_manager.if_none_match)
+
+    def _make_gzip_response(self):
+        from pyramid_caching.serializers import GzipCompressor
+        response = Response(GzipCompressor(1).compress('ok' * 100))
+        response.content_encoding = 'gzip'
+        return response
+
+    def test_compressed_hit_sent_as_is(self):
+        request, deco = self._make_one(response=self._make_gzip_response())
+        request.accept_encoding = create_accept_encoding_header(
+            'gzip, deflate')
+        response = deco(None, request)
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.headers['ETag'], hash_key('key') + '-gzip')
+        self.assertEqual(response.vary, ('Accept-Encoding',))
+
+    def test_compressed_hit_decoded(self):
+        request, deco = self._make_one(response=self._make_gzip_response())
+        request.accept_encoding = create_accept_encoding_header('gzip;q=0')
+        response = deco(None, request)
+        self.assertIsNone(response.content_encoding)
+        self.assertEqual(response.body, 'ok' * 100)
+        self.assertEqual(response.headers['ETag'], hash_key('key'))
+        self.assertEqual(response.vary, ('Accept-Encoding',))
+
+    def test_vary_when_compression_enabled(self):
+        request, deco = self._make_one(hit=False)
+        request.registry.settings['caching.compress.min_size'] = '100'
+        response = deco(None, request)
+        self.assertEqual(response.vary, ('Accept-Encoding',))
+
+    def test_no_vary_without_compression(self):
+        request, deco = self._make_one()
+        response = deco(None, request)
+        self.assertIsNone(response.vary)
+
+    def test_not_modified_encoded(self):
+        request, deco = self._make_one()
+        request.if_none_match = [hash_key('key') + '-gzip']
+        response = deco(None, request)
+        self.assertEqual(response.headers['X-View-Cache'], 'NOT_MODIFIED')
+        self.assertEqual(response.headers['ETag'], hash_key('key') + '-gzip')
+
+    def test_policy(self):
+        from pyramid_caching.cache import cache_factory
+        request, _ = self._make_one()
+        deco = cache_factory(ttl=60, max_size=1000, jitter=0.1)(self._view)
+        deco(None, request)
+        policy = request.cache_manager.policy
+        self.assertEqual((policy.ttl, policy.max_size, policy.jitter),
+                         (60, 1000, 0.1))
+
+    def test_raise_lease_timeout(self):
+        request, deco = self._make_one(fail_with=CacheLeaseTimeout)
+        self.assertRaises(CacheLeaseTimeout, deco, None, request)
+
+
+class DummyFlight(object):
+    """A flight signalling ``all_waiting`` once ``expected`` callers wait."""
+
+    lock = threading.Lock()
+
+    def __init__(self, expected, all_waiting):
+        self.value = None
+        self.expected = expected
+        self.all_waiting = all_waiting
+        self.waiting = 0
+        self._done = threading.Event()
+        self.done = self
+
+    def wait(self, timeout=None):
+        with self.lock:
+            self.waiting += 1
+            if self.waiting == self.expected:
+                self.all_waiting.set()
+        return self._done.wait(timeout)
+
+    def set(self):
+        self._done.set()
+
 
 class DummyVersioner:
     def get_multi_keys(self, dependencies):
         return dependencies
 
+    def identify_all(self, dependencies):
+        return dependencies
+
+    def format_keys(self, versiontuples):
+        return ['%s:v=%s' % (key, version) for key, version in versiontuples]
+
+
+class DictVersioner(DummyVersioner):
+    def __init__(self):
+        self.versions = {}
+
+    def get_multi_keys(self, dependencies):
+        return self.format_keys([(key, self.versions.get(key, 0))
+                                 for key in dependencies])
+
 
 class DummyClient:
+    add_error = None
+    gets = 0
+
     def __init__(self, cached_value):
         self._cached_value = cached_value
 
     def get(self, key):
+        self.gets += 1
         return self._cached_value
 
     def add(self, key, value):
-        pass
+        if self.add_error is not None:
+            raise self.add_error(key)
+
+
+class DummyLeaseClient(DummyClient):
+    def __init__(self, acquired, filled_after=None, free_after=None):
+        DummyClient.__init__(self, None)
+        self._acquire = acquired
+        self._filled_after = filled_after
+        self._free_after = free_after
+        self.acquired = []
+        self.released = []
+
+    def get(self, key):
+        self.gets += 1
+        if self._filled_after is not None and self.gets > self._filled_after:
+            return "filled"
+
+    def acquire_lease(self, key, ttl):
+        self.acquired.append((key, ttl))
+        free = self._free_after is not None and \
+            len(self.acquired) > self._free_after
+        return 'token' if self._acquire or free else None
+
+    def release_lease(self, key, token):
+        self.released.append((key, token))
+
+
+class DictClient:
+    def __init__(self):
+        self.data = {}
+        self.expirations = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def add(self, key, value, expiration=None):
+        if key in self.data:
+            raise CacheKeyAlreadyExists(key)
+        self.data[key] = value
+        self.expirations[key] = expiration
+
+    def set(self, key, value, expiration=None):
+        self.data[key] = value
+        self.expirations[key] = expiration
+
+
+class DictLeaseClient(DictClient):
+    def __init__(self):
+        DictClient.__init__(self)
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def acquire_lease(self, key, ttl):
+        with self.lock:
+            if key in self.leases:
+                return None
+            self.leases[key] = 'token'
+            return 'token'
+
+    def release_lease(self, key, token):
+        with self.lock:
+            if self.leases.get(key) == token:
+                del self.leases[key]
+
+class DummyVersionedCacheClient:
+    def __init__(self, cached_value=None):
+        self._cached_value = cached_value
+        self.calls = []
+
+    def get_versioned(self, root, keys):
+        self.calls.append((root, keys))
+        return [(key, '0') for key in keys], self._cached_value
 
 
 class DummySerializer:
@@ -248,18 +1307,49 @@ class DummySerializer:
         return data
 
 
+class DummyUnsupportedSerializer(DummySerializer):
+    def loads(self, data):
+        return None
+
+
+class DummyResponseSerializer:
+    def loads(self, data):
+        return Response(data)
+
+    def dumps(self, response):
+        return response.body
+
+
+class DummyKey(str):
+    def hash(self):
+        return hash_key(self)
+
+
 class DummyCacheManager:
-    def __init__(self, fail_with=None, hit=True):
+    def __init__(self, fail_with=None, hit=True, stale=False, response=None):
         self.hit = hit
         self.fail_with = fail_with
+        self.stale = stale
+        self.response = response
 
-    def get_or_cache(self, get_result, prefixes, dependencies):
+    def get_or_cache(self, get_result, prefixes, dependencies, max_stale=None,
+                     if_none_match=None, policy=None, budget=None):
         if self.fail_with is not None:
             raise self.fail_with
         self.get_result = get_result
         self.prefixes = prefixes
         self.dependencies = dependencies
+        self.max_stale = max_stale
+        self.if_none_match = if_none_match
+        self.policy = policy
+        self.budget = budget
+        key = DummyKey('key')
+        if if_none_match and matching_etag(key.hash(), if_none_match):
+            return CacheResult.not_modified(key)
+        response = self.response or Response()
+        if self.stale:
+            return CacheResult.stale(key, response, 'stale_key')
         if self.hit:
-            return CacheResult.hit('key', Response())
+            return CacheResult.hit(key, response)
         else:
-            return CacheResult.miss('key', Response())
+            return CacheResult.miss(key, response)
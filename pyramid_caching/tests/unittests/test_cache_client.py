@@ -8,9 +8,10 @@ from pyramid_caching.exc import (
     CacheKeyAlreadyExists,
     CacheAddError,
     CacheGetError,
+    CacheLeaseError,
     )
 
-from redis import RedisError
+from redis import RedisError, StrictRedis
 
 
 class MockClient(object):
@@ -111,3 +112,222 @@ class TestCacheClient(unittest.TestCase):
 
         with self.assertRaises(CacheGetError):
             cache.get('FOO')
+
+
+class TestCacheSet(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock(name='RedisClient')
+        self.cache = RedisCacheWrapper(self.client)
+
+    def test_set(self):
+        self.cache.set('FOO', 'BAR')
+        self.client.set.assert_called_once_with('FOO', 'BAR', ex=3600 * 24 * 7)
+
+    def test_set_with_expiration(self):
+        self.cache.set('FOO', 'BAR', expiration=42)
+        self.client.set.assert_called_once_with('FOO', 'BAR', ex=42)
+
+    def test_set_network_error(self):
+        self.client.set.side_effect = RedisError()
+
+        with self.assertRaises(CacheAddError):
+            self.cache.set('FOO', 'BAR')
+
+
+class TestCacheLease(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock(name='RedisClient')
+        self.cache = RedisCacheWrapper(self.client)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from pyramid_caching.interfaces import ICacheLeaseClient
+
+        self.assertTrue(verifyObject(ICacheLeaseClient, self.cache))
+
+    def test_acquire_lease(self):
+        self.client.set.return_value = True
+
+        token = self.cache.acquire_lease('FOO', 1.5)
+
+        self.assertIsNotNone(token)
+        self.client.set.assert_called_once_with('lease:FOO', token,
+                                                px=1500, nx=True)
+
+    def test_acquire_held_lease(self):
+        self.client.set.return_value = None
+
+        self.assertIsNone(self.cache.acquire_lease('FOO', 1))
+
+    def test_acquire_lease_network_error(self):
+        self.client.set.side_effect = RedisError()
+
+        with self.assertRaises(CacheLeaseError):
+            self.cache.acquire_lease('FOO', 1)
+
+    def test_release_lease(self):
+        script = self.client.register_script.return_value
+
+        self.cache.release_lease('FOO', 'token')
+
+        script.assert_called_once_with(keys=['lease:FOO'], args=['token'])
+
+    def test_release_lease_network_error(self):
+        self.client.register_script.return_value.side_effect = RedisError()
+
+        with self.assertRaises(CacheLeaseError):
+            self.cache.release_lease('FOO', 'token')
+
+
+class TestRedisCacheLease(unittest.TestCase):
+
+    def setUp(self):
+        from redis import StrictRedis
+        self.cache = RedisCacheWrapper(StrictRedis(db=5))
+        self.cache.flush_all()
+        self.addCleanup(self.cache.flush_all)
+
+    def test_single_holder(self):
+        token = self.cache.acquire_lease('FOO', 10)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.cache.acquire_lease('FOO', 10))
+
+        self.cache.release_lease('FOO', token)
+        self.assertIsNotNone(self.cache.acquire_lease('FOO', 10))
+
+    def test_release_with_stale_token(self):
+        self.cache.acquire_lease('FOO', 10)
+
+        self.cache.release_lease('FOO', 'expired-token')
+        self.assertIsNone(self.cache.acquire_lease('FOO', 10))
+
+
+class TestIncludeCacheStore(unittest.TestCase):
+
+    def _include(self, uri, settings=None):
+        from pyramid_caching.ext.redis import include_cache_store
+        config = mock.Mock(name='config')
+        config.registry.settings = settings or {}
+        with mock.patch.dict('os.environ', {'CACHE_STORE_REDIS_URI': uri}):
+            return include_cache_store(config)
+
+    def test_single_uri(self):
+        store = self._include('redis://127.0.0.1:6379/5')
+        self.assertIsInstance(store, RedisCacheWrapper)
+
+    def test_sharded(self):
+        from pyramid_caching.sharding import ShardedCacheClient
+        store = self._include(
+            'redis://127.0.0.1:6379/5, redis://127.0.0.1:6380/5',
+            {'caching.redis.shard_retry_interval': '10'})
+        self.assertIsInstance(store, ShardedCacheClient)
+        self.assertEqual(sorted(store.shards),
+                         ['127.0.0.1:6379/5', '127.0.0.1:6380/5'])
+        self.assertEqual(store.retry_interval, 10)
+
+    def test_same_database_twice(self):
+        from pyramid.exceptions import ConfigurationError
+        with self.assertRaises(ConfigurationError):
+            self._include('redis://127.0.0.1/5 redis://127.0.0.1:6379/5')
+
+
+class TestRedisClient(unittest.TestCase):
+
+    def test_defaults(self):
+        from redis import ConnectionPool
+        from pyramid_caching.ext.redis import redis_client
+        client = redis_client('redis://127.0.0.1:6379/5', {})
+        self.assertIs(type(client.connection_pool), ConnectionPool)
+        self.assertIsNone(
+            client.connection_pool.connection_kwargs.get('socket_timeout'))
+
+    def test_settings(self):
+        from redis import BlockingConnectionPool
+        from pyramid_caching.ext.redis import redis_client
+        client = redis_client('redis://127.0.0.1:6379/5', {
+            'caching.redis.max_connections': '8',
+            'caching.redis.pool_timeout': '0.5',
+            'caching.redis.socket_timeout': '0.2',
+            'caching.redis.socket_connect_timeout': '0.1',
+            'caching.redis.socket_keepalive': 'true',
+            })
+        pool = client.connection_pool
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 8)
+        self.assertEqual(pool.timeout, 0.5)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 0.2)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'],
+                         0.1)
+        self.assertIs(pool.connection_kwargs['socket_keepalive'], True)
+
+    def test_unix_socket(self):
+        from pyramid_caching.ext.redis import redis_client
+        client = redis_client('unix:///tmp/redis.sock?db=5', {
+            'caching.redis.socket_timeout': '0.2',
+            'caching.redis.socket_keepalive': 'true',
+            })
+        kwargs = client.connection_pool.connection_kwargs
+        self.assertEqual(kwargs['path'], '/tmp/redis.sock')
+        self.assertEqual(kwargs['socket_timeout'], 0.2)
+        self.assertNotIn('socket_keepalive', kwargs)
+
+    def test_pubsub_without_timeout(self):
+        from pyramid_caching.ext.redis import redis_client
+        client = redis_client('redis://127.0.0.1:6379/5', {
+            'caching.redis.socket_timeout': '0.2',
+            }, pubsub=True)
+        self.assertNotIn('socket_timeout',
+                         client.connection_pool.connection_kwargs)
+
+
+class TestPrewarm(unittest.TestCase):
+
+    def test_prewarm_pools(self):
+        from pyramid.registry import Registry
+        from pyramid_caching.ext.redis import prewarm, RedisVersionWrapper
+        from pyramid_caching.interfaces import ICacheClient, IKeyVersioner
+        from pyramid_caching.sharding import ShardedCacheClient
+        cache_clients = [StrictRedis(db=5), StrictRedis(db=6)]
+        version_client = StrictRedis(db=8)
+        registry = Registry()
+        registry.registerUtility(
+            ShardedCacheClient(dict(
+                (str(i), RedisCacheWrapper(client))
+                for i, client in enumerate(cache_clients))),
+            ICacheClient)
+        registry.registerUtility(RedisVersionWrapper(version_client),
+                                 IKeyVersioner)
+
+        prewarm(registry, 3)
+
+        for client in cache_clients + [version_client]:
+            connections = client.connection_pool._available_connections
+            self.assertEqual(len(connections), 3)
+            self.assertTrue(all(c._sock is not None for c in connections))
+
+    def test_prewarm_failure_is_logged(self):
+        from pyramid_caching.ext.redis import _prewarm_pool
+        pool = mock.Mock(max_connections=10)
+        pool.get_connection.return_value.connect.side_effect = RedisError()
+        with mock.patch('pyramid_caching.ext.redis.log') as m_log:
+            _prewarm_pool(pool, 2)
+        self.assertTrue(m_log.warning.called)
+        self.assertEqual(pool.release.call_count, 1)
+
+    def test_subscriber(self):
+        from pyramid.events import ApplicationCreated
+        from pyramid_caching.ext.redis import includeme
+        config = mock.Mock(name='config')
+        config.registry.settings = {'caching.enabled': True,
+                                    'caching.redis.prewarm': '2'}
+        with mock.patch.dict('os.environ', {
+                'CACHE_STORE_REDIS_URI': 'redis://127.0.0.1:6379/5',
+                'VERSION_STORE_REDIS_URI': 'redis://127.0.0.1:6379/8'}):
+            includeme(config)
+        subscriber, event_type = config.add_subscriber.call_args[0]
+        self.assertIs(event_type, ApplicationCreated)
+        with mock.patch('pyramid_caching.ext.redis.prewarm') as m_prewarm:
+            subscriber(mock.Mock(name='event'))
+        self.assertEqual(m_prewarm.call_args[0][1], 2)
@@ -49,5 +49,51 @@ class ViewCacheMissEventTests(unittest.TestCase):
         self.assertEqual(event.cache_key, key)
 
 
+class ViewCacheStaleEventTests(unittest.TestCase):
+    def test_class_implements_interface(self):
+        from pyramid_caching.events import ViewCacheStale
+        from pyramid_caching.interfaces import ICacheStale
+        from zope.interface.verify import verifyClass
+        verifyClass(ICacheStale, ViewCacheStale)
+
+    def test_attributes(self):
+        from pyramid_caching.events import ViewCacheStale
+        key = object()
+        request = DummyRequest()
+        event = ViewCacheStale(key, request)
+        self.assertEqual(event.request, request)
+        self.assertEqual(event.cache_key, key)
+
+
+
+class ViewCacheBudgetExceededEventTests(unittest.TestCase):
+    def test_class_implements_interface(self):
+        from pyramid_caching.events import ViewCacheBudgetExceeded
+        from pyramid_caching.interfaces import ICacheBudgetExceeded
+        from zope.interface.verify import verifyClass
+        verifyClass(ICacheBudgetExceeded, ViewCacheBudgetExceeded)
+
+    def test_attributes(self):
+        from pyramid_caching.events import ViewCacheBudgetExceeded
+        key = object()
+        request = DummyRequest()
+        event = ViewCacheBudgetExceeded(key, request)
+        self.assertEqual(event.request, request)
+        self.assertEqual(event.cache_key, key)
+
+
+class CircuitBreakerStateChangedEventTests(unittest.TestCase):
+    def test_instance_implements_interface(self):
+        from pyramid_caching.events import CircuitBreakerStateChanged
+        from pyramid_caching.interfaces import ICircuitBreakerStateChanged
+        from zope.interface.verify import verifyObject
+        breaker = object()
+        event = CircuitBreakerStateChanged(breaker, 'open', 'closed')
+        verifyObject(ICircuitBreakerStateChanged, event)
+        self.assertIs(event.breaker, breaker)
+        self.assertEqual(event.state, 'open')
+        self.assertEqual(event.previous_state, 'closed')
+
+
 class DummyRequest:
     pass
@@ -1,17 +1,24 @@
+import time
 import unittest
 
 import mock
 from nose_parameterized import parameterized
 
-from pyramid_caching.ext.redis import RedisVersionWrapper
+from pyramid_caching.ext.memory import MemoryVersionStore
+from pyramid_caching.ext.redis import (
+    RedisVersionWrapper,
+    VersionNearCache,
+    VersionReplicas,
+    )
 from pyramid_caching.exc import (
     VersionGetError,
     VersionMasterVersionError,
     VersionIncrementError,
+    VersionMultiIncrementError,
     CacheDisabled,
 )
 
-from redis import (StrictRedis, RedisError)
+from redis import (StrictRedis, RedisError, ResponseError)
 
 
 def get_redis():
@@ -20,6 +27,7 @@ def get_redis():
 
 KEY_VERSIONERS = [
     ("redis", get_redis, '0'),
+    ("memory", MemoryVersionStore, '0'),
 ]
 
 
@@ -40,9 +48,12 @@ class TestKeyVersioner(unittest.TestCase):
         self.assertTrue(verifyObject(IKeyVersioner, key_versioner))
 
     @parameterized.expand(KEY_VERSIONERS)
+    @mock.patch('pyramid_caching.ext.memory.time')
     @mock.patch('pyramid_caching.ext.redis.time')
-    def test_get_multi(self, name, get_key_versioner, default_value, m_time):
+    def test_get_multi(self, name, get_key_versioner, default_value, m_time,
+                       m_memory_time):
         m_time.time.return_value = 1234.123
+        m_memory_time.time.return_value = 1234.123
         key_versioner = get_key_versioner()
 
         KEYS = ['FOO', 'BAR', '2000']
@@ -70,6 +81,17 @@ class TestKeyVersioner(unittest.TestCase):
         self.assertEqual(key_versioner.get_multi(KEYS), VERSIONS)
         self.assertEqual(key_versioner.get_multi(KEYS), VERSIONS)
 
+    @parameterized.expand(KEY_VERSIONERS)
+    def test_incr_multi(self, name, get_key_versioner, default_value):
+        key_versioner = get_key_versioner()
+
+        key_versioner.incr_multi(['FOO', 'BAR'])
+        key_versioner.incr_multi(['BAR'])
+
+        versions = key_versioner.get_multi(['FOO', 'BAR', 'BAZ'])[1:]
+        self.assertEqual(versions,
+                         [('FOO', '1'), ('BAR', '2'), ('BAZ', default_value)])
+
 
 class TestRedisVersionClient(unittest.TestCase):
     """Test specifics of Redis client"""
@@ -155,8 +177,347 @@ class TestRedisVersionClient(unittest.TestCase):
         with self.assertRaises(VersionIncrementError):
             self.version_store.incr('FOO')
 
+    def test_incr_multi_pipeline(self):
+        pipeline = self.redis_client.pipeline.return_value
+        pipeline.execute.return_value = [1, 2]
+
+        self.version_store.incr_multi(['FOO', 'BAR'])
+
+        self.redis_client.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipeline.incr.call_args_list,
+                         [mock.call('FOO'), mock.call('BAR')])
+        pipeline.execute.assert_called_once_with(raise_on_error=False)
+
+    def test_incr_multi_partial_failure(self):
+        pipeline = self.redis_client.pipeline.return_value
+        error = ResponseError('not an integer')
+        pipeline.execute.return_value = [1, error]
+
+        with self.assertRaises(VersionMultiIncrementError) as context:
+            self.version_store.incr_multi(['FOO', 'BAR'])
+
+        self.assertEqual(context.exception.failures, {'BAR': error})
+
+    def test_incr_multi_redis_error(self):
+        pipeline = self.redis_client.pipeline.return_value
+        pipeline.execute.side_effect = RedisError()
+
+        with self.assertRaises(VersionIncrementError):
+            self.version_store.incr_multi(['FOO'])
+
     def test_inhibit_caching(self):
         self.redis_client.mget.return_value = ['off']
 
         with self.assertRaises(CacheDisabled):
             self.version_store.get_multi([])
+
+
+class TestRedisVersionClientChannel(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_client = mock.Mock(name='StrictRedis')
+        self.pipeline = self.redis_client.pipeline.return_value
+        self.version_store = RedisVersionWrapper(self.redis_client,
+                                                 channel='versions')
+
+    def test_incr_multi_publishes(self):
+        self.pipeline.execute.return_value = [1, 1, 0, 0]
+
+        self.version_store.incr_multi(['FOO', 'BAR'])
+
+        self.assertEqual(self.pipeline.publish.call_args_list,
+                         [mock.call('versions', 'FOO'),
+                          mock.call('versions', 'BAR')])
+
+    def test_incr_publishes(self):
+        self.version_store.incr('FOO')
+
+        self.pipeline.incr.assert_called_once_with('FOO')
+        self.pipeline.publish.assert_called_once_with('versions', 'FOO')
+        self.pipeline.execute.assert_called_once_with()
+        self.assertFalse(self.redis_client.incr.called)
+
+    def test_incr_redis_error(self):
+        self.pipeline.execute.side_effect = RedisError()
+
+        with self.assertRaises(VersionIncrementError):
+            self.version_store.incr('FOO')
+
+
+class TestVersionNearCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = VersionNearCache(mock.Mock(name='StrictRedis'), 10)
+
+    def test_get_multi_missing(self):
+        self.assertIsNone(self.cache.get_multi(['cache']))
+
+    def test_get_multi(self):
+        self.cache.update(['cache', 'FOO'], ['1', '2'], 0)
+        self.assertEqual(self.cache.get_multi(['FOO', 'cache']), ['2', '1'])
+
+    def test_get_multi_partial(self):
+        self.cache.update(['cache'], ['1'], 0)
+        self.assertIsNone(self.cache.get_multi(['cache', 'FOO']))
+
+    @mock.patch('pyramid_caching.ext.redis.time')
+    def test_max_age(self, m_time):
+        m_time.time.return_value = 100
+        self.cache.update(['cache'], ['1'], 0)
+        m_time.time.return_value = 111
+        self.assertIsNone(self.cache.get_multi(['cache']))
+
+    def test_bounded_size(self):
+        cache = VersionNearCache(mock.Mock(name='StrictRedis'), 10,
+                                 max_size=100)
+        for i in range(100):
+            cache.update(['KEY%02d' % i], ['1'], 0)
+        self.assertLessEqual(cache._versions.size, 100)
+        self.assertIsNone(cache.get_multi(['KEY00']))
+        self.assertEqual(cache.get_multi(['KEY99']), ['1'])
+
+    @mock.patch('pyramid_caching.ext.redis.time')
+    def test_expired_entries_are_dropped(self, m_time):
+        m_time.time.return_value = 100
+        self.cache.update(['cache'], ['1'], 0)
+        m_time.time.return_value = 111
+        self.cache.get_multi(['cache'])
+        self.assertEqual(len(self.cache._versions), 0)
+
+    def test_invalidate(self):
+        self.cache.update(['cache', 'FOO'], ['1', '2'], 0)
+        self.cache.invalidate('FOO')
+        self.assertIsNone(self.cache.get_multi(['FOO']))
+        self.assertEqual(self.cache.get_multi(['cache']), ['1'])
+
+    def test_update_after_invalidation_is_discarded(self):
+        generation = self.cache.generation
+        self.cache.invalidate('FOO')
+        self.cache.update(['FOO'], ['1'], generation)
+        self.assertIsNone(self.cache.get_multi(['FOO']))
+
+    def test_messages(self):
+        self.cache.update(['FOO', 'BAR'], ['1', '2'], 0)
+        self.cache._handle_message({'type': 'message', 'data': 'FOO'})
+        self.assertIsNone(self.cache.get_multi(['FOO']))
+        self.assertEqual(self.cache.get_multi(['BAR']), ['2'])
+
+        self.cache._handle_message({'type': 'subscribe', 'data': 1})
+        self.assertTrue(self.cache.connected)
+        self.assertIsNone(self.cache.get_multi(['BAR']))
+
+
+class TestRedisVersionClientNearCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_client = mock.Mock(name='StrictRedis')
+        self.near_cache = VersionNearCache(self.redis_client, 10)
+        self.version_store = RedisVersionWrapper(self.redis_client,
+                                                 near_cache=self.near_cache)
+
+    def test_get_multi_uses_near_cache(self):
+        self.redis_client.mget.return_value = ['42', '1']
+
+        self.version_store.get_multi(['FOO'])
+        versions = self.version_store.get_multi(['FOO'])
+
+        self.assertEqual(versions, [('cache', '42'), ('FOO', '1')])
+        self.assertEqual(self.redis_client.mget.call_count, 1)
+
+    def test_no_master_version_is_not_kept(self):
+        self.redis_client.mget.return_value = [None, '1']
+        self.redis_client.get.return_value = '42'
+
+        self.version_store.get_multi(['FOO'])
+
+        self.assertIsNone(self.near_cache.get_multi(['cache']))
+
+    def test_incr_invalidates_near_cache(self):
+        self.redis_client.mget.return_value = ['42', '1', '1']
+        self.version_store.get_multi(['FOO', 'BAR'])
+
+        self.version_store.incr('FOO')
+
+        self.assertIsNone(self.near_cache.get_multi(['FOO']))
+        self.assertEqual(self.near_cache.get_multi(['BAR']), ['1'])
+
+    def test_incr_multi_invalidates_near_cache(self):
+        self.redis_client.mget.return_value = ['42', '1', '2']
+        self.version_store.get_multi(['FOO', 'BAR'])
+        pipeline = self.redis_client.pipeline.return_value
+        pipeline.execute.return_value = [2, 3]
+
+        self.version_store.incr_multi(['FOO', 'BAR'])
+
+        self.assertIsNone(self.near_cache.get_multi(['FOO']))
+        self.assertIsNone(self.near_cache.get_multi(['BAR']))
+        self.assertEqual(self.near_cache.get_multi(['cache']), ['42'])
+
+    def test_failed_incr_invalidates_near_cache(self):
+        self.redis_client.mget.return_value = ['42', '1']
+        self.version_store.get_multi(['FOO'])
+        self.redis_client.incr.side_effect = RedisError()
+
+        with self.assertRaises(VersionIncrementError):
+            self.version_store.incr('FOO')
+
+        self.assertIsNone(self.near_cache.get_multi(['FOO']))
+
+
+def replica_info(**info):
+    replication = {'role': 'slave', 'master_link_status': 'up',
+                   'master_last_io_seconds_ago': 1}
+    replication.update(info)
+    return replication
+
+
+class TestVersionReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.replica1 = mock.Mock(name='Replica1')
+        self.replica2 = mock.Mock(name='Replica2')
+        for replica in (self.replica1, self.replica2):
+            replica.info.return_value = replica_info()
+        self.replicas = VersionReplicas([self.replica1, self.replica2],
+                                        max_lag=5, check_interval=1)
+
+    def test_round_robin(self):
+        self.assertIs(self.replicas.choose(), self.replica1)
+        self.assertIs(self.replicas.choose(), self.replica2)
+        self.assertIs(self.replicas.choose(), self.replica1)
+
+    @parameterized.expand([
+        ('lagging', {'master_last_io_seconds_ago': 6}),
+        ('link_down', {'master_link_status': 'down',
+                       'master_last_io_seconds_ago': -1}),
+        ('primary', {'role': 'master'}),
+        ])
+    def test_unhealthy(self, name, info):
+        self.replica1.info.return_value = replica_info(**info)
+        self.assertIs(self.replicas.choose(), self.replica2)
+        self.assertIs(self.replicas.choose(), self.replica2)
+
+    def test_info_error(self):
+        self.replica1.info.side_effect = RedisError()
+        self.replica2.info.side_effect = RedisError()
+        self.assertIsNone(self.replicas.choose())
+
+    @mock.patch('pyramid_caching.ext.redis.time')
+    def test_health_checked_every_interval(self, m_time):
+        m_time.time.return_value = 1000
+        self.replicas.is_healthy(self.replica1)
+        self.replicas.is_healthy(self.replica1)
+        self.assertEqual(self.replica1.info.call_count, 1)
+        m_time.time.return_value = 1001
+        self.replicas.is_healthy(self.replica1)
+        self.assertEqual(self.replica1.info.call_count, 2)
+
+    def test_mark_failed(self):
+        self.replicas.mark_failed(self.replica1)
+        self.assertFalse(self.replicas.is_healthy(self.replica1))
+
+
+class TestRedisVersionClientReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = mock.Mock(name='Primary')
+        self.replica = mock.Mock(name='Replica')
+        self.replica.info.return_value = replica_info()
+        self.replicas = VersionReplicas([self.replica], max_lag=5)
+        self.version_store = RedisVersionWrapper(self.primary,
+                                                 replicas=self.replicas)
+
+    def test_read_from_replica(self):
+        self.replica.mget.return_value = ['42', '1']
+        versions = self.version_store.get_multi(['FOO'])
+        self.assertEqual(versions, [('cache', '42'), ('FOO', '1')])
+        self.assertFalse(self.primary.mget.called)
+
+    def test_unhealthy_replica(self):
+        self.replica.info.return_value = replica_info(
+            master_last_io_seconds_ago=6)
+        self.primary.mget.return_value = ['42', '1']
+        self.version_store.get_multi(['FOO'])
+        self.assertFalse(self.replica.mget.called)
+
+    def test_replica_error(self):
+        self.replica.mget.side_effect = RedisError()
+        self.primary.mget.return_value = ['42', '1']
+        versions = self.version_store.get_multi(['FOO'])
+        self.assertEqual(versions, [('cache', '42'), ('FOO', '1')])
+        self.assertFalse(self.replicas.is_healthy(self.replica))
+
+    def test_master_version_initialized_on_primary(self):
+        self.replica.mget.return_value = [None, '1']
+        self.primary.mget.return_value = [None, '1']
+        self.primary.get.return_value = '42'
+        versions = self.version_store.get_multi(['FOO'])
+        self.assertEqual(versions, [('cache', '42'), ('FOO', '1')])
+        self.assertTrue(self.primary.set.called)
+        self.assertFalse(self.replica.set.called)
+
+    def test_read_your_writes(self):
+        self.primary.mget.return_value = ['42', '2']
+        self.version_store.incr('FOO')
+        self.assertEqual(self.version_store.get_multi(['FOO'])[1],
+                         ('FOO', '2'))
+        self.assertFalse(self.replica.mget.called)
+
+    def test_pinned_to_thread(self):
+        import threading
+        self.replica.mget.return_value = ['42', '1']
+        self.primary.pipeline.return_value.execute.return_value = [1]
+        self.version_store.incr_multi(['FOO'])
+        thread = threading.Thread(target=self.version_store.get_multi,
+                                  args=(['FOO'],))
+        thread.start()
+        thread.join()
+        self.assertTrue(self.replica.mget.called)
+
+    @mock.patch('pyramid_caching.ext.redis.time')
+    def test_pin_expires(self, m_time):
+        m_time.time.return_value = 1000
+        self.version_store.incr('FOO')
+        m_time.time.return_value = 1006
+        self.replica.mget.return_value = ['42', '1']
+        self.version_store.get_multi(['FOO'])
+        self.assertTrue(self.replica.mget.called)
+
+    def test_primary_after_near_cache_invalidation(self):
+        near_cache = VersionNearCache(self.primary, 10)
+        self.version_store.near_cache = near_cache
+        near_cache.invalidate('FOO')
+        self.primary.mget.return_value = ['42', '1']
+        self.version_store.get_multi(['FOO'])
+        self.assertFalse(self.replica.mget.called)
+
+
+class TestRedisVersionInvalidation(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StrictRedis(db=8)
+        self.near_cache = VersionNearCache(self.client, 60,
+                                           channel='test-versions')
+        self.version_store = RedisVersionWrapper(self.client,
+                                                 channel='test-versions',
+                                                 near_cache=self.near_cache)
+        self.writer = RedisVersionWrapper(self.client,
+                                          channel='test-versions')
+        self.version_store.flush_all()
+        self.addCleanup(self.version_store.flush_all)
+        self.version_store.get_multi(['FOO'])
+        deadline = time.time() + 2
+        while not self.near_cache.connected and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_incr_from_another_process_invalidates(self):
+        self.assertEqual(self.version_store.get_multi(['FOO'])[1],
+                         ('FOO', '0'))
+        self.writer.incr('FOO')
+        deadline = time.time() + 2
+        while (self.near_cache.get_multi(['FOO']) is not None and
+               time.time() < deadline):
+            time.sleep(0.01)
+
+        self.assertEqual(self.version_store.get_multi(['FOO'])[1],
+                         ('FOO', '1'))
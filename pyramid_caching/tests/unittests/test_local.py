@@ -0,0 +1,159 @@
+import unittest
+
+from zope.interface import implementer
+
+from pyramid_caching.exc import CacheKeyAlreadyExists
+from pyramid_caching.interfaces import ICacheClient, ICacheLeaseClient
+from pyramid_caching.local import copy_result, LocalCacheClient, LRUCache
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_get_missing(self):
+        self.assertIsNone(LRUCache(10).get('a'))
+
+    def test_put_get(self):
+        cache = LRUCache(10)
+        cache.put('a', 'A', 1)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.size, 1)
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(10)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 4)
+        cache.get('a')
+        cache.put('c', 'C', 4)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(cache.size, 8)
+
+    def test_replace_updates_size(self):
+        cache = LRUCache(10)
+        cache.put('a', 'A', 4)
+        cache.put('a', 'AA', 6)
+        self.assertEqual(cache.size, 6)
+        self.assertEqual(len(cache), 1)
+
+    def test_skip_oversized(self):
+        cache = LRUCache(10)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 11)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+
+    def test_discard(self):
+        cache = LRUCache(10)
+        cache.put('a', 'A', 4)
+        cache.discard('a')
+        cache.discard('b')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+
+    def test_clear(self):
+        cache = LRUCache(10)
+        cache.put('a', 'A', 4)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+class LocalCacheClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.client = DummyClient()
+        self.local = LocalCacheClient(self.client, 100,
+                                      mutable_prefixes=['stale:'])
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        self.assertTrue(verifyObject(ICacheClient, self.local))
+
+    def test_provides_wrapped_client_interfaces(self):
+        self.assertTrue(ICacheLeaseClient.providedBy(self.local))
+        self.assertEqual(self.local.acquire_lease('key', 1), 'token')
+
+    def test_get_keeps_local_copy(self):
+        self.client.data['key'] = 'value'
+        self.assertEqual(self.local.get('key'), 'value')
+        self.assertEqual(self.local.get('key'), 'value')
+        self.assertEqual(self.client.gets, 1)
+
+    def test_get_missing_is_not_kept(self):
+        self.assertIsNone(self.local.get('key'))
+        self.client.data['key'] = 'value'
+        self.assertEqual(self.local.get('key'), 'value')
+
+    def test_add_keeps_local_copy(self):
+        self.local.add('key', 'value')
+        self.assertEqual(self.local.get('key'), 'value')
+        self.assertEqual(self.client.gets, 0)
+
+    def test_add_existing(self):
+        self.client.data['key'] = 'value'
+        with self.assertRaises(CacheKeyAlreadyExists):
+            self.local.add('key', 'other')
+        self.assertEqual(len(self.local.local), 0)
+
+    def test_mutable_keys_are_not_kept(self):
+        self.client.data['stale:key'] = 'v1'
+        self.local.get('stale:key')
+        self.client.data['stale:key'] = 'v2'
+        self.assertEqual(self.local.get('stale:key'), 'v2')
+
+    def test_set_replaces_local_copy(self):
+        self.local.add('key', 'v1')
+        self.local.set('key', 'v2')
+        self.assertEqual(self.local.get('key'), 'v2')
+
+    def test_flush_all(self):
+        self.local.add('key', 'value')
+        self.local.flush_all()
+        self.assertIsNone(self.local.get('key'))
+
+
+class CopyResultTests(unittest.TestCase):
+
+    def test_copy_response(self):
+        from pyramid.response import Response
+        response = Response('ok')
+        copied = copy_result(response)
+        copied.headers['X-View-Cache'] = 'HIT'
+        self.assertEqual(copied.body, 'ok')
+        self.assertNotIn('X-View-Cache', response.headers)
+
+    def test_deepcopy(self):
+        data = {'a': [1]}
+        copied = copy_result(data)
+        copied['a'].append(2)
+        self.assertEqual(data, {'a': [1]})
+
+
+@implementer(ICacheLeaseClient)
+class DummyClient(object):
+
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.data.get(key)
+
+    def add(self, key, value, expiration=None):
+        if key in self.data:
+            raise CacheKeyAlreadyExists(key)
+        self.data[key] = value
+
+    def set(self, key, value, expiration=None):
+        self.data[key] = value
+
+    def acquire_lease(self, key, ttl):
+        return 'token'
+
+    def release_lease(self, key, token):
+        pass
+
+    def flush_all(self):
+        self.data.clear()
@@ -0,0 +1,180 @@
+import threading
+import unittest
+
+import mock
+from pyramid.response import Response
+from zope.interface.verify import verifyObject
+
+from pyramid_caching.exc import CacheDisabled, CacheKeyAlreadyExists
+from pyramid_caching.ext.memory import MemoryCacheClient, MemoryVersionStore
+from pyramid_caching.interfaces import (
+    ICacheClient,
+    ICacheLeaseClient,
+    IKeyVersioner,
+    )
+
+
+class TestMemoryCacheClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MemoryCacheClient(1000)
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(ICacheLeaseClient, self.client))
+
+    def test_add_get(self):
+        self.assertIsNone(self.client.get('key'))
+        self.client.add('key', 'value')
+        self.assertEqual(self.client.get('key'), 'value')
+
+    def test_add_existing(self):
+        self.client.add('key', 'value')
+        with self.assertRaises(CacheKeyAlreadyExists):
+            self.client.add('key', 'other')
+        self.assertEqual(self.client.get('key'), 'value')
+
+    def test_set(self):
+        self.client.add('key', 'value')
+        self.client.set('key', 'other')
+        self.assertEqual(self.client.get('key'), 'other')
+
+    @mock.patch('pyramid_caching.ext.memory.time')
+    def test_expiration(self, m_time):
+        m_time.time.return_value = 1000
+        self.client.add('key', 'value', expiration=10)
+        self.client.add('other', 'value')
+        m_time.time.return_value = 1010
+        self.assertIsNone(self.client.get('key'))
+        self.assertEqual(self.client.get('other'), 'value')
+        self.client.add('key', 'new')
+        self.assertEqual(self.client.get('key'), 'new')
+
+    def test_bounded_size(self):
+        for i in range(100):
+            self.client.add('key%02d' % i, 'x' * 95)
+        self.assertLessEqual(self.client.entries.size, 1000)
+        self.assertIsNone(self.client.get('key00'))
+        self.assertEqual(self.client.get('key99'), 'x' * 95)
+
+    @mock.patch('pyramid_caching.ext.memory.time')
+    def test_leases(self, m_time):
+        m_time.time.return_value = 1000
+        token = self.client.acquire_lease('key', 5)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.client.acquire_lease('key', 5))
+        self.client.release_lease('key', 'other')
+        self.assertIsNone(self.client.acquire_lease('key', 5))
+        self.client.release_lease('key', token)
+        self.assertIsNotNone(self.client.acquire_lease('key', 5))
+        m_time.time.return_value = 1005
+        self.assertIsNotNone(self.client.acquire_lease('key', 5))
+
+    def test_concurrent_add(self):
+        errors = []
+
+        def add():
+            try:
+                self.client.add('key', 'value')
+            except CacheKeyAlreadyExists:
+                errors.append(True)
+
+        threads = [threading.Thread(target=add) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 9)
+
+    def test_flush_all(self):
+        self.client.add('key', 'value')
+        self.client.flush_all()
+        self.assertIsNone(self.client.get('key'))
+
+
+class TestMemoryVersionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryVersionStore(max_versions=3)
+
+    def _versions(self, keys):
+        return dict(self.store.get_multi(keys))
+
+    @mock.patch('pyramid_caching.ext.memory.time')
+    def test_master_version_changes_on_flush(self, m_time):
+        m_time.time.return_value = 1000
+        self.store.incr('a')
+        self.assertEqual(self.store.get_multi(['a']),
+                         [('cache', '1000'), ('a', '1')])
+        self.store.flush_all()
+        self.assertEqual(self.store.get_multi(['a']),
+                         [('cache', '1001'), ('a', '0')])
+
+    @mock.patch('pyramid_caching.ext.memory.time')
+    def test_overflow_resets_master_version(self, m_time):
+        m_time.time.return_value = 1000
+        self.store.incr_multi(['a', 'b', 'c'])
+        self.assertEqual(self._versions(['a'])['cache'], '1000')
+        self.store.incr('d')
+        versions = self._versions(['a', 'd'])
+        self.assertEqual(versions, {'cache': '1001', 'a': '0', 'd': '0'})
+
+    def test_disable(self):
+        self.store.incr('a')
+        master_version = self._versions([])['cache']
+        self.store.disable()
+        with self.assertRaises(CacheDisabled):
+            self.store.get_multi(['a'])
+        self.store.incr('a')
+        self.store.enable()
+        versions = self._versions(['a'])
+        self.assertNotEqual(versions['cache'], master_version)
+        self.assertEqual(versions['a'], '2')
+
+    def test_concurrent_increments(self):
+        store = MemoryVersionStore()
+
+        def incr():
+            for _ in range(100):
+                store.incr('a')
+
+        threads = [threading.Thread(target=incr) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dict(store.get_multi(['a']))['a'], '1000')
+
+
+class TestIncludeme(unittest.TestCase):
+
+    def test_include(self):
+        from pyramid.config import Configurator
+        config = Configurator(settings={
+            'caching.memory.max_size': '2048',
+            'caching.memory.max_versions': '10',
+            })
+        config.include('pyramid_caching')
+        config.include('pyramid_caching.ext.memory')
+        config.commit()
+        registry = config.registry
+        cache_client = registry.getUtility(ICacheClient)
+        key_versioner = registry.getUtility(IKeyVersioner)
+        self.assertIsInstance(cache_client, MemoryCacheClient)
+        self.assertEqual(cache_client.entries.max_size, 2048)
+        self.assertIsInstance(key_versioner, MemoryVersionStore)
+        self.assertEqual(key_versioner.max_versions, 10)
+
+        manager = config.get_cache_manager()
+
+        def get_or_cache(body):
+            return manager.get_or_cache(lambda: Response(body), ['view'],
+                                        ['dep'])
+
+        self.assertFalse(get_or_cache('one').info().hit)
+        result = get_or_cache('two')
+        self.assertTrue(result.info().hit)
+        self.assertEqual(result.data.body, 'one')
+        config.get_versioner().incr('dep')
+        result = get_or_cache('two')
+        self.assertFalse(result.info().hit)
+        self.assertEqual(result.data.body, 'two')
@@ -18,6 +18,20 @@ class TestMetricsExtension(unittest.TestCase):
         self.assertEqual(len(event.request.metrics.keys), 1)
         self.assertEqual(event.request.metrics.keys[0], ('cache.miss', 'a_b'))
 
+    def test_cache_stale(self):
+        from pyramid_caching.ext.metrics import cache_stale
+        event = DummyEvent()
+        cache_stale(event)
+        self.assertEqual(len(event.request.metrics.keys), 1)
+        self.assertEqual(event.request.metrics.keys[0], ('cache.stale', 'a_b'))
+
+    def test_cache_budget_exceeded(self):
+        from pyramid_caching.ext.metrics import cache_budget_exceeded
+        event = DummyEvent()
+        cache_budget_exceeded(event)
+        self.assertEqual(event.request.metrics.keys,
+                         [('cache.budget_exceeded', 'a_b')])
+
 
 class DummyEvent:
     def __init__(self):
@@ -5,6 +5,7 @@ from pyramid import testing
 
 from pyramid_caching.serializers import (
     PICKLE_PROTOCOL,
+    ResponseAdapter,
     SerializerUtility,
     SERIALIZER_META_VERSION,
     )
@@ -66,6 +67,32 @@ class TestSerializers(unittest.TestCase):
         data = self._create_data(meta_version=9999)
         self.assertIsNone(utility.loads(data))
 
+    def test_decode_pickled_meta_format_version_1(self):
+        utility = SerializerUtility(self.config.registry)
+        utility.register_serialization_adapter(str, DummyAdapter)
+        data = self._create_data(meta_version=1)
+        self.assertEqual(utility.loads(data), "object")
+
+    def test_round_trip(self):
+        utility = SerializerUtility(self.config.registry)
+        utility.register_serialization_adapter(str, DummyAdapter)
+        self.assertEqual(utility.loads(utility.dumps("object")), "object")
+
+    def test_previous_release_ignores_new_entries(self):
+        from pyramid.response import Response
+        utility = SerializerUtility(self.config.registry)
+        utility.register_serialization_adapter(Response, ResponseAdapter)
+        data = utility.dumps(Response('hello'))
+
+        def previous_release_loads(data):
+            # SerializerUtility.loads of the meta version 1 releases.
+            data = pickle.loads(data)
+            if 'version' not in data or data['version'] != 1:
+                return None
+            return ResponseAdapter().deserialize(data['payload'])
+
+        self.assertIsNone(previous_release_loads(data))
+
     def test_encode_payload(self):
         utility = SerializerUtility(DummyRegistry())
         data = utility.dumps("object", adapter=DummyAdapter())
@@ -114,3 +141,113 @@ class TestSerializers(unittest.TestCase):
 
         with self.assertRaises(SerializationError):
             utility.dumps(UnknownType())
+
+
+class TestResponseAdapter(unittest.TestCase):
+
+    def _make_response(self):
+        from pyramid.response import Response
+        response = Response('\x00binary\xffbody', status='201 Created',
+                            content_type='application/octet-stream')
+        response.headers.add('Set-Cookie', 'a=1')
+        response.headers.add('Set-Cookie', 'b=2')
+        return response
+
+    def test_round_trip(self):
+        adapter = ResponseAdapter()
+        response = self._make_response()
+        copy = adapter.deserialize(adapter.serialize(response))
+        self.assertEqual(copy.status, '201 Created')
+        self.assertEqual(sorted(copy.headerlist), sorted(response.headerlist))
+        self.assertEqual(copy.body, '\x00binary\xffbody')
+
+    def test_headers_are_str(self):
+        from pyramid.response import Response
+        adapter = ResponseAdapter()
+        response = Response(u'ok')
+        response.headers[u'X-Unicode'] = u'value'
+        copy = adapter.deserialize(adapter.serialize(response))
+        for name, value in copy.headerlist:
+            self.assertIs(type(name), str)
+            self.assertIs(type(value), str)
+
+    def test_deserialize_http_message(self):
+        adapter = ResponseAdapter()
+        response = self._make_response()
+        copy = adapter.deserialize(str(response))
+        self.assertEqual(copy.status, '201 Created')
+        self.assertEqual(copy.headers.getall('Set-Cookie'), ['a=1', 'b=2'])
+        self.assertEqual(copy.body, '\x00binary\xffbody')
+
+    def test_compress(self):
+        from pyramid.response import Response
+        from pyramid_caching.serializers import GzipCompressor
+        adapter = ResponseAdapter(GzipCompressor(100))
+        response = Response('{"a": 1}' * 100, content_type='application/json',
+                            vary=['Cookie'])
+        copy = adapter.deserialize(adapter.serialize(response))
+        self.assertEqual(copy.content_encoding, 'gzip')
+        self.assertEqual(copy.headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(copy.content_length, len(copy.body))
+        self.assertLess(len(copy.body), len(response.body))
+        self.assertIsNone(response.content_encoding)
+        copy.decode_content()
+        self.assertEqual(copy.body, response.body)
+
+    def test_compress_below_min_size(self):
+        from pyramid_caching.serializers import GzipCompressor
+        adapter = ResponseAdapter(GzipCompressor(100000))
+        copy = adapter.deserialize(adapter.serialize(self._make_response()))
+        self.assertIsNone(copy.content_encoding)
+
+    def test_compress_skips_encoded_response(self):
+        from pyramid_caching.serializers import GzipCompressor
+        adapter = ResponseAdapter(GzipCompressor(1))
+        response = self._make_response()
+        response.body = 'x' * 1000
+        response.content_encoding = 'br'
+        copy = adapter.deserialize(adapter.serialize(response))
+        self.assertEqual(copy.content_encoding, 'br')
+        self.assertEqual(copy.body, 'x' * 1000)
+
+    def test_truncated_payload(self):
+        from pyramid_caching.serializers import DeserializationError
+        adapter = ResponseAdapter()
+        data = adapter.serialize(self._make_response())
+        for length in (1, len(data) // 2, len(data) - 1):
+            with self.assertRaises(DeserializationError):
+                adapter.deserialize(data[:length])
+
+
+class TestGzipCompressor(unittest.TestCase):
+
+    def test_compress(self):
+        import zlib
+        from pyramid_caching.serializers import GzipCompressor
+        data = 'x' * 1000
+        compressed = GzipCompressor(1000).compress(data)
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                         data)
+
+    def test_below_min_size(self):
+        from pyramid_caching.serializers import GzipCompressor
+        self.assertIsNone(GzipCompressor(1001).compress('x' * 1000))
+
+    def test_incompressible(self):
+        import os
+        from pyramid_caching.serializers import GzipCompressor
+        self.assertIsNone(GzipCompressor(1).compress(os.urandom(1000)))
+
+
+class TestIncludeme(unittest.TestCase):
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_compression_setting(self):
+        from pyramid.response import Response
+        config = testing.setUp(settings={'caching.compress.min_size': '10'})
+        config.include('pyramid_caching.serializers')
+        serializer = config.get_serializer()
+        response = serializer.loads(serializer.dumps(Response('x' * 100)))
+        self.assertEqual(response.content_encoding, 'gzip')
@@ -0,0 +1,157 @@
+import unittest
+
+import mock
+from zope.interface import implementer
+
+from pyramid_caching.exc import (
+    CacheAddError,
+    CacheGetError,
+    CacheKeyAlreadyExists,
+    )
+from pyramid_caching.interfaces import ICacheClient, ICacheLeaseClient
+from pyramid_caching.sharding import ConsistentHashRing, ShardedCacheClient
+
+
+class ConsistentHashRingTests(unittest.TestCase):
+
+    def test_spread_keys(self):
+        ring = ConsistentHashRing(['a', 'b', 'c'])
+        counts = {'a': 0, 'b': 0, 'c': 0}
+        for i in range(3000):
+            counts[ring.get_node('key%d' % i)] += 1
+        for count in counts.itervalues():
+            self.assertGreater(count, 700)
+
+    def test_adding_node_moves_few_keys(self):
+        before = ConsistentHashRing(['a', 'b', 'c'])
+        after = ConsistentHashRing(['a', 'b', 'c', 'd'])
+        keys = ['key%d' % i for i in range(3000)]
+        moved = [key for key in keys
+                 if before.get_node(key) != after.get_node(key)]
+        self.assertTrue(all(after.get_node(key) == 'd' for key in moved))
+        self.assertLess(len(moved), 1200)
+
+    def test_independent_of_node_order(self):
+        ring1 = ConsistentHashRing(['a', 'b', 'c'])
+        ring2 = ConsistentHashRing(['c', 'a', 'b'])
+        for i in range(100):
+            self.assertEqual(ring1.get_node('key%d' % i),
+                             ring2.get_node('key%d' % i))
+
+    def test_iter_nodes(self):
+        ring = ConsistentHashRing(['a', 'b', 'c'])
+        nodes = list(ring.iter_nodes('key'))
+        self.assertEqual(sorted(nodes), ['a', 'b', 'c'])
+        self.assertEqual(nodes[0], ring.get_node('key'))
+
+
+class ShardedCacheClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = dict((name, DictClient()) for name in 'abc')
+        self.client = ShardedCacheClient(self.shards, retry_interval=30)
+
+    def _owner(self, key):
+        return self.shards[self.client.ring.get_node(key)]
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        self.assertTrue(verifyObject(ICacheClient, self.client))
+        self.assertTrue(ICacheLeaseClient.providedBy(self.client))
+
+    def test_no_lease_interface(self):
+        client = ShardedCacheClient({'a': DictClient(),
+                                     'b': mock.Mock(spec=['get'])})
+        self.assertFalse(ICacheLeaseClient.providedBy(client))
+
+    def test_add_get(self):
+        for i in range(20):
+            self.client.add('key%d' % i, 'value%d' % i, expiration=60)
+        for i in range(20):
+            key = 'key%d' % i
+            self.assertEqual(self._owner(key).data[key], 'value%d' % i)
+            self.assertEqual(self.client.get(key), 'value%d' % i)
+        self.assertTrue(all(shard.data for shard in self.shards.values()))
+
+    def test_add_existing(self):
+        self.client.add('key', 'value')
+        with self.assertRaises(CacheKeyAlreadyExists):
+            self.client.add('key', 'other')
+
+    def test_leases(self):
+        token = self.client.acquire_lease('key', 5)
+        self.assertIsNone(self.client.acquire_lease('key', 5))
+        self.client.release_lease('key', token)
+        self.assertIsNotNone(self.client.acquire_lease('key', 5))
+
+    def test_flush_all(self):
+        self.client.add('key', 'value')
+        self.client.flush_all()
+        self.assertIsNone(self.client.get('key'))
+
+    @mock.patch('pyramid_caching.sharding.time')
+    def test_dead_shard_is_skipped(self, m_time):
+        m_time.time.return_value = 1000
+        owner = self._owner('key')
+        owner.fail = True
+
+        self.client.add('key', 'value')
+        self.assertNotIn('key', owner.data)
+        self.assertEqual(self.client.get('key'), 'value')
+        self.assertEqual(owner.calls, 1)
+
+        m_time.time.return_value = 1031
+        owner.fail = False
+        self.assertIsNone(self.client.get('key'))
+        self.assertEqual(owner.calls, 2)
+
+    def test_all_shards_dead(self):
+        for shard in self.shards.values():
+            shard.fail = True
+        with self.assertRaises(CacheGetError):
+            self.client.get('key')
+        with self.assertRaises(CacheAddError):
+            self.client.add('key', 'value')
+
+
+@implementer(ICacheLeaseClient)
+class DictClient(object):
+
+    def __init__(self):
+        self.data = {}
+        self.fail = False
+        self.calls = 0
+
+    def _check(self):
+        self.calls += 1
+        if self.fail:
+            raise CacheGetError('down')
+
+    def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    def add(self, key, value, expiration=None):
+        self._check()
+        if key in self.data:
+            raise CacheKeyAlreadyExists(key)
+        self.data[key] = value
+
+    def set(self, key, value, expiration=None):
+        self._check()
+        self.data[key] = value
+
+    def acquire_lease(self, key, ttl):
+        self._check()
+        if 'lease:' + key in self.data:
+            return None
+        self.data['lease:' + key] = 'token'
+        return 'token'
+
+    def release_lease(self, key, token):
+        self._check()
+        if self.data.get('lease:' + key) == token:
+            del self.data['lease:' + key]
+
+    def flush_all(self):
+        self.data.clear()
@@ -1,7 +1,16 @@
 import unittest
 
+import mock
+
 from pyramid.config import Configurator
-from sqlalchemy import create_engine, Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    create_engine,
+    event,
+    Column,
+    ForeignKey,
+    Integer,
+    String,
+    )
 from sqlalchemy.ext.declarative import declarative_base, DeferredReflection
 from sqlalchemy.orm import scoped_session, sessionmaker
 
@@ -29,9 +38,25 @@ class Score(Base):
     points = Column('points', Integer)
 
 
-class SqlAlchemyExtensionTests(unittest.TestCase):
+def _enable_sqlite_savepoints(engine):
+    """Let SQLAlchemy emit BEGIN, pysqlite breaks SAVEPOINT otherwise."""
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.execute('BEGIN')
+
+
+class SqlAlchemyTestCase(unittest.TestCase):
+
+    def make_identity_inspector(self):
+        return None
+
     def setUp(self):
         self.engine = create_engine('sqlite:///:memory:')
+        _enable_sqlite_savepoints(self.engine)
         self.session = scoped_session(sessionmaker(bind=self.engine))
         Base.metadata.create_all(self.engine)
         Base.prepare(self.engine)
@@ -43,7 +68,8 @@ class SqlAlchemyExtensionTests(unittest.TestCase):
         self.config = Configurator(settings={
             'caching.enabled': True,
             })
-        register_sqlalchemy_caching(self.config, self.session, Base)
+        register_sqlalchemy_caching(self.config, self.session, Base,
+                                    self.make_identity_inspector())
 
         self.config.registry.registerAdapter(lambda x: x,
                                              required=[str],
@@ -59,6 +85,9 @@ class SqlAlchemyExtensionTests(unittest.TestCase):
     def tearDown(self):
         Base.metadata.drop_all(self.engine)
 
+
+class SqlAlchemyExtensionTests(SqlAlchemyTestCase):
+
     def test_create_entity(self):
         u = User(id=2, name='bob', address='123 street')
         self.session.add(u)
@@ -93,14 +122,298 @@ class SqlAlchemyExtensionTests(unittest.TestCase):
             self.key_versioner.incr_keys,
             ['users', 'scores:user_id=2'])
 
+    def test_increment_in_one_batch(self):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        user.address = 'up the hill'
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        self.assertEqual(len(self.key_versioner.batches), 1)
+        self.assertItemsEqual(self.key_versioner.batches[0],
+                              ['users', 'users:id=1:name=hadrien'])
+
+    @mock.patch('pyramid_caching.ext.sqlalchemy.log')
+    def test_increment_failures_are_logged(self, m_log):
+        from pyramid_caching.exc import VersionMultiIncrementError
+        error = ValueError()
+        self.key_versioner.incr_multi = mock.Mock(
+            side_effect=VersionMultiIncrementError({'users': error}))
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        m_log.error.assert_called_once_with(
+            'Entity version increment failed key=%s: %s', 'users', error)
+
+    def test_listeners_registered_once(self):
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        self.session.commit()
+        self.assertEqual(len(self.key_versioner.batches), 1)
+
+    def test_include_flushed_changes(self):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        user.address = 'up the hill'
+        self.session.flush()
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        self.assertEqual(len(self.key_versioner.batches), 1)
+        self.assertItemsEqual(self.key_versioner.batches[0],
+                              ['users', 'users:id=1:name=hadrien'])
+
+    def test_rollback_drops_changes(self):
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.flush()
+        self.session.rollback()
+        self.session.commit()
+        self.assertEqual(self.key_versioner.batches, [])
+
+    def test_released_savepoint(self):
+        self.session.begin_nested()
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        self.assertEqual(self.key_versioner.batches, [])
+        self.session.commit()
+        self.assertEqual(self.key_versioner.batches, [['users']])
+
+    def test_rolled_back_savepoint(self):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        user.address = 'up the hill'
+        self.session.begin_nested()
+        self.session.add(Score(id=1, user_id=1, points=25))
+        self.session.flush()
+        self.session.rollback()
+        self.session.commit()
+        self.assertEqual(len(self.key_versioner.batches), 1)
+        self.assertItemsEqual(self.key_versioner.batches[0],
+                              ['users', 'users:id=1:name=hadrien'])
+
+    def test_nothing_pending_after_commit(self):
+        from pyramid_caching.ext.sqlalchemy import SESSION_INFO_KEY
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        self.assertEqual(self.session().info[SESSION_INFO_KEY], {})
+
+    def test_bulk_update(self):
+        self.session.query(User).filter_by(id=1).update(
+            {'address': 'up the hill'}, synchronize_session=False)
+        self.session.commit()
+        self.assertEqual(len(self.key_versioner.batches), 1)
+        self.assertItemsEqual(self.key_versioner.batches[0],
+                              ['users', 'users:*'])
+
+    def test_bulk_delete(self):
+        self.session.query(User).filter_by(id=1).delete(
+            synchronize_session=False)
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['users', 'users:*'])
+
+    def test_core_insert(self):
+        self.session.execute(Score.__table__.insert().values(
+            id=1, user_id=1, points=25))
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['scores', 'scores:*'])
+
+    def test_core_select_is_ignored(self):
+        self.session.execute(Score.__table__.select())
+        self.session.commit()
+        self.assertEqual(self.key_versioner.batches, [])
+
+    def test_bulk_update_rollback(self):
+        self.session.query(User).update({'address': 'up the hill'},
+                                        synchronize_session=False)
+        self.session.rollback()
+        self.session.commit()
+        self.assertEqual(self.key_versioner.batches, [])
+
+    def test_bulk_update_in_new_transactions(self):
+        for address in ('up the hill', 'down the hill'):
+            self.session.query(User).update({'address': address},
+                                            synchronize_session=False)
+            self.session.commit()
+        self.assertEqual(len(self.key_versioner.batches), 2)
+
+    def test_core_update_after_flush_without_work(self):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.flush([user])
+        self.session.execute(User.__table__.update().values(
+            address='up the hill'))
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['users', 'users:*'])
+
+    def test_identities_scoped_by_table_generation(self):
+        user = self.session.query(User).first()
+        identify = self.config.registry.getAdapter
+        for identity in (identify(user, IIdentityInspector),
+                         identify(User, IIdentityInspector)):
+            self.assertEqual(identity.scopes, ('users:*',))
+
+    def _modify_hadrien(self, **values):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        for name, value in values.iteritems():
+            setattr(user, name, value)
+        self.session.commit()
+
+    def test_unchanged_value(self):
+        self._modify_hadrien(address='down the hill')
+        self.assertEqual(self.key_versioner.batches, [])
+
+    def test_ignored_column(self):
+        User.__cache_ignore__ = ('address',)
+        self.addCleanup(delattr, User, '__cache_ignore__')
+        self._modify_hadrien(address='up the hill')
+        self.assertEqual(self.key_versioner.batches, [])
+
+    def test_relevant_columns(self):
+        User.__cache_columns__ = ('name',)
+        self.addCleanup(delattr, User, '__cache_columns__')
+        self._modify_hadrien(address='up the hill')
+        self.assertEqual(self.key_versioner.batches, [])
+        self._modify_hadrien(name='bob', address='down the hill')
+        self.assertEqual(len(self.key_versioner.batches), 1)
+
+    def test_ignored_column_with_other_changes(self):
+        score = Score(id=1, user_id=1, points=25)
+        self.session.add(score)
+        self.session.commit()
+        Score.__cache_ignore__ = ('points',)
+        self.addCleanup(delattr, Score, '__cache_ignore__')
+        score.points = 30
+        score.user_id = 2
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.batches[-1],
+                              ['scores:user_id=2', 'scores:id=1'])
+
+
+class PrefixedIdentityInspectorTests(SqlAlchemyTestCase):
+
+    def make_identity_inspector(self):
+        from pyramid_caching.ext.sqlalchemy import DefaultIdentityInspector
+
+        class PrefixedIdentityInspector(DefaultIdentityInspector):
+            def table_name(self, entity):
+                return 'app.' + entity.__tablename__
+
+        return PrefixedIdentityInspector()
+
+    def test_bulk_update(self):
+        self.session.query(User).filter_by(id=1).update(
+            {'address': 'up the hill'}, synchronize_session=False)
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['app.users', 'app.users:*'])
+
+    def test_core_insert(self):
+        self.session.execute(Score.__table__.insert().values(
+            id=1, user_id=1, points=25))
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['app.scores', 'app.scores:*'])
+
+
+class MinimalIdentityInspector(object):
+
+    def identify_instance(self, instance):
+        return '%s:id=%s' % (instance.__tablename__, instance.id)
+
+    def identify_collection(self, collection):
+        return collection.instance().__tablename__
+
+    def identify_class(self, cls):
+        return cls.__tablename__
+
+
+class MinimalIdentityInspectorTests(SqlAlchemyTestCase):
+
+    def make_identity_inspector(self):
+        return MinimalIdentityInspector()
+
+    def test_create_entity(self):
+        self.session.add(User(id=2, name='bob', address='123 street'))
+        self.session.commit()
+        self.assertEqual(self.key_versioner.incr_keys, ['users'])
+
+    def test_modify_entity(self):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        user.address = 'up the hill'
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['users', 'users:id=1'])
+
+    def test_delete_entity(self):
+        user = self.session.query(User).filter_by(name='hadrien').first()
+        self.session.delete(user)
+        self.session.commit()
+        self.assertItemsEqual(self.key_versioner.incr_keys,
+                              ['users', 'users:id=1'])
+
+    def test_bulk_update(self):
+        self.session.query(User).filter_by(id=1).update(
+            {'address': 'up the hill'}, synchronize_session=False)
+        self.session.commit()
+        self.assertEqual(self.key_versioner.incr_keys, ['users'])
+
+
+class DefaultIdentityInspectorTests(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid_caching.ext.sqlalchemy import DefaultIdentityInspector
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        Base.prepare(engine)
+        self.inspector = DefaultIdentityInspector()
+
+    def test_identify_instance(self):
+        identity = self.inspector.identify_instance(
+            User(id=1, name='bob', address='street'))
+        self.assertEqual(identity, 'users:id=1:name=bob')
+        self.assertEqual(identity.scopes, ('users:*',))
+
+    def test_identify_collection(self):
+        from pyramid_caching.ext.sqlalchemy import Collection
+        score = Score(id=1, user_id=2)
+        self.assertEqual(self.inspector.identify_collection(Collection(score)),
+                         'scores:user_id=2')
+
+    def test_columns_looked_up_once_per_class(self):
+        with mock.patch.object(self.inspector, 'primary_key_column_names',
+                               return_value=['name', 'id']) as m_names:
+            for i in range(3):
+                self.inspector.identify_instance(
+                    User(id=i, name='bob', address='street'))
+        self.assertEqual(m_names.call_count, 1)
+
+    @mock.patch('pyramid_caching.ext.sqlalchemy.log')
+    def test_none_value(self, m_log):
+        identity = self.inspector.identify_instance(User(name='bob'))
+        self.assertEqual(identity, 'users:name=bob')
+        self.assertEqual(identity.scopes, ('users:*',))
+        m_log.warning.assert_called_once_with('Caching key %s:%s is None',
+                                              'users', 'id')
+
+    def test_identify_modified(self):
+        users = [User(id=i, name='bob', address='street') for i in range(3)]
+        scores = [Score(id=i, user_id=i % 2) for i in range(4)]
+        identities = self.inspector.identify_modified(
+            new=users + scores, deleted=scores[:1])
+        self.assertEqual(identities, set(['users', 'scores:user_id=0',
+                                          'scores:user_id=1', 'scores:id=0']))
+
 
 class DummyKeyVersioner:
     def __init__(self):
         self._incr_keys = set()
+        self.batches = []
 
     def incr(self, key):
         self._incr_keys.add(key)
 
+    def incr_multi(self, keys):
+        self.batches.append(keys)
+        for key in keys:
+            self.incr(key)
+
     @property
     def incr_keys(self):
         return list(self._incr_keys)
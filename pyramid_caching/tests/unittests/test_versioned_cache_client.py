@@ -0,0 +1,186 @@
+import unittest
+
+import mock
+
+from pyramid.exceptions import ConfigurationError
+from redis import StrictRedis, RedisError
+
+from pyramid_caching.cache import CacheKey
+from pyramid_caching.ext.redis import (
+    include_versioned_cache_client,
+    RedisCacheWrapper,
+    RedisVersionedCacheWrapper,
+    RedisVersionWrapper,
+    )
+from pyramid_caching.exc import (
+    CacheDisabled,
+    VersionGetError,
+    VersionMasterVersionError,
+    )
+
+
+class TestRedisVersionedCacheWrapper(unittest.TestCase):
+
+    def setUp(self):
+        self.version_store = RedisVersionWrapper(StrictRedis(db=8))
+        self.cache_store = RedisCacheWrapper(StrictRedis(db=8))
+        self.version_store.flush_all()
+        self.addCleanup(self.version_store.flush_all)
+        self.client = RedisVersionedCacheWrapper(self.version_store,
+                                                 self.cache_store)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from pyramid_caching.interfaces import IVersionedCacheClient
+
+        self.assertTrue(verifyObject(IVersionedCacheClient, self.client))
+
+    @mock.patch('pyramid_caching.ext.redis.time')
+    def test_initialize_master_version(self, m_time):
+        m_time.time.return_value = 1234.123
+
+        versions, data = self.client.get_versioned('root', ['FOO'])
+
+        self.assertEqual(versions, [('cache', '1234'), ('FOO', '0')])
+        self.assertIsNone(data)
+
+    def test_versions_match_version_store(self):
+        self.version_store.incr('BAR')
+        self.version_store.incr('BAR')
+
+        versions, data = self.client.get_versioned('root', ['FOO', 'BAR'])
+
+        self.assertEqual(versions,
+                         self.version_store.get_multi(['FOO', 'BAR']))
+
+    def test_get_cached_data(self):
+        versions = self.version_store.get_multi(['FOO', 'BAR'])
+        key = CacheKey(['a', 'b'], ['%s:v=%s' % v for v in versions])
+        self.cache_store.add(str(key), 'DATA')
+
+        versions, data = self.client.get_versioned('a:b', ['FOO', 'BAR'])
+
+        self.assertEqual(data, 'DATA')
+
+    def test_single_round_trip_with_known_versions(self):
+        versions = self.version_store.get_multi(['FOO'])
+        key = CacheKey(['a', 'b'], ['%s:v=%s' % v for v in versions])
+        self.cache_store.add(str(key), 'DATA')
+        self.client.get_versioned('a:b', ['FOO'])
+
+        with mock.patch.object(self.cache_store, 'get') as m_get:
+            versions, data = self.client.get_versioned('a:b', ['FOO'])
+
+        self.assertEqual(data, 'DATA')
+        self.assertFalse(m_get.called)
+
+    def test_version_bump_misses(self):
+        versions = self.version_store.get_multi(['FOO'])
+        key = CacheKey(['a', 'b'], ['%s:v=%s' % v for v in versions])
+        self.cache_store.add(str(key), 'DATA')
+        self.version_store.incr('FOO')
+
+        versions, data = self.client.get_versioned('a:b', ['FOO'])
+
+        self.assertIsNone(data)
+
+    def test_version_bump_after_known_versions(self):
+        versions = self.version_store.get_multi(['FOO'])
+        key = CacheKey(['a', 'b'], ['%s:v=%s' % v for v in versions])
+        self.cache_store.add(str(key), 'DATA')
+        self.client.get_versioned('a:b', ['FOO'])
+        self.version_store.incr('FOO')
+        versions = self.version_store.get_multi(['FOO'])
+        key = CacheKey(['a', 'b'], ['%s:v=%s' % v for v in versions])
+        self.cache_store.add(str(key), 'NEW')
+
+        versions, data = self.client.get_versioned('a:b', ['FOO'])
+
+        self.assertEqual(data, 'NEW')
+        self.assertEqual(versions[1], ('FOO', '1'))
+
+    def test_inhibit_caching(self):
+        self.version_store.client.set('cache', 'off')
+
+        with self.assertRaises(CacheDisabled):
+            self.client.get_versioned('root', [])
+
+
+class TestRedisVersionedCacheWrapperErrors(unittest.TestCase):
+
+    def setUp(self):
+        self.version_client = mock.Mock(name='VersionClient')
+        self.cache_client = mock.Mock(name='CacheClient')
+        self.script = self.version_client.register_script.return_value
+        self.client = RedisVersionedCacheWrapper(
+            RedisVersionWrapper(self.version_client),
+            RedisCacheWrapper(self.cache_client))
+
+    def test_script_args(self):
+        self.script.return_value = [0, ['42', '1']]
+        self.cache_client.get.return_value = 'DATA'
+
+        result = self.client.get_versioned('root', ['one'])
+
+        self.assertEqual(result, ([('cache', '42'), ('one', '1')], 'DATA'))
+        self.script.assert_called_once_with(keys=['cache', 'one'],
+                                            args=['off', 2])
+        self.cache_client.get.assert_called_once_with(
+            'root:cache:v=42:one:v=1')
+
+    def test_script_args_with_known_versions(self):
+        self.script.return_value = [0, ['42', '1']]
+        self.cache_client.get.return_value = None
+        self.client.get_versioned('root', ['one'])
+        self.script.reset_mock()
+        self.script.return_value = [1, ['42', '1'], 'DATA']
+
+        result = self.client.get_versioned('root', ['one'])
+
+        self.assertEqual(result, ([('cache', '42'), ('one', '1')], 'DATA'))
+        self.script.assert_called_once_with(
+            keys=['cache', 'one', 'root:cache:v=42:one:v=1'],
+            args=['off', 2, '42', '1'])
+        self.assertEqual(self.cache_client.get.call_count, 1)
+
+    def test_redis_error(self):
+        self.script.side_effect = RedisError()
+
+        with self.assertRaises(VersionGetError):
+            self.client.get_versioned('root', [])
+
+    def test_no_master_version_after_reset_attempt(self):
+        self.script.return_value = None
+        self.version_client.mget.return_value = ['42']
+
+        with self.assertRaises(VersionMasterVersionError):
+            self.client.get_versioned('root', [])
+
+
+class TestIncludeVersionedCacheClient(unittest.TestCase):
+
+    def test_requires_same_database(self):
+        config = mock.Mock(name='config')
+        cache_store = RedisCacheWrapper(StrictRedis(db=5))
+        version_store = RedisVersionWrapper(StrictRedis(db=8))
+
+        with self.assertRaises(ConfigurationError):
+            include_versioned_cache_client(config, cache_store, version_store)
+
+    def test_requires_same_server(self):
+        config = mock.Mock(name='config')
+        cache_store = RedisCacheWrapper(StrictRedis(host='cache.local'))
+        version_store = RedisVersionWrapper(StrictRedis(host='version.local'))
+
+        with self.assertRaises(ConfigurationError):
+            include_versioned_cache_client(config, cache_store, version_store)
+
+    def test_register_client(self):
+        config = mock.Mock(name='config')
+        cache_store = RedisCacheWrapper(StrictRedis(db=5))
+        version_store = RedisVersionWrapper(StrictRedis(db=5))
+
+        include_versioned_cache_client(config, cache_store, version_store)
+
+        client, = config.add_versioned_cache_client.call_args[0]
+        self.assertIs(client.cache_store, cache_store)
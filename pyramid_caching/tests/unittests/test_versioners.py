@@ -1,9 +1,15 @@
 import inspect
 import unittest
 
+import mock
+
 from nose_parameterized import parameterized
 from zope.interface import implementer
 
+from pyramid_caching.exc import (
+    VersionIncrementError,
+    VersionMultiIncrementError,
+    )
 from pyramid_caching.interfaces import IIdentityInspector
 from pyramid_caching.versioner import Versioner
 
@@ -47,6 +53,10 @@ def get_basic():
 
         def incr(self, key):
             self._d[key] += 1
+
+        def incr_multi(self, keys):
+            for key in keys:
+                self.incr(key)
     key_versioner = TestKeyVersioner()
 
     id_inspector = BasicModelIdentityInspector()
@@ -101,3 +111,154 @@ class TestBasic(unittest.TestCase):
 
         self.assertNotEqual(key_id1_v0, key_id1_v1)
         self.assertNotEqual(key_cls_v0, key_cls_v1)
+
+
+class TestIncrMulti(unittest.TestCase):
+
+    def test_dedupe_keys(self):
+        key_versioner = mock.Mock(name='KeyVersioner')
+        versioner = Versioner(key_versioner, None, identify=str)
+
+        versioner.incr_multi(['a', 'b', 'a', 1])
+
+        key_versioner.incr_multi.assert_called_once_with(['a', 'b', '1'])
+
+    def test_nothing_to_increment(self):
+        key_versioner = mock.Mock(name='KeyVersioner')
+        versioner = Versioner(key_versioner, None, identify=str)
+
+        versioner.incr_multi([])
+
+        self.assertFalse(key_versioner.incr_multi.called)
+
+    def test_fallback_to_incr(self):
+        key_versioner = mock.Mock(name='KeyVersioner', spec=['incr'])
+        versioner = Versioner(key_versioner, None, identify=str)
+
+        versioner.incr_multi(['a', 'b', 'a'])
+
+        self.assertEqual(key_versioner.incr.call_args_list,
+                         [mock.call('a'), mock.call('b')])
+
+    def test_fallback_to_incr_collects_failures(self):
+        error = VersionIncrementError('down')
+
+        class IncrOnlyKeyVersioner(object):
+            def __init__(self):
+                self.incremented = []
+
+            def incr(self, key):
+                if key == 'b':
+                    raise error
+                self.incremented.append(key)
+
+        key_versioner = IncrOnlyKeyVersioner()
+        versioner = Versioner(key_versioner, None, identify=str)
+
+        with self.assertRaises(VersionMultiIncrementError) as ctx:
+            versioner.incr_multi(['a', 'b', 'c'])
+
+        self.assertEqual(ctx.exception.failures, {'b': error})
+        self.assertEqual(key_versioner.incremented, ['a', 'c'])
+
+
+class TestIdentify(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid.config import Configurator
+        self.config = Configurator()
+        self.config.include('pyramid_caching.versioner')
+        self.versioner = Versioner(None, self.config)
+
+    def test_builtin_types(self):
+        identify = self.versioner.identify
+        self.assertEqual(identify('a'), 'a')
+        self.assertEqual(identify(u'b'), 'b')
+        self.assertEqual(identify(1), '1')
+        self.assertEqual(identify(('a', {'id': 1, 'b': (2, 3)})),
+                         'a:b=2:3:id=1')
+
+    def test_adapter_looked_up_once_per_type(self):
+        adapters = self.config.registry.adapters
+        with mock.patch.object(adapters, 'lookup',
+                               wraps=adapters.lookup) as m_lookup:
+            for value in ('a', 'b', ('c', 'd'), ('e', 'f')):
+                self.versioner.identify(value)
+        self.assertEqual(m_lookup.call_count, 2)
+
+    def test_directly_provided_interface(self):
+        from zope.interface import Interface, alsoProvides
+
+        class IMarker(Interface):
+            pass
+
+        self.config.registry.registerAdapter(
+            lambda x: 'model', required=[BasicModel],
+            provided=IIdentityInspector)
+        self.config.registry.registerAdapter(
+            lambda x: 'marked', required=[IMarker],
+            provided=IIdentityInspector)
+        marked = BasicModel(2)
+        alsoProvides(marked, IMarker)
+
+        self.assertEqual(self.versioner.identify(BasicModel(1)), 'model')
+        self.assertEqual(self.versioner.identify(marked), 'marked')
+
+    def test_no_adapter(self):
+        with self.assertRaises(TypeError):
+            self.versioner.identify(BasicModel(1))
+
+    def test_identify_all_dedupes_keys(self):
+        self.assertEqual(self.versioner.identify_all(['a', 'b', 'a', ('b',)]),
+                         ['a', 'b'])
+
+
+class TestScopedIdentity(unittest.TestCase):
+
+    def test_identify_all_appends_scopes(self):
+        from pyramid_caching.versioner import ScopedIdentity
+        identities = {
+            'a': ScopedIdentity('a:1', ['a:*']),
+            'b': ScopedIdentity('a:2', ['a:*']),
+            'c': 'c',
+            }
+        versioner = Versioner(None, None, identify=identities.get)
+
+        self.assertEqual(versioner.identify_all(['a', 'b', 'c']),
+                         ['a:1', 'a:2', 'c', 'a:*'])
+
+    def test_incr_multi_ignores_scopes(self):
+        from pyramid_caching.versioner import ScopedIdentity
+        key_versioner = mock.Mock(name='KeyVersioner')
+        versioner = Versioner(key_versioner, None,
+                              identify=lambda x: ScopedIdentity(x, ['*']))
+
+        versioner.incr_multi(['a'])
+
+        key_versioner.incr_multi.assert_called_once_with(['a'])
+
+    def test_join_keeps_scopes(self):
+        from pyramid_caching.versioner import (
+            DictIdentityInspector,
+            ScopedIdentity,
+            TupleIdentityInspector,
+            )
+
+        def identify(x):
+            if x == 'model':
+                return ScopedIdentity('model', ['model:*'])
+            if isinstance(x, dict):
+                return DictIdentityInspector(identify).identify(x)
+            return str(x)
+
+        identity = TupleIdentityInspector(identify).identify(
+            ('model', {'id': 1}))
+
+        self.assertEqual(identity, 'model:id=1')
+        self.assertEqual(identity.scopes, ('model:*',))
+
+    def test_join_without_scopes(self):
+        from pyramid_caching.versioner import DictIdentityInspector
+        identity = DictIdentityInspector(str).identify({'a': 1, 'b': 2})
+        self.assertIs(type(identity), str)
+        self.assertEqual(identity, 'a=1:b=2')
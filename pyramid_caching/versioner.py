@@ -1,7 +1,11 @@
 import logging
 
-from zope.interface import implementer
+from zope.interface import implementedBy, implementer, providedBy
 
+from pyramid_caching.exc import (
+    VersionIncrementError,
+    VersionMultiIncrementError,
+    )
 from pyramid_caching.interfaces import (
     IIdentityInspector,
     IVersioner,
@@ -20,25 +24,20 @@ def includeme(config):
                 'Could not adapt %r to a cache identity' % model_obj_or_cls)
         return y
 
-    registry.registerAdapter(lambda x: x, required=[str],
-                             provided=IIdentityInspector)
-
-    registry.registerAdapter(lambda x: str(x), required=[unicode],
+    registry.registerAdapter(_same, required=[str],
                              provided=IIdentityInspector)
 
-    registry.registerAdapter(lambda x: str(x), required=[int],
-                             provided=IIdentityInspector)
-
-    registry.registerAdapter(lambda x: str(x), required=[float],
-                             provided=IIdentityInspector)
+    for required in (unicode, int, float):
+        registry.registerAdapter(str, required=[required],
+                                 provided=IIdentityInspector)
 
     registry.registerAdapter(
-        lambda x: TupleIdentityInspector(identify).identify(x),
+        ContainerIdentityAdapter(TupleIdentityInspector, identify),
         required=[tuple],
         provided=IIdentityInspector,
         )
     registry.registerAdapter(
-        lambda x: DictIdentityInspector(identify).identify(x),
+        ContainerIdentityAdapter(DictIdentityInspector, identify),
         required=[dict],
         provided=IIdentityInspector,
         )
@@ -55,17 +54,50 @@ def includeme(config):
     config.action((__name__, 'versioner'), register, order=1)
 
 
+def _same(x):
+    return x
+
+
 def get_versioner(config_or_request):
     return config_or_request.registry.getUtility(IVersioner)
 
 
+class ScopedIdentity(str):
+
+    """An identity whose cached versions also depend on other keys.
+
+    Views depending on this identity are invalidated when the version of the
+    identity or of any of its ``scopes`` is incremented. For example, all the
+    rows of a table can be invalidated at once when the modified rows are
+    unknown.
+    """
+
+    def __new__(cls, identity, scopes=()):
+        self = str.__new__(cls, identity)
+        self.scopes = tuple(scopes)
+        return self
+
+
+def join_identities(identities, separator=':'):
+    """Join identities, keeping the scopes of each of them."""
+    joined = separator.join(identities)
+    scopes = []
+    for identity in identities:
+        for scope in getattr(identity, 'scopes', ()):
+            if scope not in scopes:
+                scopes.append(scope)
+    if scopes:
+        return ScopedIdentity(joined, scopes)
+    return joined
+
+
 @implementer(IIdentityInspector)
 class TupleIdentityInspector(object):
     def __init__(self, identify):
         self._identify = identify
 
     def identify(self, t):
-        return ':'.join([self._identify(elem) for elem in t])
+        return join_identities([self._identify(elem) for elem in t])
 
 
 @implementer(IIdentityInspector)
@@ -75,33 +107,115 @@ class DictIdentityInspector(object):
         self._identify = identify
 
     def identify(self, dict_like):
-        elems = ['%s=%s' % (self._identify(k), self._identify(v))
+        elems = [join_identities([self._identify(k), self._identify(v)], '=')
                  for k, v in sorted(dict_like.iteritems())]
-        return ':'.join(elems)
+        return join_identities(elems)
+
+
+class ContainerIdentityAdapter(object):
+
+    """Identify a tuple or a dict with an inspector of its elements."""
+
+    def __init__(self, inspector_class, identify):
+        self.inspector_class = inspector_class
+        self.inspector = inspector_class(identify)
+
+    def __call__(self, obj):
+        return self.inspector.identify(obj)
+
+
+# Instances of these types can not provide interfaces of their own.
+_BUILTIN_TYPES = frozenset([str, unicode, int, long, float, tuple, dict])
 
 
 @implementer(IVersioner)
 class Versioner(object):
 
+    """Identify dependencies and resolve their versions.
+
+    The identity adapter of a type is looked up in the registry the first
+    time one of its instances is identified, then reused: adapters must be
+    registered before the configuration is committed.
+    """
+
     def __init__(self, key_versioner, config, identify=None):
         self.key_versioner = key_versioner
         if identify is not None:
             self.identify = identify
         else:
             self.registry = config.registry
+            self._adapters = {}
 
     def identify(self, x):
-        y = self.registry.queryAdapter(x, IIdentityInspector)
+        cls = type(x)
+        spec = cls if cls in _BUILTIN_TYPES else providedBy(x)
+        try:
+            adapter = self._adapters[spec]
+        except KeyError:
+            adapter = self._adapters[spec] = self._lookup_adapter(spec)
+        y = adapter(x) if adapter is not None else None
         if y is None:
             raise TypeError('Could not adapt %r to a cache identity' % x)
         return y
 
+    def _lookup_adapter(self, spec):
+        if isinstance(spec, type):
+            spec = implementedBy(spec)
+        adapter = self.registry.adapters.lookup((spec,), IIdentityInspector)
+        if isinstance(adapter, ContainerIdentityAdapter):
+            # Identify the elements through the same cache.
+            adapter = adapter.inspector_class(self.identify).identify
+        return adapter
+
     def get_multi_keys(self, things):
-        keys = [self.identify(anything) for anything in things]
+        keys = self.identify_all(things)
 
         versiontuples = self.key_versioner.get_multi(keys)
 
+        return self.format_keys(versiontuples)
+
+    def identify_all(self, things):
+        """Return the distinct keys identifying things, followed by their
+        scopes."""
+        keys = []
+        seen = set()
+        scopes = []
+        for key in map(self.identify, things):
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            for scope in getattr(key, 'scopes', ()):
+                if scope not in seen:
+                    seen.add(scope)
+                    scopes.append(scope)
+        return keys + scopes
+
+    def format_keys(self, versiontuples):
         return ['%s:v=%s' % (key, version) for (key, version) in versiontuples]
 
     def incr(self, obj_or_cls):
         self.key_versioner.incr(self.identify(obj_or_cls))
+
+    def incr_multi(self, objs_or_classes):
+        keys = []
+        seen = set()
+        for key in map(self.identify, objs_or_classes):
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        if not keys:
+            return
+        incr_multi = getattr(self.key_versioner, 'incr_multi', None)
+        if incr_multi is not None:
+            incr_multi(keys)
+            return
+        # Key versioners written before incr_multi only increment one key.
+        failures = {}
+        for key in keys:
+            try:
+                self.key_versioner.incr(key)
+            except VersionIncrementError as error:
+                failures[key] = error
+        if failures:
+            raise VersionMultiIncrementError(failures)